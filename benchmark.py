@@ -0,0 +1,355 @@
+"""
+Benchmark and numerical regression suite of the disentangling kernels, on synthetic spectra so no FITS files are needed.
+Every case is run through the NumPy GridEngine and the compiled gridfd3 and fd3 engines (if built in ./bin). It reports
+evaluations per second, and the chisq grids and component spectra of the checked cases are compared with the stored
+reference outputs. The shipped references were made with the NumPy engine and have not been checked against a build
+of the compiled engines yet, so a failing compiled engine check may also mean the two engines differ beyond the
+tolerances. With the compiled engines, the engine counters split the time over dft_fwd, triorb_rv (with
+kepler_psiofmu), and the assembly, svd and chisq phases of fd3sep. The startup benchmark times the import of the
+compute modules in fresh interpreters, and fails if they pull in the plotting or FITS stack. The memory benchmark
+reports the peak resident memory of fresh interpreters holding the spectra of a Monte Carlo run in several layouts.
+The propagation check fails if the best fit of modules.propagation changes between calls on a line that perturbs its
+spectra.
+"""
+
+import os
+import pathlib
+import subprocess as sp
+import sys
+import time
+
+import numpy as np
+
+import modules.gridengine as gridengine
+import modules.gridfd3classes as fd3classes
+import modules.kepler as kepler
+import modules.propagation as propagation
+import modules.synthetic as synthetic
+
+# input
+# folder of the reference outputs, the results and the engine files
+benchfolder = 'benchmarks'
+reference = benchfolder + '/reference.npz'
+
+# overwrite the reference outputs with those of the NumPy engine instead of checking against them. Only do this after
+# a change that is meant to alter the results. The compiled engines are checked against these NumPy references
+store_reference = False
+
+# engines to benchmark: 'numpy' for the NumPy GridEngine, 'gridfd3' and 'fd3' for the compiled executables
+engines = ['numpy', 'gridfd3', 'fd3']
+
+# tolerances of the checks: relative on chisq, absolute on the component spectra (continuum 1) and the anomalies (rad)
+chisq_rtol = 1e-6
+components_atol = 1e-4
+kepler_atol = 1e-10
+
+# synthetic binary: p, t0, e, omega (deg), K1, K2
+orbit = (1000., 100., 0.5, 40., 30., 50.)
+
+# cases: number of spectra, ln(lambda) bins, third component, grid points along K1 and K2, K step (km/s), and whether
+# the outputs are checked against the reference. Only the small cases are checked, the others are timed
+cases = dict()
+cases['small'] = dict(spectra=20, bins=2000, tl=False, grid=21, step=1., check=True)
+cases['thirdlight'] = dict(spectra=20, bins=2000, tl=True, grid=11, step=1., check=True)
+cases['many spectra'] = dict(spectra=500, bins=1000, tl=False, grid=5, step=1., check=False)
+cases['wide'] = dict(spectra=20, bins=100000, tl=False, grid=3, step=5., check=False)
+cases['large grid'] = dict(spectra=40, bins=500, tl=False, grid=200, step=0.25, check=False)
+
+# only run the checked cases
+quick = False
+
+# cases rerun through the compiled engines with the window extended to a smooth FFT length (see Fd3class.smoothfft),
+# reporting the speed-up over the plain run. 'wide' has the bin count of a broad range fd3 run like 'range' in fd3.py
+smooth_fft_cases = ['wide']
+
+# number of (mean anomaly, eccentricity) pairs of the Kepler solver benchmark
+kepler_evals = 10 ** 6
+
+# modules whose import is timed in fresh interpreters, the number of interpreters per module, and the packages they
+# must not import, as every worker process and headless job pays for them
+startup_modules = ['modules.gridfd3classes', 'modules.gridengine', 'modules.propagation']
+startup_repeats = 5
+startup_forbidden = ['matplotlib', 'astropy', 'scipy']
+
+# memory benchmark: lines of spectra and bins each, of which every fresh interpreter draws the perturbed spectra of
+# some Monte Carlo iterations and writes their master files. The layouts are the flux type, whether the spectra on the
+# wide base of fd3 are held, and whether the perturbed spectra are drawn into reused buffers
+memory_lines = 8
+memory_spectra = 500
+memory_bins = 1200
+memory_iterations = 3
+memory_layouts = dict(eager=('float64', True, False), lean=('float32', False, True))
+
+############################################################
+# Here we start our actual runs
+
+starttime = time.time()
+workfolder = benchfolder + '/work'
+pathlib.Path(workfolder).mkdir(parents=True, exist_ok=True)
+fd3classes.TIMELINE.engine_counters = True
+outputs = dict()
+rows = list()
+failures = list()
+
+
+def check(key, value, rtol=0., atol=0.):
+    """
+    compares an output with its reference, or keeps it to be stored
+    :param key: name of the output in the reference file
+    :param value: the output
+    :param rtol: relative tolerance
+    :param atol: absolute tolerance
+    :return: 'ok', 'FAIL' or 'stored'
+    """
+    if store_reference:
+        outputs.setdefault(key, value)
+        return 'stored'
+    if key not in refs:
+        return 'no reference'
+    ref = refs[key]
+    if ref.shape != np.shape(value) or not np.allclose(value, ref, rtol=rtol, atol=atol):
+        failures.append(key)
+        diff = np.max(np.abs(value - ref)) if ref.shape == np.shape(value) else 'shape {}'.format(np.shape(value))
+        print(' {} differs from its reference: {} (max abs diff {})'.format(key, 'FAIL', diff))
+        return 'FAIL'
+    return 'ok'
+
+
+def counter_rates(counters, spectra, solves):
+    """
+    :param counters: engine counters of one run
+    :param spectra: number of spectra
+    :param solves: number of times the engine solved the orbit at all epochs
+    :return: the rates of the kernels, and the share of the fd3sep phases in the engine time
+    """
+    def per_second(evals, *keys):
+        seconds = sum(counters.get(key, 0) for key in keys)
+        return evals / seconds if seconds > 0 else float('nan')
+
+    total = counters.get('time_total', 0) or float('nan')
+    return 'dft_fwd {:.3g} spectra/s, triorb_rv {:.3g} rvs/s, fd3sep {:.3g} evals/s (assemble {:.0f}%, svd {:.0f}%, ' \
+           'chisq {:.0f}% of the engine time), {} svd truncations'.format(
+            per_second(spectra, 'time_dft_fwd'), per_second(spectra * solves, 'time_triorb_rv'),
+            per_second(counters.get('merit_evals', 0), 'time_assemble', 'time_svd', 'time_chi2'),
+            *(100 * counters.get(key, 0) / total for key in ('time_assemble', 'time_svd', 'time_chi2')),
+            counters.get('svd_truncations', 0))
+
+
+def last_counters(engine):
+    """
+    :param engine: name of the compiled engine
+    :return: counters of its last run, None if there were none
+    """
+    for _, _, _, counters in reversed(fd3classes.TIMELINE.counters):
+        if counters.get('engine') == engine:
+            return counters
+    return None
+
+
+def run_case(name, case):
+    """
+    runs one case through all engines
+    :param name: name of the case
+    :param case: dict of the case
+    """
+    fd3line, _ = synthetic.synthetic_line(
+        name.replace(' ', '_'), bins=case['bins'], spectra=case['spectra'], tl=case['tl'], orbit=orbit,
+        k1s=synthetic.k_range(orbit[4], case['grid'], case['step']),
+        k2s=synthetic.k_range(orbit[5], case['grid'], case['step']))
+    points = case['grid'] ** 2
+    dims = '{:>5} {:>7} {:>2} {:>6}'.format(case['spectra'], len(fd3line.logbase), 3 if case['tl'] else 2, points)
+    for engine in engines:
+        if engine != 'numpy' and not os.path.isfile('./bin/' + engine):
+            rows.append('{:<14}{:<9}{} {:>10} {:>12}  {}'.format(name, engine, dims, '-', '-', 'not built'))
+            continue
+        now = time.perf_counter()
+        if engine == 'fd3':
+            fd3line.run_fd3(workfolder)
+            evals = 1
+            comps = np.loadtxt(workfolder + '/products{}.mod'.format(repr(fd3line)))[:, 1:].T
+        else:
+            fd3line.engine = engine
+            evals = points
+            cchisq = fd3line.chisq_grid(orbit[:4], workfolder)
+        elapsed = time.perf_counter() - now
+        status = ''
+        if case['check']:
+            if engine == 'fd3':
+                status = check(name + ' components', comps, atol=components_atol)
+            else:
+                status = check(name + ' chisq', cchisq, rtol=chisq_rtol)
+        rows.append('{:<14}{:<9}{} {:>10.4g} {:>12.4g}  {}'.format(name, engine, dims, elapsed, evals / elapsed,
+                                                                  status))
+        counters = last_counters(engine) if engine != 'numpy' else None
+        if counters is not None:
+            rows.append('{:>14}{}'.format('', counter_rates(counters, case['spectra'],
+                                                            counters.get('merit_evals', 0) if engine == 'fd3' else 1)))
+        if engine != 'numpy' and name in smooth_fft_cases:
+            run_smooth_fft(name, fd3line, engine, dims, elapsed, counters)
+    # the component spectra of the NumPy engine at the true semi-amplitudes, on the range fd3 disentangles
+    if 'numpy' in engines:
+        engine = gridengine.GridEngine(fd3line.widelogbase, fd3line.widedata, fd3line.noises, fd3line.mjds,
+                                       fd3line.lfs, fd3line.wideloglimits, fd3line.tl)
+        now = time.perf_counter()
+        comps = engine.components(orbit[4], orbit[5], orbit[:4])
+        elapsed = time.perf_counter() - now
+        status = check(name + ' components', comps, atol=components_atol) if case['check'] else ''
+        rows.append('{:<14}{:<9}{:>5} {:>7} {:>2} {:>6} {:>10.4g} {:>12.4g}  {}'.format(
+            name, 'numpy', case['spectra'], engine.N, engine.K, 'comps', elapsed, 1 / elapsed, status))
+
+
+def run_smooth_fft(name, fd3line, engine, dims, plain, counters):
+    """
+    reruns a case through a compiled engine with the window extended to a smooth FFT length, and reports the speed-up
+    over the plain run
+    :param name: name of the case
+    :param fd3line: the synthetic line of the case
+    :param engine: name of the compiled engine
+    :param dims: the dimension columns of the case
+    :param plain: time of the plain run (s)
+    :param counters: engine counters of the plain run
+    """
+    fd3line.smoothfft = True
+    now = time.perf_counter()
+    if engine == 'fd3':
+        fd3line.run_fd3(workfolder)
+    else:
+        fd3line.chisq_grid(orbit[:4], workfolder)
+    elapsed = time.perf_counter() - now
+    fd3line.smoothfft = False
+    smooth = last_counters(engine)
+    dft = float('nan')
+    if counters is not None and smooth is not None and smooth.get('time_dft_fwd', 0) > 0:
+        dft = counters.get('time_dft_fwd', 0) / smooth['time_dft_fwd']
+    rows.append('{:<14}{:<9}{} {:>10.4g} {:>12}  speed-up {:.3g}x, dft_fwd {:.3g}x'.format(
+        name + ' smooth', engine, dims, elapsed, '-', plain / elapsed, dft))
+
+
+def run_kepler():
+    """
+    times the vectorized Kepler solver, and checks a fixed set of anomalies
+    """
+    rng = np.random.default_rng(0)
+    mus = rng.uniform(0, 2 * np.pi, kepler_evals)
+    es = rng.uniform(0, 0.95, kepler_evals)
+    now = time.perf_counter()
+    kepler.ecc_anom(mus, es)
+    elapsed = time.perf_counter() - now
+    grid = np.linspace(0, 2 * np.pi, 25)[:, None]
+    status = check('kepler ecc_anom', kepler.ecc_anom(grid, np.array([0., 0.3, 0.6, 0.9, 0.99])), atol=kepler_atol)
+    rows.append('{:<14}{:<9}{:>23} {:>10.4g} {:>12.4g}  {}'.format('kepler', 'numpy', kepler_evals, elapsed,
+                                                                   kepler_evals / elapsed, status))
+
+
+def run_propagation():
+    """
+    checks that the best fit of the linear propagation is deterministic on a line that perturbs its spectra, as its
+    finite differences are otherwise dominated by the spectral noise, and that it handles a Delta gamma range
+    """
+    fd3line, _ = synthetic.synthetic_line('propagation', bins=500, spectra=20, orbit=orbit,
+                                          k1s=synthetic.k_range(orbit[4], 11, 1.),
+                                          k2s=synthetic.k_range(orbit[5], 11, 1.))
+    fd3line.ps = True
+    now = time.perf_counter()
+    fits = [propagation.best_fit([fd3line], orbit[:4], workfolder) for _ in range(2)]
+    elapsed = time.perf_counter() - now
+    # a single Delta gamma of 0 gives the same grid as no Delta gamma range
+    fd3line.dgs = '0 0 1'
+    cubefit = propagation.best_fit([fd3line], orbit[:4], workfolder)
+    status = 'ok'
+    if not np.array_equal(*fits):
+        failures.append('propagation best_fit')
+        status = 'FAIL, best fits {} and {}'.format(*fits)
+    elif not np.array_equal(fits[0], cubefit):
+        failures.append('propagation best_fit dgs')
+        status = 'FAIL, best fit {} with Delta gamma range'.format(cubefit)
+    rows.append('{:<14}{:<9}{:>23} {:>10.4g} {:>12.4g}  {}'.format('propagation', 'numpy', 2, elapsed, 2 / elapsed,
+                                                                   status))
+
+
+def run_startup():
+    """
+    times the import of the startup modules in fresh interpreters, and checks they do not import the forbidden packages
+    """
+    script = 'import sys, time\nt = time.perf_counter()\nimport {}\nprint(time.perf_counter() - t)\n' \
+             'print(" ".join(m for m in {} if m in sys.modules))'
+    for module in startup_modules:
+        times = list()
+        for _ in range(startup_repeats):
+            now = time.perf_counter()
+            out = sp.run([sys.executable, '-c', script.format(module, startup_forbidden)], capture_output=True,
+                         text=True, check=True).stdout.split('\n')
+            times.append((float(out[0]), time.perf_counter() - now))
+        imported = out[1].split()
+        status = 'ok'
+        if imported:
+            failures.append('startup ' + module)
+            status = 'FAIL, imports {}'.format(', '.join(imported))
+        # the fastest run is the least disturbed by the rest of the system
+        importtime, walltime = min(times)
+        rows.append('{:<14}{:<32} {:>10.4g} {:>12}  {} (interpreter {:.3g}s)'.format(
+            'startup', module, importtime, '-', status, walltime))
+
+
+def run_memory():
+    """
+    reports the peak resident memory of the memory benchmark in every layout
+    """
+    script = 'import resource, numpy as np\nimport modules.synthetic as synthetic\n' \
+             'lines = [synthetic.synthetic_line("line" + str(i), {bins}, {spectra}, seed=i, dtype=np.{dtype}, ' \
+             'wide={wide})[0] for i in range({lines})]\n' \
+             'buffers = dict() if {reuse} else None\n' \
+             'for ii in range({iterations}):\n' \
+             '    for line in lines:\n' \
+             '        line.ps = True\n' \
+             '        data = line._iteration_data(ii + 1, None, None if buffers is None else buffers.get(repr(line)))\n' \
+             '        if buffers is not None:\n' \
+             '            buffers[repr(line)] = data\n' \
+             '        for chunk in line._grid_master_chunks(data):\n' \
+             '            pass\n' \
+             'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n' \
+             'print(sum(line.data.nbytes + (0 if line.widedata is None else line.widedata.nbytes) for line in lines))'
+    # ru_maxrss is in kB, except on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    for layout, (dtype, wide, reuse) in memory_layouts.items():
+        out = sp.run([sys.executable, '-c', script.format(bins=memory_bins, spectra=memory_spectra, dtype=dtype,
+                                                          wide=wide, lines=memory_lines, reuse=reuse,
+                                                          iterations=memory_iterations)],
+                     capture_output=True, text=True, check=True).stdout.split('\n')
+        rows.append('{:<14}{:<32} {:>10} {:>12}  peak RSS {:.1f} MB, of which spectra {:.1f} MB'.format(
+            'memory', '{} {} x {}'.format(layout, memory_lines, memory_spectra), '-', '-',
+            int(out[0]) * unit / 2 ** 20, int(out[1]) / 2 ** 20))
+
+
+refs = dict()
+if not store_reference:
+    if os.path.isfile(reference):
+        with np.load(reference) as npz:
+            refs = dict(npz)
+    else:
+        print('no reference outputs in {}, only timing'.format(reference))
+
+print('benchmarking on synthetic spectra')
+run_startup()
+run_memory()
+run_kepler()
+run_propagation()
+for casename in cases:
+    if quick and not cases[casename]['check']:
+        continue
+    print(' case {}'.format(casename))
+    run_case(casename, cases[casename])
+
+header = '{:<14}{:<9}{:>5} {:>7} {:>2} {:>6} {:>10} {:>12}  {}'.format('case', 'engine', 'M', 'N', 'K', 'points',
+                                                                       'time (s)', 'evals/s', 'check')
+report = '\n'.join([header] + rows)
+print(report)
+with open(benchfolder + '/benchmark.txt', 'w') as f:
+    f.write(report + '\n')
+if store_reference:
+    np.savez(reference, **outputs)
+    print('stored {} reference outputs in {}'.format(len(outputs), reference))
+print('benchmark took {}s'.format(time.time() - starttime))
+if failures:
+    print('{} outputs differ from their reference: {}'.format(len(failures), ', '.join(failures)))
+    exit(1)
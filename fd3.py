@@ -9,6 +9,7 @@ import pathlib
 import time
 import matplotlib.pyplot as plt
 import modules.gridfd3classes as fd3classes
+import modules.orbitfit as orbitfit
 
 # input
 # define working directories
@@ -32,6 +33,10 @@ except IndexError:
 
 # geometrical orbit elements and its error. error is ignored if not monte_carlo
 orbit = (3251, 56547, 0.648, 30.9, 31.0, 52.0)  # p, t0, e, omega(A), K1, K2
+# optimize the orbit first with this many parallel simplex starts, spread over orbit +- orbit_steps. Parameters with a
+# step of 0 are kept fixed. 0 separates at the given orbit
+optimize_starts = 0
+orbit_steps = (0, 0, 0, 0, 2.0, 2.0)
 
 # lightfactors of your components (if thirdlight, give three)
 lfs = [0.57, 0.43]
@@ -44,6 +49,20 @@ sampling = 0.03
 # enter wavelength range(s) in natural log of wavelength and give name of line. Must be a dict.
 lines = dict()
 lines['range'] = (4010, 6800)
+
+# split wide ranges in overlapping ln(lambda) windows of at most window_bins bins, sharing window_overlap bins,
+# that are disentangled in parallel and stitched. False (default) runs a single fd3 on the whole range
+windowed = False
+window_bins = 8000
+window_overlap = 400
+
+# extend every window to a length the FFT of fd3 factorizes well, tapered over the edge points, instead of
+# transforming the length the ln(lambda) range happens to give, which can be a large prime
+smooth_fft = False
+
+# run the compiled engines with their performance counters on (merit evaluations, svd truncations and the time spent
+# in every phase), collected in the timeline summary and trace
+engine_counters = False
 ############################################################
 
 
@@ -92,26 +111,42 @@ with open(fd3folder + "/params.txt", 'w') as paramfile:
     paramfile.write('lightfactors\t' + str(lfs) + '\n')
     paramfile.write('sampling\t' + str(sampling) + '\n')
     paramfile.write('spectra\t' + str(spectra_set) + '\n')
+    paramfile.write('windowed\t' + str(windowed) + '\n')
+    paramfile.write('smooth_fft\t' + str(smooth_fft) + '\n')
 
+fd3classes.TIMELINE.engine_counters = engine_counters
 fd3lineobjects = list()
 print('building fd3gridline object for:')
 for line in lines.keys():
     print(' {}'.format(line))
     fd3lineobjects.append(
-        fd3classes.Fd3class(line, lines[line], sampling, allfiles, thirdlight, orbit, lfs=lfs))
+        fd3classes.Fd3class(line, lines[line], sampling, allfiles, thirdlight, orbit, lfs=lfs, smoothfft=smooth_fft))
 
 d3threads = list()
 setuptime = time.time()
 print('setup took {}s\n'.format(setuptime - starttime))
 print('starting runs!')
 now = time.time()
+if optimize_starts:
+    for line in fd3lineobjects:
+        line._set_spectra()
+    orbit, _, _, _ = orbitfit.multistart_simplex(fd3lineobjects, orbit, orbit_steps, optimize_starts)
+    orbit = tuple(orbit)
+    for line in fd3lineobjects:
+        line.orb = orbit
 for line in fd3lineobjects:
-    line.run_fd3(fd3folder)
+    if windowed:
+        line.run_fd3_windowed(fd3folder, window_bins, window_overlap)
+    else:
+        line.run_fd3(fd3folder)
 for line in fd3lineobjects:
     # line.recombine_and_renorm()
     plt.title('k2 = {}'.format(orbit[5]))
     line.plot_fd3_results(offset=0.0)
 
 
+# where the time went, per stage. The trace opens in chrome://tracing or ui.perfetto.dev
+print(fd3classes.TIMELINE.summary())
+fd3classes.TIMELINE.export_chrome(fd3folder + '/trace.json')
 print('Thanks for your patience! You waited a whopping {} hours!'.format((time.time() - starttime) / 3600))
 plt.show()
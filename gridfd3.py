@@ -10,6 +10,8 @@ import os
 import pathlib
 import time
 
+import modules.asyncrunner as asyncrunner
+import modules.chisqcache as chisqcache
 import modules.gridfd3classes as fd3classes
 
 
@@ -38,6 +40,9 @@ orbit = (3261, 56547, 0.648, 30.8, -5)  # p, t0, e, omega(A), Delta\gamma
 # K1 and K2 ranges to be explored, in string form: 'left right step', all in km/s
 k1str = '15 45 1'
 k2str = '40 65 1'
+# optional Delta gamma range (km/s), the systemic velocity of B relative to A, in the same form. If given, every line
+# gets a K1 x K2 x Delta gamma chisq cube in one run; if None, the Delta gamma of the orbit is used
+dgstr = None
 
 # light factors of your components (if thirdlight, give three)
 lfs = [0.57, 0.43]
@@ -65,6 +70,34 @@ back = False
 # do you want a (static) third component to be found?
 thirdlight = False
 
+# engine evaluating the grid: 'gridfd3' for the compiled executable, 'numpy' for the pure NumPy engine
+engine = 'gridfd3'
+
+# co-add spectra whose predicted rvs of both components differ less than this (km/s), e.g. exposures taken within
+# minutes of each other. None uses every spectrum separately
+bintol = None
+# and only if they were taken within this many days of each other, None for a hundredth of the period
+bingap = None
+
+# cache of the chisq grid nodes of every line, shared by all runs: lines and orbits that did not change are served from
+# it, and a widened K range only evaluates the new nodes. The least recently used entries are removed beyond
+# cache_maxbytes. None (default) disables it, e.g. 'chisqcache' to keep it in the working directory
+cachefolder = None
+cache_maxbytes = 2 ** 30
+
+# run the compiled engines with their performance counters on (merit evaluations, svd truncations and the time spent
+# in every phase), collected in the timeline summary and trace
+engine_counters = False
+
+# run the lines from one event loop instead of a thread each, with the input of the compiled engines streamed through
+# pipes and their output parsed as it arrives. At most async_concurrency engines run at once, None for one per cpu
+asynchronous = False
+async_concurrency = None
+
+# let gridfd3 extend the window to a length its FFT factorizes well, tapered over the edge points. This changes the
+# chisqs slightly, but avoids the slow transform of e.g. a large prime number of bins
+smooth_fft = False
+
 # sampling of your spectra in angstrom
 sampling = 0.03
 
@@ -176,18 +209,27 @@ with open(gridfd3folder + "/params.txt", 'w') as paramfile:
     paramfile.write('sampling\t' + str(sampling) + '\n')
     paramfile.write('k1s\t' + k1str + '\n')
     paramfile.write('k2s\t' + k2str + '\n')
+    paramfile.write('dgs\t' + str(dgstr) + '\n')
+    paramfile.write('engine\t' + engine + '\n')
+    paramfile.write('bintol\t' + str(bintol) + '\n')
+    paramfile.write('bingap\t' + str(bingap) + '\n')
+    paramfile.write('smooth_fft\t' + str(smooth_fft) + '\n')
     paramfile.write('spectra\t' + str(spectra_set) + '\n')
     paramfile.write('lines used:\n')
     for line, bounds in lines.items():
         paramfile.write(str(line) + ' ' + str(bounds) + '\n')
 
 # build the line objects
+fd3classes.TIMELINE.engine_counters = engine_counters
+cache = None if cachefolder is None else chisqcache.ChisqCache(cachefolder, cache_maxbytes)
 fd3lineobjects = list()
 print('building fd3gridline object for:')
 for line in lines.keys():
     print(' {}'.format(line))
     fd3lineobjects.append(
-        fd3classes.Fd3class(line, lines[line], sampling, allfiles, thirdlight, orbit, lfs=lfs, k1s=k1str, k2s=k2str))
+        fd3classes.Fd3class(line, lines[line], sampling, allfiles, thirdlight, orbit, lfs=lfs, k1s=k1str, k2s=k2str,
+                            engine=engine, dgs=dgstr, bintol=bintol, bingap=bingap, cache=cache,
+                            smoothfft=smooth_fft))
 
 # build the threads
 print('building threads')
@@ -215,7 +257,10 @@ print('starting runs!')
 i = 0
 now = time.time()
 # run gridfd3
-run_join_threads(gridthreads)
+if asynchronous:
+    asyncrunner.AsyncRunner(async_concurrency).run_grids(fd3lineobjects, gridfd3folder)
+else:
+    run_join_threads(gridthreads)
 print('run {} done in {}h'.format(i + 1, (time.time() - now) / 3600))
 # mink1, mink2 = oa.get_min_of_run(gridfd3folder)
 # print('minimum of the last run_fd3 is', mink1, mink2)
@@ -232,4 +277,7 @@ print('run {} done in {}h'.format(i + 1, (time.time() - now) / 3600))
 # i += 1
 # # reset thread lists with fresh threads
 # new_threads()
+# where the time went, per stage. The trace opens in chrome://tracing or ui.perfetto.dev
+print(fd3classes.TIMELINE.summary())
+fd3classes.TIMELINE.export_chrome(gridfd3folder + '/trace.json')
 print('Thanks for your patience! You waited a whopping {} hours!'.format((time.time() - starttime) / 3600))
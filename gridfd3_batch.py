@@ -0,0 +1,44 @@
+"""
+User script running the grids and Monte Carlo runs of many targets in one go, as described in a batch config (see
+modules/batch.py and batch_example.json). All (target, line, iteration) tasks share one pool of engines and every
+spectrum file is read only once. Every target gets the folder layout of gridfd3.py, or of gridfd3_renorm_MC.py if it
+runs a Monte Carlo.
+"""
+
+import time
+
+import modules.batch as batch
+import modules.gridfd3classes as fd3classes
+
+# input
+# the batch config, and the file the timeline trace of all targets is written to
+configfile = 'batch.json'
+tracefile = 'batch_trace.json'
+
+# maximal number of engines running at once, None for one per cpu
+concurrency = None
+
+# maximal number of spectrum files kept in memory, None to keep every file that was read
+spectra_maxfiles = None
+
+# run the compiled engines with their performance counters on, collected in the timeline summary and trace
+engine_counters = False
+
+############################################################
+# Here we start our actual runs
+
+starttime = time.time()
+fd3classes.TIMELINE.engine_counters = engine_counters
+targets = batch.load_batch(configfile, spectra_maxfiles)
+print('batch of {} targets:'.format(len(targets)))
+for target in targets:
+    print(' {}'.format(repr(target)))
+results = batch.run_batch(targets, concurrency)
+failed = sum(isinstance(result, BaseException) for result in results)
+if failed:
+    print('{} of {} tasks failed'.format(failed, len(results)))
+print(repr(targets[0].fd3lines[0].spectra_cache))
+# where the time went, per stage. The trace opens in chrome://tracing or ui.perfetto.dev
+print(fd3classes.TIMELINE.summary())
+fd3classes.TIMELINE.export_chrome(tracefile)
+print('Thanks for your patience! You waited a whopping {} hours!'.format((time.time() - starttime) / 3600))
@@ -10,7 +10,13 @@ import time
 
 import numpy as np
 
+import modules.asyncrunner as asyncrunner
 import modules.gridfd3classes as fd3classes
+import modules.chisqstore as chisqstore
+import modules.convergence as convergence
+import modules.emulator as emulator
+import modules.propagation as propagation
+import modules.sampler as sampler
 
 # input
 
@@ -61,10 +67,48 @@ monte_carlo = True
 N = 1000
 perturb_orbit = True
 perturb_spectra = True
+# seed of the orbit and spectrum perturbations, None draws a fresh one. The seed used is written to params.txt
+seed = None
+# stop early once the 15.8% and 84.2% quantiles of K1 and K2 change less than this (km/s) between checks, e.g. 0.5.
+# None (default) runs all N iterations
+converge_tol = None
+# with only perturb_orbit, emulate the chisq grids of all draws from a response surface fitted to a few exact runs
+# around the nominal orbit, and rerun emulate_verify draws exactly to check it
+emulate = False
+emulate_verify = 20
+# instead of the Monte Carlo, propagate the orbit errors linearly into K1 and K2 from finite differences of the best
+# fit (9 grid runs), and compare to a Monte Carlo of propagate_mc draws (0 to skip)
+propagate = False
+propagate_mc = 20
+# instead of the grid and Monte Carlo, sample the posterior of K1, K2 and the orbit with an ensemble MCMC, using the
+# merit function of all lines as likelihood and the orbit errors as prior. The samples after mcmc_burn steps are saved
+# in the files monte_carlo_analyser writes, for MC_combiner
+mcmc = False
+mcmc_walkers = 32
+mcmc_steps = 1000
+mcmc_burn = 200
 
 # do you want a (static) third component to be found?
 thirdlight = False
 
+# engine evaluating the grid: 'gridfd3' for the compiled executable, 'numpy' for the pure NumPy engine
+engine = 'gridfd3'
+
+# co-add spectra whose predicted rvs of both components differ less than this (km/s), e.g. exposures taken within
+# minutes of each other. None uses every spectrum separately
+bintol = None
+# and only if they were taken within this many days of each other, None for a hundredth of the period
+bingap = None
+
+# run the compiled engines with their performance counters on (merit evaluations, svd truncations and the time spent
+# in every phase), collected in the timeline summary and trace
+engine_counters = False
+
+# run the lines and iterations from one event loop instead of threads with their own working directories, with the
+# input of the compiled engines streamed through pipes and their output parsed as it arrives. At most cpus engines run
+# at once
+asynchronous = False
+
 # lightfactors of your components (if thirdlight, give three)
 lfs = [0.6173, 0.3827]
 
@@ -154,12 +198,16 @@ with open(gridfd3folder + "/params.txt", 'w') as paramfile:
     paramfile.write('sampling\t' + str(sampling) + '\n')
     paramfile.write('k1s\t' + k1str + '\n')
     paramfile.write('k2s\t' + k2str + '\n')
+    paramfile.write('engine\t' + engine + '\n')
+    paramfile.write('bintol\t' + str(bintol) + '\n')
+    paramfile.write('bingap\t' + str(bingap) + '\n')
     paramfile.write('spectra\t' + str(spectra_set) + '\n')
     paramfile.write('perturb orbit\t' + str(perturb_orbit) + '\n')
     paramfile.write('perturb spectra\t' + str(perturb_spectra) + '\n')
     paramfile.write('covar matrix\t' + str(orbit_covar_scale) + '\n')
 
 # build gridfd3line objects
+fd3classes.TIMELINE.engine_counters = engine_counters
 fd3lineobjects = list()
 print('building fd3gridline object for:')
 for line in lines.keys():
@@ -167,7 +215,8 @@ for line in lines.keys():
     fd3lineobjects.append(
         fd3classes.Fd3class(line, lines[line], sampling, allfiles, thirdlight, orbit,
                             orbit_err, orbcovar=orbit_covar_scale, po=perturb_orbit,
-                            ps=perturb_spectra, lfs=lfs, k1s=k1str, k2s=k2str))
+                            ps=perturb_spectra, lfs=lfs, k1s=k1str, k2s=k2str, engine=engine, bintol=bintol,
+                            bingap=bingap))
 
 # build threads around the lines
 print('building threads')
@@ -180,27 +229,78 @@ for fd3line in fd3lineobjects:
     d3threads.append(fd3classes.Fd3Thread(fd3folder, fd3line))
 
 # do an initial separation to renormalize on, we still consider this
-run_join_threads(d3threads)
+if asynchronous:
+    asyncrunner.AsyncRunner(cpus).run_fd3s(fd3lineobjects, fd3folder)
+else:
+    run_join_threads(d3threads)
 # recombine_and_renorm
 print('renormalizing')
 for fd3line in fd3lineobjects:
     fd3line.recombine_and_renorm()
 
-if monte_carlo:
+if emulate and not (monte_carlo and perturb_orbit and not perturb_spectra and not (propagate or mcmc)):
+    print('emulate needs a Monte Carlo with perturb_orbit only (no perturb_spectra, propagate or mcmc), ignoring it')
+if monte_carlo and not (propagate or mcmc):
     # create threads
     print('number of threads will be {}'.format(cpus))
     print('each thread will have {} iterations to complete'.format(N / cpus))
     atleast = int(N / cpus)
     remainder = int(N % cpus)
 
-    for i in range(remainder):
-        gridthreads.append(fd3classes.GridFd3MCThread(gridfd3folder, i + 1, atleast + 1, fd3lineobjects))
-    for i in range(remainder, cpus):
-        gridthreads.append(fd3classes.GridFd3MCThread(gridfd3folder, i + 1, atleast, fd3lineobjects))
+    # all threads write their chisq grids to one store instead of separate npz files
+    storelines = [repr(fd3line) for fd3line in fd3lineobjects if fd3line.no_used_spectra > 0]
+    # draw all orbit realizations at once, every line of an iteration uses the same one
+    orbits = None
+    if perturb_orbit:
+        orbits, seed = fd3classes.perturbed_orbits(orbit, N, orbit_err, orbit_covar_scale, seed)
+    else:
+        seed = np.random.SeedSequence(seed).entropy
+    with open(gridfd3folder + "/params.txt", 'a') as paramfile:
+        paramfile.write('seed\t' + str(seed) + '\n')
+    # the spectrum perturbations of every iteration and line are drawn from the same seed, so the run is reproducible
+    store = chisqstore.ChisqStore.create(gridfd3folder + '/chisqstore', N, storelines, k1str, k2str, orbits, seed)
+    emulating = emulate and perturb_orbit and not perturb_spectra
+    # the monitor keeps a live summary of the minima and signals the threads once they have converged
+    monitor = convergence.ConvergenceMonitor(store, gridfd3folder + '/convergence.txt', tol=converge_tol)
+    first = 0
+    for i in range(0 if emulating or asynchronous else cpus):
+        iterations = atleast + 1 if i < remainder else atleast
+        gridthreads.append(fd3classes.GridFd3MCThread(gridfd3folder, i + 1, iterations, fd3lineobjects, store, first,
+                                                      monitor.stop))
+        first += iterations
 
 setuptime = time.time()
 print('setup took {}s\n'.format(setuptime - starttime))
 # start the MC gridfd3 process
 print('starting runs!')
-run_join_threads(gridthreads)
+if mcmc:
+    mcmcsampler = sampler.sample_posterior(fd3lineobjects, orbit, orbit_covar_scale, orbit_err, mcmc_walkers, mcmc_steps,
+                                           cpus, seed)
+    sampler.save_samples(gridfd3folder, mcmcsampler.samples(mcmc_burn))
+elif monte_carlo and propagate:
+    pathlib.Path(gridfd3folder + '/propagation').mkdir(exist_ok=True)
+    best, jac, kcovar, mccovar = propagation.delta_method(fd3lineobjects, orbit, gridfd3folder + '/propagation',
+                                                          orbit_covar_scale, orbit_err, mc=propagate_mc, seed=seed)
+    with open(gridfd3folder + '/propagation.txt', 'w') as f:
+        f.write('k1 k2\t{} {}\n'.format(*best))
+        f.write('jacobian\t{}\n'.format(jac.tolist()))
+        f.write('propagated covar\t{}\n'.format(kcovar.tolist()))
+        f.write('mc covar\t{}\n'.format(None if mccovar is None else mccovar.tolist()))
+elif monte_carlo and emulating:
+    pathlib.Path(gridfd3folder + '/emulator').mkdir(exist_ok=True)
+    emulator.emulate_mc(fd3lineobjects, store, orbit, gridfd3folder + '/emulator', orbit_covar_scale, orbit_err,
+                        emulate_verify, seed)
+    monitor.update(final=True)
+else:
+    if monte_carlo:
+        monitor.start()
+    if monte_carlo and asynchronous:
+        asyncrunner.AsyncRunner(cpus).run_monte_carlo(fd3lineobjects, store, N, stop=monitor.stop)
+    else:
+        run_join_threads(gridthreads)
+    if monte_carlo:
+        monitor.finish()
+# where the time went, per stage. The trace opens in chrome://tracing or ui.perfetto.dev
+print(fd3classes.TIMELINE.summary())
+fd3classes.TIMELINE.export_chrome(gridfd3folder + '/trace.json')
 print('Thanks for your patience! You waited a whopping {} hours!'.format((time.time() - starttime) / 3600))
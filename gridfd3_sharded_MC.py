@@ -0,0 +1,93 @@
+"""
+User script running the Monte Carlo of one target of a batch config (see modules/batch.py) sharded over worker
+processes, on this node or on several nodes that share the shard folder. Run it without arguments to be the
+coordinator: it plans the shards, starts local_workers workers on this node, waits until all shards are finished and
+merges them into the chisqstore of the target, which is identical to that of a single node run. Workers on other nodes
+are started with 'python gridfd3_sharded_MC.py worker' from the same directory, and 'python gridfd3_sharded_MC.py merge'
+merges the shards finished so far.
+"""
+
+import subprocess as sp
+import sys
+import time
+
+import numpy as np
+
+import modules.asyncrunner as asyncrunner
+import modules.batch as batch
+import modules.chisqstore as chisqstore
+import modules.convergence as convergence
+import modules.gridfd3classes as fd3classes
+import modules.shards as shards
+
+# input
+# the batch config and the Monte Carlo target in it
+configfile = 'batch.json'
+targetname = '9_Sgr_MC'
+
+# iterations per shard, and the shard folder on a filesystem all workers share (None for 'shards' in the target folder)
+shard_size = 50
+shardfolder = None
+
+# number of worker processes the coordinator starts on this node, and the number of engines each of them runs at once
+# (None for one per cpu)
+local_workers = 2
+concurrency = 1
+
+# claims of shards not renewed for this long (s) are put back in the queue, as their worker is considered dead
+claim_timeout = 3600
+
+# after the merge, rerun the whole Monte Carlo in the coordinator and check the merged store is identical to it
+verify = False
+
+# coordinator, worker or merge, from the command line
+role = sys.argv[1] if len(sys.argv) > 1 else 'coordinator'
+
+############################################################
+# Here we start our actual runs
+
+starttime = time.time()
+target = [t for t in batch.load_batch(configfile) if t.name == targetname][0]
+if not target.N:
+    print('target {} has no Monte Carlo iterations'.format(targetname))
+    exit(1)
+if shardfolder is None:
+    shardfolder = target.folder + '/shards'
+storefolder = target.folder + '/chisqstore'
+
+if role == 'worker':
+    shards.work(shardfolder, target.fd3lines, concurrency=concurrency)
+    exit()
+
+if role == 'coordinator':
+    target.prepare()
+    asyncrunner.AsyncRunner(concurrency).load(target.fd3lines)
+    lines, orbits, seed = target.montecarlo_plan()
+    queue = shards.plan(shardfolder, target.N, lines, target.settings['k1s'], target.settings['k2s'], orbits, seed,
+                        shard_size, target.settings['dgs'])
+    print('planned {} iterations of {} in {}'.format(target.N, targetname, repr(queue)))
+    workers = [sp.Popen([sys.executable, __file__, 'worker']) for _ in range(local_workers)]
+    # wait for the local workers, and for the workers elsewhere as long as they hold claims
+    while any(worker.poll() is None for worker in workers) or queue.status()[1]:
+        time.sleep(5)
+        if queue.requeue(claim_timeout):
+            print('put shards of unresponsive workers back in the queue')
+    todo, _, done = queue.status()
+    print('{} shards finished, {} left'.format(done, todo))
+
+store = shards.merge(shardfolder, storefolder)
+# the summary of the minima, as the ConvergenceMonitor of gridfd3_renorm_MC.py writes it
+convergence.ConvergenceMonitor(store, target.folder + '/convergence.txt').update(final=True)
+
+if role == 'coordinator' and verify:
+    print('verifying against a single node run')
+    plan = shards.load_plan(shardfolder)
+    single = chisqstore.ChisqStore.create(target.folder + '/verifystore', target.N, plan['lines'], plan['k1s'],
+                                          plan['k2s'], plan['orbits'], plan['seed'], dgs=plan['dgs'])
+    asyncrunner.AsyncRunner(concurrency).run_monte_carlo(target.fd3lines, single, target.N)
+    same = np.array_equal(single.chisq, store.chisq) and np.array_equal(single.done, store.done)
+    print('merged store is {}identical to the single node run'.format('' if same else 'NOT '))
+    if not same:
+        exit(1)
+print(fd3classes.TIMELINE.summary())
+print('Thanks for your patience! You waited a whopping {} hours!'.format((time.time() - starttime) / 3600))
@@ -0,0 +1,318 @@
+"""
+Runs the engines of many lines and Monte Carlo iterations from one asyncio event loop, as an alternative to the
+GridFd3Thread, Fd3Thread and GridFd3MCThread threads. At most 'concurrency' engines run at once. The compiled engines
+get their in file and master file streamed through a pipe, and the gridfd3 output is parsed while it arrives, so no
+working directories per thread or intermediate files are needed.
+"""
+import asyncio
+import collections
+import io
+import os
+import time
+
+import numpy as np
+
+import modules.gridfd3classes as fd3classes
+import modules.timing as timing
+
+TIMELINE = fd3classes.TIMELINE
+
+
+class EngineError(RuntimeError):
+    """
+    raised when a compiled engine exits with an error
+    """
+    pass
+
+
+def _split_root(text):
+    # the first token names the master file; the engines read it before the master file itself
+    root, rest = text.split(' ', 1)
+    return root + '\n', ' ' + rest
+
+
+async def _feed(stdin, fd3line, head, chunks, rest):
+    """
+    writes the first token of the in file, the master file and the rest of the in file to the engine
+    :param stdin: stdin of the engine process
+    :param fd3line: Fd3class the input is of
+    :param head: first token of the in file
+    :param chunks: iterator over the text blocks of the master file
+    :param rest: the in file after its first token
+    """
+    try:
+        stdin.write(head.encode())
+        while True:
+            # formatting the master file is the expensive part, so it is done outside the event loop
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            stdin.write(chunk.encode())
+            await stdin.drain()
+        stdin.write(rest.encode())
+        await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # the engine quit early; its exit code tells why
+        print(' {}: engine stopped reading its input'.format(repr(fd3line)))
+    finally:
+        stdin.close()
+
+
+async def _spawn(executable, fd3line):
+    if TIMELINE.engine_counters:
+        return await asyncio.create_subprocess_exec(executable, stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                    env=fd3line._engine_env())
+    return await asyncio.create_subprocess_exec(executable, stdin=asyncio.subprocess.PIPE,
+                                                stdout=asyncio.subprocess.PIPE, env=fd3line._engine_env())
+
+
+async def _stderr(proc):
+    return (await proc.stderr.read()).decode() if proc.stderr is not None else ''
+
+
+async def _finish(proc, executable, fd3line, iteration, stderr, lastline):
+    """
+    waits for the engine to exit, records its counters and raises an EngineError if it failed
+    """
+    await proc.wait()
+    counters = timing.parse_perf_block(stderr)
+    if counters is not None:
+        TIMELINE.record_counters(counters, fd3line, iteration)
+    if proc.returncode != 0:
+        raise EngineError('{} failed for {} (iteration {}) with exit code {}: {}'.format(
+            executable, repr(fd3line), iteration, proc.returncode, lastline.strip() or stderr.strip()))
+
+
+async def stream_gridfd3(fd3line, params, iteration=None, executable='./bin/gridfd3', data=None):
+    """
+    runs gridfd3 on a line with its input streamed through stdin, and parses its grid as it is printed
+    :param fd3line: Fd3class with its spectra loaded
+    :param params: orbit p, t0, e, omega(, Delta gamma)
+    :param iteration: if an MCMC is running, which iteration are we doing
+    :param executable: the gridfd3 executable
+    :param data: spectra to use instead of those of the line, e.g. perturbed ones
+    :return: k1s, k2s, Delta gammas and chisq of all nodes, in the order gridfd3 prints them
+    """
+    infile = io.StringIO()
+    fd3line._write_gridfd3_infile(infile, 'stdin', params)
+    head, rest = _split_root(infile.getvalue())
+    proc = await _spawn(executable, fd3line)
+    rows = list()
+    lastline = ''
+
+    async def read():
+        nonlocal lastline
+        async for raw in proc.stdout:
+            try:
+                row = [float(num) for num in raw.split()]
+            except ValueError:
+                row = None
+            if row is None or len(row) != 4:
+                # the header, or an error message
+                lastline = raw.decode()
+                continue
+            rows.append(row)
+
+    _, _, stderr = await asyncio.gather(_feed(proc.stdin, fd3line, head, fd3line._grid_master_chunks(data), rest),
+                                        read(), _stderr(proc))
+    await _finish(proc, executable, fd3line, iteration, stderr, lastline)
+    grid = np.array(rows).reshape(-1, 4).T
+    return grid[0], grid[1], grid[2], grid[3]
+
+
+async def stream_fd3(fd3line, wd, executable='./bin/fd3'):
+    """
+    runs fd3 on a line with its input streamed through stdin. fd3 writes its products to wd
+    :param fd3line: Fd3class with its spectra loaded
+    :param wd: directory of the products
+    :param executable: the fd3 executable
+    """
+    infile = io.StringIO()
+    fd3line._write_fd3_infile(infile, 'stdin', wd)
+    head, rest = _split_root(infile.getvalue())
+    proc = await _spawn(executable, fd3line)
+    output = list()
+
+    async def read():
+        async for raw in proc.stdout:
+            output.append(raw.decode())
+
+    _, _, stderr = await asyncio.gather(_feed(proc.stdin, fd3line, head, fd3line._fd3_master_chunks(), rest),
+                                        read(), _stderr(proc))
+    await _finish(proc, executable, fd3line, None, stderr, output[-1] if output else '')
+
+
+class AsyncRunner:
+    """
+    Schedules the grid and fd3 runs of lines and iterations on one event loop, with at most 'concurrency' engines
+    (or NumPy grid evaluations, in worker threads) at once
+    """
+
+    def __init__(self, concurrency=None):
+        """
+        :param concurrency: maximal number of engines running at once, the number of cpus by default
+        """
+        self.concurrency = concurrency or os.cpu_count()
+        self.semaphore = None
+        # free buffers of perturbed spectra by line, so iterations reuse those of earlier ones
+        self.buffers = collections.defaultdict(list)
+
+    def __repr__(self):
+        return 'AsyncRunner of {} engines'.format(self.concurrency)
+
+    async def _evaluate(self, fd3line, params, iteration=None, data=None):
+        async with self.semaphore:
+            if fd3line.engine == 'numpy':
+                with TIMELINE.stage('numpy engine', fd3line, iteration):
+                    return await asyncio.to_thread(fd3line._run_grid_engine, params, data)
+            with TIMELINE.stage('stream gridfd3', fd3line, iteration):
+                return await stream_gridfd3(fd3line, params, iteration, data=data)
+
+    async def _grid(self, fd3line, params, iteration=None, verbose=True, data=None):
+        if fd3line.cache is None or fd3line.ps:
+            return await self._evaluate(fd3line, params, iteration, data)
+        key, nodes, cchisq, blocks = await asyncio.to_thread(fd3line._cache_plan, params, iteration, verbose)
+        grids = await asyncio.gather(*(self._evaluate(block, params, iteration) for _, block in blocks))
+        for (span, _), grid in zip(blocks, grids):
+            await asyncio.to_thread(fd3line._cache_fill, key, cchisq, span, grid, iteration)
+        return nodes + (cchisq.ravel(),)
+
+    async def _load(self, fd3lines):
+        async def load(fd3line):
+            if fd3line.data is None:
+                with TIMELINE.stage('load spectra', fd3line):
+                    await asyncio.to_thread(fd3line._set_spectra)
+
+        await asyncio.gather(*(load(fd3line) for fd3line in fd3lines))
+        return [fd3line for fd3line in fd3lines if fd3line.no_used_spectra > 0]
+
+    async def _run_gridfd3(self, fd3line, wd, iteration=None, store=None):
+        """
+        the asynchronous Fd3class.run_gridfd3 of a line with its spectra loaded
+        """
+        params = fd3line._iteration_orbit(iteration, store)
+        pool = self.buffers[id(fd3line)]
+        data = await asyncio.to_thread(fd3line._iteration_data, iteration, store, pool.pop() if pool else None)
+        try:
+            kk1s, kk2s, ddgs, cchisq = await self._grid(fd3line, params, iteration, not iteration, data)
+        finally:
+            if data is not None:
+                pool.append(data)
+        with TIMELINE.stage('save output', fd3line, iteration):
+            if store is None:
+                # the in file of the grid holds the dof for the analysis
+                fd3line._make_gridfd3_infile(wd, params)
+            await asyncio.to_thread(fd3line._save_gridfd3_output, wd, iteration, store, kk1s, kk2s, ddgs, cchisq)
+
+    async def _run_fd3(self, fd3line, wd):
+        # the wide spectra are read on first use, outside of the event loop
+        await asyncio.to_thread(getattr, fd3line, 'widedata')
+        async with self.semaphore:
+            print(' running fd3 for {}'.format(repr(fd3line)))
+            with TIMELINE.stage('stream fd3', fd3line):
+                await stream_fd3(fd3line, wd)
+        with TIMELINE.stage('handle fd3 output', fd3line):
+            await asyncio.to_thread(fd3line._handle_fd3_output, wd)
+
+    async def _run(self, coroutines):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                print(repr(result))
+        return results
+
+    async def _grids(self, fd3lines, wd):
+        fd3lines = await self._load(fd3lines)
+        return await self._run([self._run_gridfd3(fd3line, wd) for fd3line in fd3lines])
+
+    async def _fd3s(self, fd3lines, wd):
+        fd3lines = await self._load(fd3lines)
+        return await self._run([self._run_fd3(fd3line, wd) for fd3line in fd3lines])
+
+    async def _tasks(self, tasks, stop=None, done=None):
+        """
+        runs grid tasks, admitted in the order given. Only as many tasks as engines are admitted at once, which also
+        bounds the perturbed spectra held in memory
+        :param tasks: list of (Fd3class, wd, iteration, store) tasks
+        :param stop: optional threading.Event, no new tasks are started once it is set
+        :param done: optional function called with every task that completed
+        """
+        admit = asyncio.Semaphore(self.concurrency)
+
+        async def task(fd3line, wd, iteration, store):
+            async with admit:
+                if stop is not None and stop.is_set():
+                    return
+                await self._run_gridfd3(fd3line, wd, iteration, store)
+            if done is not None:
+                done((fd3line, wd, iteration, store))
+
+        return await self._run([task(*tt) for tt in tasks])
+
+    async def _monte_carlo(self, fd3lines, store, iterations, first=0, stop=None):
+        fd3lines = await self._load(fd3lines)
+        remaining = {ii: len(fd3lines) for ii in range(first + 1, first + iterations + 1)}
+        starttime = time.time()
+        completed = list()
+
+        def done(task):
+            iteration = task[2]
+            remaining[iteration] -= 1
+            if remaining[iteration] == 0:
+                completed.append(iteration)
+                print('iteration {} done, estimated time to completion: {}h'.format(
+                    iteration, (time.time() - starttime) / len(completed) * (iterations - len(completed)) / 3600))
+
+        # iterations are admitted in order, so the first ones complete first and the monitor sees them early
+        return await self._tasks([(fd3line, None, ii, store) for ii in remaining for fd3line in fd3lines], stop, done)
+
+    def load(self, fd3lines):
+        """
+        loads the spectra of all lines that have none yet, in parallel
+        :param fd3lines: list of Fd3class
+        :return: the lines that have spectral data
+        """
+        return asyncio.run(self._load(fd3lines))
+
+    def run_tasks(self, tasks, stop=None, done=None):
+        """
+        runs grid tasks of any lines, working directories and stores on the shared engines
+        :param tasks: list of (Fd3class with its spectra loaded, wd, iteration, store) tasks, in order of admission.
+        Tasks with a ChisqStore write to it, the others save their output in wd as run_gridfd3 does
+        :param stop: optional threading.Event, no new tasks are started once it is set
+        :param done: optional function called with every task that completed
+        :return: list of the exceptions of the failed tasks, None for the others
+        """
+        return asyncio.run(self._tasks(tasks, stop, done))
+
+    def run_grids(self, fd3lines, wd):
+        """
+        the grid of every line, saved to wd as GridFd3Thread does
+        :param fd3lines: list of Fd3class
+        :param wd: working directory of the results
+        :return: list of the exceptions of the failed lines, None for the others
+        """
+        return asyncio.run(self._grids(fd3lines, wd))
+
+    def run_fd3s(self, fd3lines, wd):
+        """
+        the fd3 separation of every line, with its products in wd as Fd3Thread does
+        :param fd3lines: list of Fd3class
+        :param wd: working directory of the products
+        :return: list of the exceptions of the failed lines, None for the others
+        """
+        return asyncio.run(self._fd3s(fd3lines, wd))
+
+    def run_monte_carlo(self, fd3lines, store, iterations, first=0, stop=None):
+        """
+        iterations first + 1 up to first + iterations of a Monte Carlo, written to a ChisqStore as they complete
+        :param fd3lines: list of Fd3class
+        :param store: ChisqStore of the Monte Carlo run
+        :param iterations: number of iterations
+        :param first: number of iterations before the first one of this run
+        :param stop: optional threading.Event, no new iterations are started once it is set
+        :return: list of the exceptions of the failed runs, None for the others
+        """
+        return asyncio.run(self._monte_carlo(fd3lines, store, iterations, first, stop))
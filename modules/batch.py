@@ -0,0 +1,222 @@
+"""
+Batch runs of many targets from one declarative JSON config, instead of a copy of gridfd3.py or gridfd3_renorm_MC.py
+per target. The grid or Monte Carlo tasks of all (target, line, iteration) share one AsyncRunner, and all lines share
+one SpectrumCache, so spectra used by several lines or targets are read once. Every target gets the folder layout of
+the single target scripts.
+
+The config holds 'defaults' for all targets, named 'linesets', and the 'targets' by name:
+{
+  "defaults": {"spectra_root": "/data/spectra", "sampling": 0.03, "lfs": [0.6, 0.4], "engine": "gridfd3"},
+  "linesets": {"balmer": {"Hdelta": [4085, 4120], "Hgamma": [4320, 4355]}},
+  "targets": {
+    "9_Sgr": {"folder": "9_Sgr/batch", "spectra": ["9_Sgr"], "orbit": [3261, 56547, 0.648, 30.8, -5],
+              "k1s": "15 45 1", "k2s": "40 65 1", "lines": "balmer"},
+    "HD_1": {"folder": "HD_1/mc", "spectra": ["HD_1"], "orbit": [10.5, 58000, 0.1, 80], "k1s": "50 90 1",
+             "k2s": "100 160 1", "lines": ["balmer"], "N": 500, "perturb_orbit": true, "orbit_err": [0.1, 1, 0.01, 5]}
+  }
+}
+The 'lines' of a target are the name of a line set, a list of names, or a dict of lines. Targets with N > 0 run a
+Monte Carlo of N iterations into a ChisqStore, the others a single grid. See SETTINGS for all settings.
+"""
+import glob
+import itertools
+import json
+import os
+import pathlib
+
+import numpy as np
+
+import modules.asyncrunner as asyncrunner
+import modules.chisqcache as chisqcache
+import modules.chisqstore as chisqstore
+import modules.convergence as convergence
+import modules.gridfd3classes as fd3classes
+import modules.spectra_manager as spec_man
+
+# the settings of a target and their defaults. The REQUIRED ones have no default
+REQUIRED = ('folder', 'spectra', 'orbit', 'k1s', 'k2s', 'lines')
+SETTINGS = dict(folder=None, spectra=None, orbit=None, k1s=None, k2s=None, lines=None, spectra_root='', dgs=None,
+                sampling=0.03, lfs=[0.5, 0.5], thirdlight=False, engine='gridfd3', bintol=None, bingap=None, N=0,
+                perturb_orbit=False, perturb_spectra=True, orbit_err=None, orbit_covar=None, seed=None)
+
+
+class ConfigError(Exception):
+    """
+    Exception when a batch config is not valid
+    """
+    pass
+
+
+class Target:
+    """
+    One target of a batch: its settings, its lines and, if it runs a Monte Carlo, its ChisqStore
+    """
+
+    def __init__(self, name, settings, linesets, spectra_cache=None, cache=None):
+        """
+        :param name: name of the target
+        :param settings: dict of the settings of the target, including the defaults
+        :param linesets: dict of the named line sets of the config
+        :param spectra_cache: SpectrumCache shared by all targets
+        :param cache: ChisqCache shared by all targets, used by the lines that do not perturb their spectra
+        """
+        unknown = set(settings) - set(SETTINGS)
+        if unknown:
+            raise ConfigError('target {} has unknown settings {}'.format(name, ', '.join(sorted(unknown))))
+        self.name = name
+        self.settings = dict(SETTINGS, **settings)
+        missing = [key for key in REQUIRED if self.settings[key] is None]
+        if missing:
+            raise ConfigError('target {} misses {}'.format(name, ', '.join(missing)))
+        self.folder = self.settings['folder']
+        self.N = self.settings['N']
+        self.lines = self._lines(linesets)
+        self.files = self._files()
+        self.store = None
+        s = self.settings
+        orberr = None if s['orbit_err'] is None else np.array([s['orbit_err']])
+        orbcovar = None if s['orbit_covar'] is None else np.array(s['orbit_covar'])
+        montecarlo = self.N > 0
+        self.fd3lines = [
+            fd3classes.Fd3class(line, bounds, s['sampling'], self.files, s['thirdlight'], tuple(s['orbit']), orberr,
+                                orbcovar=orbcovar, po=montecarlo and s['perturb_orbit'],
+                                ps=montecarlo and s['perturb_spectra'], lfs=s['lfs'], k1s=s['k1s'], k2s=s['k2s'],
+                                engine=s['engine'], dgs=s['dgs'], bintol=s['bintol'], bingap=s['bingap'],
+                                cache=cache, spectra_cache=spectra_cache)
+            for line, bounds in self.lines.items()]
+
+    def __repr__(self):
+        return 'Target {} ({} lines, {})'.format(self.name, len(self.fd3lines),
+                                                 '{} iterations'.format(self.N) if self.N else 'grid')
+
+    def _lines(self, linesets):
+        lines = self.settings['lines']
+        if isinstance(lines, dict):
+            return {line: tuple(bounds) for line, bounds in lines.items()}
+        names = [lines] if isinstance(lines, str) else lines
+        merged = dict()
+        for lineset in names:
+            if lineset not in linesets:
+                raise ConfigError('target {} uses unknown line set {}'.format(self.name, lineset))
+            merged.update({line: tuple(bounds) for line, bounds in linesets[lineset].items()})
+        return merged
+
+    def _files(self):
+        # the spectra are found as in the single target scripts
+        files = list()
+        for folder in self.settings['spectra']:
+            found = glob.glob(os.path.join(self.settings['spectra_root'], folder))
+            if not found:
+                raise ConfigError('no spectra folder {} of target {} found'.format(folder, self.name))
+            files.extend(glob.glob(found[0] + '/**/*.fits', recursive=True))
+        if len(files) == 0:
+            raise ConfigError('no spectra of target {} found'.format(self.name))
+        return files
+
+    def prepare(self):
+        """
+        makes the folder of the target, clears the results of earlier runs and saves the parameters
+        """
+        pathlib.Path(self.folder).mkdir(parents=True, exist_ok=True)
+        for file in glob.glob(self.folder + '/chisqs/**'):
+            os.remove(file)
+        with open(self.folder + '/params.txt', 'w') as paramfile:
+            paramfile.write('target\t' + self.name + '\n')
+            for key in ('orbit', 'orbit_err', 'lfs', 'sampling', 'k1s', 'k2s', 'dgs', 'engine', 'bintol', 'bingap',
+                        'spectra', 'N', 'perturb_orbit', 'perturb_spectra'):
+                paramfile.write('{}\t{}\n'.format(key, self.settings[key]))
+            paramfile.write('lines used:\n')
+            for line, bounds in self.lines.items():
+                paramfile.write(str(line) + ' ' + str(bounds) + '\n')
+
+    def tasks(self):
+        """
+        :return: the (Fd3class, wd, iteration, store) tasks of the target, for the lines with spectral data. A Monte
+        Carlo target gets its ChisqStore here, with its orbit realizations drawn at once
+        """
+        fd3lines = [fd3line for fd3line in self.fd3lines if fd3line.no_used_spectra > 0]
+        if not self.N:
+            return [(fd3line, self.folder, None, None) for fd3line in fd3lines]
+        lines, orbits, seed = self.montecarlo_plan()
+        self.store = chisqstore.ChisqStore.create(self.folder + '/chisqstore', self.N, lines, self.settings['k1s'],
+                                                  self.settings['k2s'], orbits, seed, dgs=self.settings['dgs'])
+        return [(fd3line, None, ii, self.store) for ii in range(1, self.N + 1) for fd3line in fd3lines]
+
+    def montecarlo_plan(self):
+        """
+        draws the orbit realizations of the Monte Carlo at once, and saves the seed they and the spectrum
+        perturbations are drawn from
+        :return: the names of the lines with spectral data, the orbit of every iteration (None if the orbit is not
+        perturbed) and the seed
+        """
+        s = self.settings
+        orbits = None
+        if s['perturb_orbit']:
+            orbits, seed = fd3classes.perturbed_orbits(s['orbit'], self.N, s['orbit_err'], s['orbit_covar'], s['seed'])
+        else:
+            seed = np.random.SeedSequence(s['seed']).entropy
+        with open(self.folder + '/params.txt', 'a') as paramfile:
+            paramfile.write('seed\t' + str(seed) + '\n')
+        return [repr(fd3line) for fd3line in self.fd3lines if fd3line.no_used_spectra > 0], orbits, seed
+
+
+def load_batch(configfile, spectra_maxfiles=None):
+    """
+    :param configfile: JSON batch config
+    :param spectra_maxfiles: maximal number of spectrum files kept in the shared SpectrumCache, None to keep all
+    :return: list of Target
+    """
+    with open(configfile) as f:
+        config = json.load(f)
+    defaults = config.get('defaults', dict())
+    cachefolder = defaults.pop('cachefolder', None)
+    cache = None if cachefolder is None else chisqcache.ChisqCache(cachefolder)
+    spectra_cache = spec_man.SpectrumCache(spectra_maxfiles)
+    targets = list()
+    for name, settings in config['targets'].items():
+        targets.append(Target(name, dict(defaults, **settings), config.get('linesets', dict()), spectra_cache, cache))
+    folders = [target.folder for target in targets]
+    if len(set(folders)) != len(folders):
+        raise ConfigError('targets must have their own folder')
+    return targets
+
+
+def interleave(tasklists):
+    """
+    fair sharing of the engines: the tasks of all targets in turn, so a large Monte Carlo does not hold back the
+    targets after it
+    :param tasklists: list of the task lists of the targets
+    :return: one list of tasks
+    """
+    return [task for tasks in itertools.zip_longest(*tasklists) for task in tasks if task is not None]
+
+
+def run_batch(targets, concurrency=None):
+    """
+    runs the grids and Monte Carlo iterations of all targets on one AsyncRunner
+    :param targets: list of Target
+    :param concurrency: maximal number of engines running at once, the number of cpus by default
+    :return: list of the exceptions of the failed tasks, None for the others
+    """
+    runner = asyncrunner.AsyncRunner(concurrency)
+    for target in targets:
+        target.prepare()
+    print('loading the spectra of {} lines of {} targets'.format(sum(len(t.fd3lines) for t in targets), len(targets)))
+    runner.load([fd3line for target in targets for fd3line in target.fd3lines])
+    tasklists = [target.tasks() for target in targets]
+    remaining = {target.name: len(tasks) for target, tasks in zip(targets, tasklists)}
+    owners = {id(fd3line): target.name for target in targets for fd3line in target.fd3lines}
+
+    def done(task):
+        name = owners[id(task[0])]
+        remaining[name] -= 1
+        if remaining[name] == 0:
+            print('target {} done'.format(name))
+
+    print('running {} tasks of {} targets on {}'.format(sum(map(len, tasklists)), len(targets), repr(runner)))
+    results = runner.run_tasks(interleave(tasklists), done=done)
+    for target in targets:
+        if target.store is not None:
+            # the summary of the minima, as the ConvergenceMonitor of gridfd3_renorm_MC.py writes it
+            convergence.ConvergenceMonitor(target.store, target.folder + '/convergence.txt').update(final=True)
+    return results
@@ -0,0 +1,165 @@
+"""
+Defines the ChisqCache, a content-addressed on-disk cache of the chisq grids of lines, at grid point granularity
+"""
+import hashlib
+import os
+import threading
+import uuid
+
+import numpy as np
+
+import modules.gridengine as gridengine
+import modules.kepler as kepler
+
+
+def engine_version(engine):
+    """
+    :param engine: 'numpy' or 'gridfd3'
+    :return: hash of the code of the engine, so that rebuilding or editing it invalidates its cached results
+    """
+    files = [gridengine.__file__, kepler.__file__] if engine == 'numpy' else ['./bin/gridfd3']
+    digest = hashlib.sha256(engine.encode())
+    for file in files:
+        with open(file, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def node_keys(k1s, k2s, dgs):
+    """
+    :param k1s: K1 values of the nodes
+    :param k2s: K2 values of the nodes
+    :param dgs: Delta gamma values of the nodes
+    :return: keys of the nodes, rounded as gridfd3 prints them
+    """
+    return list(zip(np.round(k1s, 5).tolist(), np.round(k2s, 5).tolist(), np.round(dgs, 5).tolist()))
+
+
+class ChisqCache:
+    """
+    Caches chisq values per (K1, K2, Delta gamma) node, in one npz file per line and orbit. The file name is a hash of
+    everything the chisq depends on besides the node: the spectra, noises and epochs, the ln(lambda) base and window,
+    the light factors, the orbit and the version of the engine. Lookups touch their file, and once the files exceed
+    maxbytes the least recently used ones are removed.
+    """
+
+    def __init__(self, folder, maxbytes=2 ** 30):
+        """
+        :param folder: directory of the cache, made if it does not exist
+        :param maxbytes: maximal total size of the cache files
+        """
+        self.folder = folder
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self._versions = dict()
+        os.makedirs(folder, exist_ok=True)
+
+    def __repr__(self):
+        return 'ChisqCache at {} ({} entries)'.format(self.folder, len(self._entries()))
+
+    def key(self, fd3line, params):
+        """
+        :param fd3line: Fd3class with its spectra loaded
+        :param params: orbit p, t0, e, omega(, Delta gamma). The Delta gamma is part of the nodes, not of the key
+        :return: hash identifying the chisq grid of this line and orbit
+        """
+        if fd3line.engine not in self._versions:
+            self._versions[fd3line.engine] = engine_version(fd3line.engine)
+        digest = hashlib.sha256(self._versions[fd3line.engine].encode())
+        for arr in (fd3line.data, fd3line.noises, fd3line.mjds, fd3line.logbase, fd3line.loglimits, fd3line.lfs,
+                    params[:4]):
+            arr = np.ascontiguousarray(arr, dtype=np.float64)
+            digest.update(str(arr.shape).encode())
+            digest.update(arr.tobytes())
+        digest.update(str(bool(fd3line.tl)).encode())
+        if fd3line.smoothfft and fd3line.engine != 'numpy':
+            # the extended window of the compiled engines gives slightly different chisqs
+            digest.update('smoothfft {}'.format(fd3line.edgepoints).encode())
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.folder)
+                if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz')]
+
+    def _load(self, key):
+        try:
+            with np.load(self._file(key)) as npz:
+                return {node: chisq for node, chisq in zip(node_keys(npz['k1s'], npz['k2s'], npz['dgs']), npz['chisq'])}
+        except (FileNotFoundError, ValueError, OSError):
+            return dict()
+
+    def lookup(self, key, k1s, k2s, dgs):
+        """
+        :param key: key of the line and orbit
+        :param k1s: K1 values of the nodes
+        :param k2s: K2 values of the nodes
+        :param dgs: Delta gamma values of the nodes
+        :return: the cached chisq of the nodes, NaN where a node is not cached
+        """
+        with self.lock:
+            nodes = self._load(key)
+            if nodes:
+                os.utime(self._file(key))
+        return np.array([nodes.get(node, np.nan) for node in node_keys(k1s, k2s, dgs)])
+
+    def update(self, key, k1s, k2s, dgs, chisq):
+        """
+        adds nodes to the cache, and evicts the least recently used files if it has grown too large
+        :param key: key of the line and orbit
+        :param k1s: K1 values of the nodes
+        :param k2s: K2 values of the nodes
+        :param dgs: Delta gamma values of the nodes
+        :param chisq: chisq values of the nodes
+        """
+        with self.lock:
+            nodes = self._load(key)
+            nodes.update(zip(node_keys(k1s, k2s, dgs), np.asarray(chisq, dtype=np.float64).tolist()))
+            keys = np.array(list(nodes.keys())).reshape(-1, 3)
+            # a temporary name of its own for every writer, so processes sharing the cache never write the same file
+            tmp = '{}.{}.tmp.npz'.format(self._file(key)[:-4], uuid.uuid4().hex)
+            np.savez(tmp, k1s=keys[:, 0], k2s=keys[:, 1], dgs=keys[:, 2], chisq=np.array(list(nodes.values())))
+            # readers in other processes only ever see a complete file
+            os.replace(tmp, self._file(key))
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.maxbytes:
+                break
+            if entry.name == keep + '.npz':
+                continue
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def clear(self):
+        """
+        removes all entries
+        """
+        with self.lock:
+            for entry in self._entries():
+                os.remove(entry.path)
+
+
+def missing_blocks(missing):
+    """
+    covers the missing nodes of a grid with rectangles: consecutive K1 rows that miss the same span of K2 columns
+    are merged into one block
+    :param missing: boolean array of shape (K1s, K2s)
+    :return: list of (first row, last row, first column, last column) blocks
+    """
+    blocks = list()
+    for i, row in enumerate(missing):
+        cols = np.flatnonzero(row)
+        if len(cols) == 0:
+            continue
+        span = (int(cols[0]), int(cols[-1]))
+        if blocks and blocks[-1][1] == i - 1 and blocks[-1][2:] == span:
+            blocks[-1] = (blocks[-1][0], i) + span
+        else:
+            blocks.append((i, i) + span)
+    return blocks
@@ -0,0 +1,187 @@
+"""
+Defines the ChisqStore, a single memory-mapped result store for the chisq grids of a Monte Carlo run
+"""
+import os
+
+import numpy as np
+
+
+def k_axis(kstr):
+    """
+    builds the K axis gridfd3 explores for a range string, using the same sampling as the executable
+    :param kstr: K range in string form: 'left right step'
+    :return: array of K values
+    """
+    low, high, step = (float(s) for s in kstr.split())
+    samp = int((high - low) / step + 1)
+    return np.round(low + np.arange(samp) * step, 5)
+
+
+class ChisqStore:
+    """
+    Holds the chisq grids of all iterations and lines of a Monte Carlo run in one array chisq[iteration, line, k1, k2],
+    or chisq[iteration, line, k1, k2, dg] for runs over a Delta gamma range. The axes and line names are stored once in
+    meta.npz. Every (iteration, line) slot is written by exactly one worker
+    and flagged in a separate done array afterwards, so workers in different threads or processes can fill the store
+    concurrently without locking, and readers only look at completed slots.
+    """
+
+    def __init__(self, folder, mode='r'):
+        """
+        opens an existing store
+        :param folder: directory of the store
+        :param mode: 'r' to read (zero-copy), 'r+' to write
+        """
+        self.folder = folder
+        with np.load(folder + '/meta.npz') as meta:
+            self.k1s = meta['k1s']
+            self.k2s = meta['k2s']
+            # Delta gamma axis, None if the grids have none
+            self.dgs = meta['dgs'] if 'dgs' in meta and meta['dgs'].size else None
+            self.lines = [str(line) for line in meta['lines']]
+            # the seed of the spectrum perturbations, and the number of iterations of the run before the first one of
+            # this store
+            self.seed = int(meta['seed']) if 'seed' in meta and str(meta['seed']) else None
+            self.first = int(meta['first']) if 'first' in meta else 0
+        self.chisq = np.load(folder + '/chisq.npy', mmap_mode=mode)
+        self.done = np.load(folder + '/done.npy', mmap_mode=mode)
+        self.orbits = np.load(folder + '/orbits.npy', mmap_mode='r') if os.path.isfile(folder + '/orbits.npy') else None
+
+    def __repr__(self):
+        return 'ChisqStore at {} ({} iterations, lines {})'.format(self.folder, len(self), self.lines)
+
+    def __len__(self):
+        return self.chisq.shape[0]
+
+    @classmethod
+    def create(cls, folder, iterations, lines, k1s, k2s, orbits=None, seed=None, first=0, dgs=None):
+        """
+        creates an empty store and opens it for writing
+        :param folder: directory of the store, made if it does not exist
+        :param iterations: number of Monte Carlo iterations the store can hold
+        :param lines: names of the lines
+        :param k1s: K1 axis, or K1 range string 'left right step'
+        :param k2s: K2 axis, or K2 range string 'left right step'
+        :param orbits: optional array with the orbit used in every iteration, stored alongside the results
+        :param seed: optional seed of the spectrum perturbations, see rng
+        :param first: number of iterations of the run before the first one of this store, if it holds a part of it
+        :param dgs: optional Delta gamma axis, or range string 'left right step', of lines run over a Delta gamma range
+        :return: the store, opened in 'r+' mode
+        """
+        if isinstance(k1s, str):
+            k1s = k_axis(k1s)
+        if isinstance(k2s, str):
+            k2s = k_axis(k2s)
+        if isinstance(dgs, str):
+            dgs = k_axis(dgs)
+        os.makedirs(folder, exist_ok=True)
+        # the seed is kept as a string, as SeedSequence entropy does not fit in 64 bits
+        np.savez(folder + '/meta.npz', k1s=k1s, k2s=k2s, dgs=np.zeros(0) if dgs is None else dgs,
+                 lines=np.array(lines, dtype=str), seed='' if seed is None else str(seed), first=first)
+        if orbits is not None:
+            if len(orbits) != iterations:
+                raise ValueError('need one orbit per iteration, got {} for {} iterations'.format(len(orbits), iterations))
+            np.save(folder + '/orbits.npy', orbits)
+        elif os.path.isfile(folder + '/orbits.npy'):
+            os.remove(folder + '/orbits.npy')
+        shape = (iterations, len(lines), len(k1s), len(k2s)) + (() if dgs is None else (len(dgs),))
+        chisq = np.lib.format.open_memmap(folder + '/chisq.npy', mode='w+', dtype=np.float64, shape=shape)
+        chisq.flush()
+        done = np.lib.format.open_memmap(folder + '/done.npy', mode='w+', dtype=np.bool_, shape=(iterations, len(lines)))
+        done.flush()
+        del chisq, done
+        return cls(folder, mode='r+')
+
+    def rng(self, iteration, line):
+        """
+        the random generator of the spectrum perturbations of a line in an iteration. It only depends on the seed, the
+        number of the iteration in the whole run and the line, so a Monte Carlo draws the same perturbations however
+        its iterations are spread over threads, processes or shards
+        :param iteration: iteration number in this store, starting at 1
+        :param line: name of the line
+        :return: numpy Generator, None if the store has no seed
+        """
+        if self.seed is None:
+            return None
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(self.first + iteration,
+                                                                                  self.lines.index(line))))
+
+    @staticmethod
+    def exists(folder):
+        return os.path.isfile(folder + '/meta.npz')
+
+    def write(self, iteration, line, cchisq):
+        """
+        writes the chisq grid of one line in one iteration, and flags it as done once it is on disk
+        :param iteration: iteration number, starting at 1
+        :param line: name of the line
+        :param cchisq: chisq values, in the order gridfd3 prints them
+        """
+        il = self.lines.index(line)
+        self.chisq[iteration - 1, il] = np.reshape(cchisq, self.chisq.shape[2:])
+        self.chisq.flush()
+        self.done[iteration - 1, il] = True
+        self.done.flush()
+
+    def write_block(self, iteration, cchisqs):
+        """
+        writes the chisq grids of all lines for a block of consecutive iterations at once
+        :param iteration: number of the first iteration of the block, starting at 1
+        :param cchisqs: chisq grids, shape (iterations, lines, k1s, k2s(, dgs)) with the lines in the order of the store
+        """
+        sl = slice(iteration - 1, iteration - 1 + len(cchisqs))
+        self.chisq[sl] = cchisqs
+        self.chisq.flush()
+        self.done[sl] = True
+        self.done.flush()
+
+    def completed(self):
+        """
+        :return: indices of the iterations for which every line has been written
+        """
+        return np.flatnonzero(np.all(self.done, axis=1))
+
+
+def chunks(store, iterations=None, maxbytes=2 ** 28):
+    """
+    iterates over the completed iterations of a store in chunks that fit in a memory budget
+    :param store: ChisqStore to read
+    :param iterations: indices of the iterations to read, by default all completed ones
+    :param maxbytes: maximal size of a chunk in memory
+    :return: generator of (indices, chisq[indices]) tuples
+    """
+    if iterations is None:
+        iterations = store.completed()
+    size = max(1, int(maxbytes // (store.chisq[0].nbytes or 1)))
+    for start in range(0, len(iterations), size):
+        idx = iterations[start:start + size]
+        if idx[-1] - idx[0] == len(idx) - 1:
+            # contiguous run of iterations, read it as a single slice
+            yield idx, np.asarray(store.chisq[idx[0]:idx[-1] + 1])
+        else:
+            yield idx, store.chisq[idx]
+
+
+def combine_minima(store, iterations=None, maxbytes=2 ** 28):
+    """
+    sums the chisq grids over all lines and finds the minimum of every iteration, streaming over the store in chunks
+    so that memory use stays bounded however many iterations there are. Grids with a Delta gamma axis are minimized
+    over it as well
+    :param store: ChisqStore to read
+    :param iterations: indices of the iterations to combine, by default all completed ones
+    :param maxbytes: maximal size of a chunk in memory
+    :return: indices of the combined iterations, and the K1 and K2 of their minimal chisq
+    """
+    if iterations is None:
+        iterations = store.completed()
+    mink1s = np.empty(len(iterations))
+    mink2s = np.empty(len(iterations))
+    pos = 0
+    for idx, chunk in chunks(store, iterations, maxbytes):
+        total = chunk.sum(axis=1)
+        flat = np.argmin(total.reshape(len(idx), -1), axis=1)
+        i1, i2 = np.unravel_index(flat, total.shape[1:])[:2]
+        mink1s[pos:pos + len(idx)] = store.k1s[i1]
+        mink2s[pos:pos + len(idx)] = store.k2s[i2]
+        pos += len(idx)
+    return iterations, mink1s, mink2s
@@ -0,0 +1,113 @@
+"""
+Defines the ConvergenceMonitor, which follows the per-iteration minima of a running Monte Carlo and stops it early
+"""
+import threading
+import time
+
+import numpy as np
+
+import modules.chisqstore as chisqstore
+
+
+def quantiles(lst):
+    """
+    the 15.8% and 84.2% quantiles of a sample, taken the same way as in MC_combiner.stats
+    :param lst: sample
+    :return: lower and upper quantile
+    """
+    lst = np.sort(lst)
+    return lst[int(0.158 * len(lst))], lst[int(0.842 * len(lst))]
+
+
+class ConvergenceMonitor(threading.Thread):
+    """
+    Thread that periodically combines the completed iterations of a ChisqStore, keeps a summary file with the K1/K2
+    quantiles, mean and std of the minima up to date, and sets its stop event once the quantiles change by less
+    than tol for patience consecutive checks. GridFd3MCThreads given this event stop after their current iteration.
+    """
+
+    def __init__(self, store, summaryfile, tol=None, every=50, miniter=200, patience=3, interval=10):
+        """
+        :param store: ChisqStore the Monte Carlo threads write to
+        :param summaryfile: file the live summary is written to
+        :param tol: maximal change of the quantiles (km/s) between checks to be considered stable, None to never stop
+        :param every: number of new iterations between checks
+        :param miniter: minimal number of iterations before stopping is considered
+        :param patience: number of consecutive stable checks needed to stop
+        :param interval: seconds between polls of the store
+        """
+        super().__init__(daemon=True)
+        self.store = store
+        self.summaryfile = summaryfile
+        self.tol = tol
+        self.every = every
+        self.miniter = miniter
+        self.patience = patience
+        self.interval = interval
+        self.stop = threading.Event()
+        self._finished = threading.Event()
+        self.seen = np.zeros(0, dtype=int)
+        self.mink1s = np.zeros(0)
+        self.mink2s = np.zeros(0)
+        self.previous = None
+        self.stable = 0
+        self.checked = 0
+
+    def __repr__(self):
+        return 'ConvergenceMonitor of ' + repr(self.store)
+
+    def run(self) -> None:
+        """
+        polls the store until finish is called
+        """
+        while not self._finished.wait(self.interval):
+            self.update()
+        self.update(final=True)
+
+    def finish(self):
+        """
+        makes a last update of the summary and ends the monitor
+        """
+        self._finished.set()
+        self.join()
+
+    def update(self, final=False):
+        """
+        combines the newly completed iterations and checks convergence every 'every' iterations
+        :param final: write the summary even if no check is due
+        """
+        new = np.setdiff1d(self.store.completed(), self.seen, assume_unique=True)
+        if len(new):
+            _, k1, k2 = chisqstore.combine_minima(self.store, new)
+            self.seen = np.concatenate((self.seen, new))
+            self.mink1s = np.concatenate((self.mink1s, k1))
+            self.mink2s = np.concatenate((self.mink2s, k2))
+        while len(self.seen) >= self.checked + self.every:
+            self.checked += self.every
+            self._check(self.checked)
+        if final and len(self.seen):
+            self._write(len(self.seen))
+
+    def _check(self, n):
+        current = np.array(quantiles(self.mink1s[:n]) + quantiles(self.mink2s[:n]))
+        if self.previous is not None and self.tol is not None and np.max(np.abs(current - self.previous)) <= self.tol:
+            self.stable += 1
+        else:
+            self.stable = 0
+        self.previous = current
+        if self.tol is not None and n >= self.miniter and self.stable >= self.patience and not self.stop.is_set():
+            print('Monte Carlo converged after {} iterations, stopping'.format(n))
+            self.stop.set()
+        self._write(n)
+
+    def _write(self, n):
+        with open(self.summaryfile, 'w') as f:
+            f.write('time\t{}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S')))
+            f.write('iterations\t{}\n'.format(n))
+            f.write('converged\t{}\n'.format(self.stop.is_set()))
+            for name, ks in (('k1', self.mink1s[:n]), ('k2', self.mink2s[:n])):
+                q1, q2 = quantiles(ks)
+                f.write('{} avg\t{}\n'.format(name, np.average(ks)))
+                f.write('{} std\t{}\n'.format(name, np.std(ks)))
+                f.write('{} 15.8%\t{}\n'.format(name, q1))
+                f.write('{} 84.2%\t{}\n'.format(name, q2))
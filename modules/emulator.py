@@ -0,0 +1,140 @@
+"""
+Defines the ChisqEmulator, a polynomial response surface of the chisq grids over the orbital parameters, used to
+answer orbit-perturbation Monte Carlo draws without rerunning the grid for every draw
+"""
+import itertools
+
+import numpy as np
+import scipy.linalg as spalg
+
+
+def central_composite(dim, radius=2.):
+    """
+    rotatable central composite design: the centre, the 2^dim corners of the cube and 2 dim axial points
+    :param dim: number of parameters
+    :param radius: distance of the axial points from the centre, in units of sigma
+    :return: design points in whitened coordinates, shape (1 + 2^dim + 2 dim, dim)
+    """
+    alpha = (2 ** dim) ** 0.25
+    corners = np.array(list(itertools.product((-1., 1.), repeat=dim)))
+    axial = np.concatenate((alpha * np.eye(dim), -alpha * np.eye(dim)))
+    return np.concatenate((np.zeros((1, dim)), corners, axial)) * radius / alpha
+
+
+def features(u, degree=2):
+    """
+    :param u: points in whitened coordinates, shape (R, dim)
+    :param degree: degree of the polynomial
+    :return: all monomials of u up to degree, shape (R, terms)
+    """
+    cols = [np.ones(len(u))]
+    for d in range(1, degree + 1):
+        for combo in itertools.combinations_with_replacement(range(u.shape[1]), d):
+            cols.append(np.prod(u[:, combo], axis=1))
+    return np.array(cols).T
+
+
+class ChisqEmulator:
+    """
+    Quadratic response surface of a chisq grid (or any stack of grids) in the first four orbital elements
+    (p, t0, e, omega), fitted per grid node on a central composite design around the nominal orbit.
+    The orbital elements are whitened with the Cholesky factor of their covariance matrix, so the design and the
+    polynomial are expressed in units of sigma.
+    """
+
+    def __init__(self, orbit, orbcovar=None, orberr=None, degree=2, radius=3., extra=0, seed=None):
+        """
+        :param orbit: nominal orbit
+        :param orbcovar: covariance matrix of p, t0, e, omega
+        :param orberr: errors of p, t0, e, omega, used if no covariance matrix is given
+        :param degree: degree of the polynomial
+        :param radius: extent of the design in units of sigma
+        :param extra: number of random design points drawn from the orbit distribution on top of the composite design,
+        needed for degrees above 2
+        :param seed: seed for the extra design points
+        """
+        if orbcovar is None:
+            orbcovar = np.diag(np.ravel(orberr) ** 2)
+        self.orbit = np.array(orbit, dtype=np.float64)
+        self.chol = spalg.cholesky(orbcovar, lower=True)
+        self.degree = degree
+        self.design = np.concatenate((central_composite(4, radius), np.random.default_rng(seed).normal(size=(extra, 4))))
+        if len(self.design) < features(self.design, degree).shape[1]:
+            raise ValueError('{} design points cannot fit a polynomial of degree {}, add extra points'.format(
+                len(self.design), degree))
+        self.coefs = None
+        self.shape = None
+
+    def __repr__(self):
+        return 'ChisqEmulator of degree {} on {} design points'.format(self.degree, len(self.design))
+
+    def design_orbits(self):
+        """
+        :return: the orbits at which the exact chisq grids are needed for the fit, shape (P, len(orbit))
+        """
+        return self.to_orbits(self.design)
+
+    def to_orbits(self, u):
+        orbits = np.tile(self.orbit, (len(u), 1))
+        orbits[:, :4] += u @ self.chol.T
+        return orbits
+
+    def whiten(self, orbits):
+        return spalg.solve_triangular(self.chol, (np.atleast_2d(orbits)[:, :4] - self.orbit[:4]).T, lower=True).T
+
+    def fit(self, grids):
+        """
+        fits the polynomial to every grid node at once
+        :param grids: exact chisq grids at the design orbits, shape (P, ...)
+        """
+        grids = np.asarray(grids)
+        self.shape = grids.shape[1:]
+        self.coefs, _, _, _ = np.linalg.lstsq(features(self.design, self.degree), grids.reshape(len(grids), -1),
+                                              rcond=None)
+
+    def predict(self, orbits):
+        """
+        :param orbits: orbits, shape (R, len(orbit))
+        :return: emulated chisq grids, shape (R, ...)
+        """
+        return (features(self.whiten(orbits), self.degree) @ self.coefs).reshape((-1,) + self.shape)
+
+
+def emulate_mc(fd3lines, store, orbit, wd, orbcovar=None, orberr=None, verify=20, seed=None, **kwargs):
+    """
+    fills a ChisqStore holding pre-drawn orbits from an emulator, and reruns a subset of iterations exactly to verify it
+    :param fd3lines: Fd3class objects of the lines in the store
+    :param store: ChisqStore with orbits
+    :param orbit: nominal orbit
+    :param wd: working directory for the exact runs
+    :param orbcovar: covariance matrix of p, t0, e, omega
+    :param orberr: errors of p, t0, e, omega, used if no covariance matrix is given
+    :param verify: number of iterations that are also computed exactly; those are kept in the store
+    :param seed: seed for choosing the verified iterations and the extra design points
+    :param kwargs: passed on to ChisqEmulator
+    :return: the emulator
+    """
+    emulator = ChisqEmulator(orbit, orbcovar, orberr, seed=seed, **kwargs)
+    byname = {repr(fd3line): fd3line for fd3line in fd3lines}
+    lines = [byname[line] for line in store.lines]
+    design = emulator.design_orbits()
+    print('evaluating {} design orbits for the emulator'.format(len(design)))
+    exact = np.array([[fd3line.chisq_grid(params, wd) for fd3line in lines] for params in design])
+    emulator.fit(exact)
+    print('emulating {} iterations'.format(len(store)))
+    for start in range(0, len(store), 100):
+        store.write_block(start + 1, emulator.predict(store.orbits[start:start + 100]))
+    checks = np.random.default_rng(seed).choice(len(store), size=min(verify, len(store)), replace=False)
+    same = 0
+    maxerr = 0
+    for it in checks:
+        emulated = np.sum(store.chisq[it], axis=0)
+        grids = [fd3line.chisq_grid(store.orbits[it], wd) for fd3line in lines]
+        for il, fd3line in enumerate(lines):
+            store.write(it + 1, repr(fd3line), grids[il])
+        total = np.sum(grids, axis=0)
+        maxerr = max(maxerr, np.max(np.abs(emulated - total) / total))
+        same += np.argmin(emulated) == np.argmin(total)
+    print('emulator verified on {} iterations: same minimum in {}, max relative chisq error {}'.format(
+        len(checks), same, maxerr))
+    return emulator
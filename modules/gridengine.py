@@ -0,0 +1,206 @@
+"""
+Pure NumPy implementation of the gridfd3 merit function of src/gridfd3, evaluating many (K1, K2) points per call.
+Used when the compiled engine is not available, and as the numerical reference for the compiled engines.
+"""
+import numpy as np
+
+import modules.kepler as kepler
+
+SPEEDOFLIGHT = 299792.458  # km/s
+# gridfd3 drops singular values below SVCUT = 1e-9 times the largest one. Here the per-frequency systems are solved
+# through their K x K normal matrices, whose eigenvalues are the squared singular values; below EIGCUT those are
+# dominated by round-off, so that is where they are cut instead of at SVCUT ** 2.
+EIGCUT = 1.0e-12
+
+
+class GridEngine:
+    """
+    Holds the Fourier transformed observations of one line, and evaluates the gridfd3 chisq for any number of
+    (K1, K2) points of a tight orbit (p, t0, e, omega) as batched array operations.
+    """
+
+    def __init__(self, logbase, data, noises, mjds, lfs, loglimits, tl=False):
+        """
+        :param logbase: ln(lambda) base of the observations, as written to the gridfd3 master file
+        :param data: observed fluxes, shape (M, len(logbase))
+        :param noises: noise of every spectrum
+        :param mjds: times of the observations
+        :param lfs: light factors of the components
+        :param loglimits: ln(lambda) limits of the part of the base that is used
+        :param tl: whether a static third component is fitted
+        """
+        logbase = np.asarray(logbase)
+        # same bin selection and rv step as gridfd3.c
+        i0 = np.searchsorted(logbase, loglimits[0], side='left')
+        i1 = np.searchsorted(logbase, loglimits[1], side='right') - 1
+        self.rvstep = SPEEDOFLIGHT * (np.exp((logbase[-1] - logbase[0]) / (len(logbase) - 1)) - 1)
+        self.mjds = np.asarray(mjds, dtype=np.float64)
+        self.sig = np.asarray(noises, dtype=np.float64)
+        self.K = 3 if tl else 2
+        self.M = len(self.mjds)
+        self.N = i1 - i0 + 1
+        obs = np.asarray(np.asarray(data)[:, i0:i1 + 1], dtype=np.float64)
+        # weighted data vectors, shape (M, F), with the 1/sqrt(N) normalization of dft_fwd
+        self.dftobs = np.fft.rfft(obs, axis=1) / np.sqrt(self.N) / self.sig[:, None]
+        n = np.arange(self.dftobs.shape[1])
+        self.q = 2 * np.pi * n / self.N
+        self.roots = np.exp(-2j * np.pi * np.arange(self.N) / self.N)
+        self.weights = np.where(n % ((self.N + 1) // 2) == 0, 1., 2.)
+        self.bb = np.sum(self.weights * np.sum(np.abs(self.dftobs) ** 2, axis=0))
+        # light factor over noise, shape (K, M)
+        self.lfm = np.array([np.full(self.M, lfs[k]) for k in range(self.K)]) / self.sig[None, :]
+
+    def __repr__(self):
+        return 'GridEngine ({} spectra, {} bins, {} components)'.format(self.M, self.N, self.K)
+
+    @classmethod
+    def from_fd3class(cls, fd3obj, data=None):
+        """
+        :param fd3obj: Fd3class with its spectra loaded
+        :param data: fluxes to use instead of fd3obj.data, e.g. perturbed ones
+        :return: engine for the line of fd3obj
+        """
+        return cls(fd3obj.logbase, fd3obj.data if data is None else data, fd3obj.noises, fd3obj.mjds, fd3obj.lfs,
+                   fd3obj.loglimits, fd3obj.tl)
+
+    def orbit_shape(self, orbit):
+        """
+        the radial velocity curve of unit semi-amplitude, cos(theta + omega) + e cos(omega), at all epochs
+        :param orbit: p, t0, e, omega (deg), or a stack of R such orbits of shape (R, 4)
+        :return: array of shape (M,), or (R, M) for a stack of orbits
+        """
+        p, t0, e, omega = (np.asarray(orbit, dtype=np.float64)[..., i, None] for i in range(4))
+        omega = np.pi / 180 * omega
+        theta = kepler.true_anom(kepler.phase(self.mjds, p, t0), e)
+        return np.cos(theta + omega) + e * np.cos(omega)
+
+    def rv_bins(self, k1s, k2s, shape, dgs=None):
+        """
+        :param k1s: K1 values (km/s), shape (G,)
+        :param k2s: K2 values (km/s), shape (G,)
+        :param shape: output of orbit_shape, shape (M,) for a common orbit or (G, M) for one orbit per point
+        :param dgs: Delta gamma values (km/s), the systemic velocity of the secondary relative to the primary, shape (G,)
+        :return: radial velocities in bins, shape (G, K, M)
+        """
+        rv = np.zeros((len(k1s), self.K, self.M))
+        rv[:, 0] = k1s[:, None] * shape / self.rvstep
+        rv[:, 1] = - k2s[:, None] * shape / self.rvstep
+        if dgs is not None:
+            rv[:, 1] += dgs[:, None] / self.rvstep
+        return rv
+
+    def shift_matrix(self, rv):
+        """
+        the fd3sep model matrix, light factor over noise times the Fourier transformed linear interpolation shift
+        :param rv: radial velocities in bins, shape (G, K, M)
+        :return: complex array of shape (G, K, M, F)
+        """
+        fv = np.floor(rv)
+        w = (rv - fv)[..., None]
+        # linear interpolation between the shifts by floor(v) and floor(v) + 1 bins, shape (G, K, M, F).
+        # exp(-i floor(v) q) is looked up in the table of N-th roots of unity, as floor(v) n is an integer
+        z = w * (np.exp(-1j * self.q) - 1)
+        z += 1
+        z *= self.lfm[None, :, :, None]
+        idx = fv.astype(np.int64)[..., None] * np.arange(len(self.q))
+        idx %= self.N
+        z *= np.take(self.roots, idx)
+        return z
+
+    def merit_rv(self, rv):
+        """
+        the fd3sep chisq for stacks of radial velocities in bins
+        :param rv: radial velocities in bins, shape (G, K, M)
+        :return: chisq, shape (G,)
+        """
+        z = self.shift_matrix(rv)
+        gram = np.einsum('gkmf,glmf->gfkl', z.conj(), z)
+        atb = np.einsum('gkmf,mf->gfk', z.conj(), self.dftobs)
+        lam, u = np.linalg.eigh(gram)
+        proj = np.abs(np.einsum('gfkl,gfk->gfl', u.conj(), atb)) ** 2
+        keep = lam > EIGCUT * lam[..., -1:]
+        fitted = np.sum(np.where(keep, proj / np.where(keep, lam, 1), 0), axis=2)
+        return self.bb - fitted @ self.weights
+
+    def components(self, k1, k2, orbit, dg=0.):
+        """
+        the disentangled component spectra at one (K1, K2, Delta gamma) point, as fd3 writes them to its .mod file
+        :param k1: K1 (km/s)
+        :param k2: K2 (km/s)
+        :param orbit: p, t0, e, omega (deg)
+        :param dg: Delta gamma (km/s)
+        :return: component spectra, shape (K, N)
+        """
+        rv = self.rv_bins(np.array([k1], dtype=np.float64), np.array([k2], dtype=np.float64), self.orbit_shape(orbit),
+                          np.array([dg], dtype=np.float64))
+        z = self.shift_matrix(rv)[0]
+        gram = np.einsum('kmf,lmf->fkl', z.conj(), z)
+        atb = np.einsum('kmf,mf->fk', z.conj(), self.dftobs)
+        lam, u = np.linalg.eigh(gram)
+        proj = np.einsum('fkl,fk->fl', u.conj(), atb)
+        keep = lam > EIGCUT * lam[..., -1:]
+        # minimum norm solution, as the truncated svd of fd3sep gives for the degenerate zero frequency
+        coef = np.einsum('fkl,fl->kf', u, np.where(keep, proj / np.where(keep, lam, 1), 0))
+        return np.fft.irfft(coef * np.sqrt(self.N), n=self.N, axis=1)
+
+    def merit(self, k1s, k2s, orbit, dgs=0., maxbytes=2 ** 27):
+        """
+        the gridfd3 chisq at any number of (K1, K2, Delta gamma) points, evaluated in chunks that fit in a memory
+        budget. The orbit is solved once for all points.
+        :param k1s: K1 values (km/s)
+        :param k2s: K2 values (km/s), broadcast against k1s
+        :param orbit: p, t0, e, omega (deg)
+        :param dgs: Delta gamma values (km/s), broadcast against k1s and k2s
+        :param maxbytes: maximal size of the intermediate arrays of a chunk
+        :return: chisq, with the broadcast shape of k1s, k2s and dgs
+        """
+        k1s, k2s, dgs = np.broadcast_arrays(np.asarray(k1s, dtype=np.float64), np.asarray(k2s, dtype=np.float64),
+                                            np.asarray(dgs, dtype=np.float64))
+        shape = self.orbit_shape(orbit)
+        flat1, flat2, flatg = k1s.ravel(), k2s.ravel(), dgs.ravel()
+        chisq = np.empty(len(flat1))
+        size = max(1, int(maxbytes // (3 * 16 * self.K * self.M * len(self.q))))
+        for start in range(0, len(flat1), size):
+            sl = slice(start, start + size)
+            chisq[sl] = self.merit_rv(self.rv_bins(flat1[sl], flat2[sl], shape, flatg[sl]))
+        return chisq.reshape(k1s.shape)
+
+    def merit_orbits(self, k1s, k2s, orbits, maxbytes=2 ** 27):
+        """
+        the gridfd3 chisq at points that each have their own orbit, e.g. the walkers of a sampler
+        :param k1s: K1 values (km/s), shape (G,)
+        :param k2s: K2 values (km/s), shape (G,)
+        :param orbits: p, t0, e, omega (deg) of every point, shape (G, 4)
+        :param maxbytes: maximal size of the intermediate arrays of a chunk
+        :return: chisq, shape (G,)
+        """
+        k1s, k2s = np.asarray(k1s, dtype=np.float64), np.asarray(k2s, dtype=np.float64)
+        shapes = self.orbit_shape(orbits)
+        chisq = np.empty(len(k1s))
+        size = max(1, int(maxbytes // (3 * 16 * self.K * self.M * len(self.q))))
+        for start in range(0, len(k1s), size):
+            sl = slice(start, start + size)
+            chisq[sl] = self.merit_rv(self.rv_bins(k1s[sl], k2s[sl], shapes[sl]))
+        return chisq
+
+    def grid(self, k1axis, k2axis, orbit, maxbytes=2 ** 27):
+        """
+        :param k1axis: K1 axis of the grid
+        :param k2axis: K2 axis of the grid
+        :param orbit: p, t0, e, omega (deg)
+        :param maxbytes: maximal size of the intermediate arrays of a chunk
+        :return: chisq grid of shape (len(k1axis), len(k2axis))
+        """
+        return self.merit(np.asarray(k1axis)[:, None], np.asarray(k2axis)[None, :], orbit, maxbytes=maxbytes)
+
+    def cube(self, k1axis, k2axis, dgaxis, orbit, maxbytes=2 ** 27):
+        """
+        :param k1axis: K1 axis of the grid
+        :param k2axis: K2 axis of the grid
+        :param dgaxis: Delta gamma axis of the grid
+        :param orbit: p, t0, e, omega (deg)
+        :param maxbytes: maximal size of the intermediate arrays of a chunk
+        :return: chisq cube of shape (len(k1axis), len(k2axis), len(dgaxis))
+        """
+        return self.merit(np.asarray(k1axis)[:, None, None], np.asarray(k2axis)[None, :, None], orbit,
+                          np.asarray(dgaxis)[None, None, :], maxbytes)
@@ -1,21 +1,26 @@
 """
 Defines the Fd3gridline object and its MCMC brother
 """
+import concurrent.futures as cf
+import copy
 import os
-import re
 import shutil
 import subprocess as sp
 import threading
 import time
 import typing
 
-import scipy.interpolate as spint
-import scipy.optimize as spopt
-import scipy.linalg as spalg
 import numpy as np
-import matplotlib.pyplot as plt
 
+import modules.chisqcache as chisqcache
+import modules.chisqstore as chisqstore
+import modules.gridengine as gridengine
+import modules.kepler as kepler
 import modules.spectra_manager as spec_man
+import modules.timing as timing
+
+# stage durations of all runs in this process, see modules.timing
+TIMELINE = timing.Timeline()
 
 
 def doppler_shift(w, rv):
@@ -26,11 +31,60 @@ def doppler_shift(w, rv):
     return w * c / (c - rv)
 
 
+def crossfade_weights(x, lo, hi, fade_lo=0., fade_hi=0.):
+    """
+    weights of a window in a stitched spectrum: 1 in the middle, ramping linearly to 0 over the central half of the
+    overlaps with the neighbouring windows, and 0 outside the window
+    :param x: ln(lambda) grid
+    :param lo: lower limit of the window
+    :param hi: upper limit of the window
+    :param fade_lo: width of the overlap with the window below, 0 for the first window
+    :param fade_hi: width of the overlap with the window above, 0 for the last window
+    :return: weights on x
+    """
+    w = np.where((x >= lo) & (x <= hi), 1., 0.)
+    if fade_lo:
+        w *= np.clip((x - lo - fade_lo / 4) / (fade_lo / 2), 0, 1)
+    if fade_hi:
+        w *= np.clip((hi - fade_hi / 4 - x) / (fade_hi / 2), 0, 1)
+    return w
+
+
+def perturbed_orbits(orb, n, orberr=None, orbcovar=None, seed=None):
+    """
+    draws n orbit realizations in one go. The first four elements (p, t0, e, omega) are perturbed with the errors
+    orberr, or with the covariance matrix orbcovar if given, which is factorized only once.
+    :param orb: nominal orbit
+    :param n: number of realizations
+    :param orberr: errors of p, t0, e, omega
+    :param orbcovar: covariance matrix of p, t0, e, omega
+    :param seed: seed of the SeedSequence, None to draw fresh entropy
+    :return: array of shape (n, len(orb)) of orbits, and the entropy of the SeedSequence to reproduce them with
+    """
+    ss = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(ss)
+    if orbcovar is None:
+        turb = rng.normal(size=(n, 4)) * np.reshape(orberr, (1, 4))
+    else:
+        c = np.linalg.cholesky(orbcovar)
+        turb = rng.normal(size=(n, 4)) @ c.T
+    orbits = np.tile(np.array(orb, dtype=np.float64), (n, 1))
+    orbits[:, :4] += turb
+    return orbits, ss.entropy
+
+
 class Fd3class:
+    # slots rather than a __dict__, as Monte Carlo runs keep many lines in memory
+    __slots__ = ('tl', 'engine', 'lfs', 'orb', 'orberr', 'orbcovar', 'name', 'loglimits', 'wideloglimits', 'linbase',
+                 'logbase', 'widelogbase', 'edgepoints', 'data', '_widedata', 'noises', 'mjds', 'spectra', 'dof',
+                 'no_used_spectra', 'po', 'ps', 'k1s', 'k2s', 'dgs', 'bintol', 'bingap', 'cache', 'spectra_cache', 'dtype',
+                 'lazywide', 'smoothfft', 'prim', 'sec', '_orbchol', '_used', '_bins')
 
     def __init__(self, name, linlimits, linsamp, spectra_files, tl, orb, orberr=None, orbcovar=None, po=False, ps=False, lfs=(0.5, 0.5), k1s=None,
-                 k2s=None):
+                 k2s=None, engine='gridfd3', dgs=None, bintol=None, cache=None, spectra_cache=None, dtype=np.float64,
+                 lazywide=True, smoothfft=False, bingap=None):
         self.tl = tl
+        self.engine = engine
         self.lfs = lfs
         self.orb = orb
         self.orberr = orberr
@@ -44,7 +98,7 @@ class Fd3class:
         self.widelogbase = np.arange(self.wideloglimits[0] - 20 * logsamp, self.wideloglimits[-1] + 20 * logsamp, logsamp)
         self.edgepoints = 20
         self.data = None
-        self.widedata = None
+        self._widedata = None
         self.noises = None
         self.mjds = None
         self.spectra = spectra_files
@@ -54,98 +108,304 @@ class Fd3class:
         self.ps = ps
         self.k1s = k1s
         self.k2s = k2s
+        # Delta gamma range, which makes the grid a K1 x K2 x Delta gamma cube. If None, the Delta gamma of the orbit
+        self.dgs = dgs
+        # co-add spectra whose predicted rvs differ less than this (km/s), None to use every spectrum separately
+        self.bintol = bintol
+        # and that were taken within this many days of each other, a hundredth of the period if None
+        self.bingap = bingap
+        # optional ChisqCache serving the grid nodes that were computed before for the same spectra and orbit
+        self.cache = cache
+        # optional SpectrumCache shared with other lines, so every spectrum file is read once
+        self.spectra_cache = spectra_cache
+        # storage type of the fluxes, np.float32 halves the memory of the spectra and their perturbations
+        self.dtype = dtype
+        # read the spectra on the wide base of fd3 only when they are first used, as grid runs never use them
+        self.lazywide = lazywide
+        # let the compiled engines extend the window to a length their FFT factorizes well, tapered over edgepoints
+        # bins, instead of transforming e.g. a large prime length with the slow generic radix. The NumPy engine
+        # transforms the window as it is
+        self.smoothfft = smoothfft
         self.prim = None
         self.sec = None
+        self._orbchol = None
+        # indices of the used spectrum files, and the co-adding of _bin_epochs, to load the wide spectra with
+        self._used = None
+        self._bins = None
 
     def __repr__(self):
         return self.name
 
     def ecc_anom_of_phase(self, ph):
-        # define keplers equation as function of a phase
-        def keplers_eq(p):
-            # build a function object that should be zero for a certain eccentric anomaly
-            def kepler(ecc_an):
-                return ecc_an - self.orb[2] * np.sin(ecc_an) - 2 * np.pi * p
+        # solve keplers equation for a phase, or an array of phases at once
+        return kepler.ecc_anom_of_phase(ph, self.orb[2])
+
+    def true_anom(self, ph):
+        return kepler.true_anom(ph, self.orb[2])
 
-            return kepler
+    @property
+    def widedata(self):
+        """
+        the spectra on the wide ln(lambda) base of fd3, read from the spectrum files when they are first used
+        """
+        if self._widedata is None and self._used is not None:
+            self._set_widedata()
+        return self._widedata
 
-        # find the root of keplers_eq(phase), which by construction returns a function for which the eccentric anomaly
-        # is the independent variable.
-        # current root finding algorithm is toms748, as it has the best convergence (2.7 bits per function evaluation)
-        ph = np.remainder(ph, 1)
-        return spopt.root_scalar(keplers_eq(ph), method='toms748', bracket=(0, 2 * np.pi)).root
+    @widedata.setter
+    def widedata(self, widedata):
+        self._widedata = widedata
 
-    def true_anom(self, ph):
-        E = self.ecc_anom_of_phase(ph)
-        return 2 * np.arctan(np.sqrt((1 + self.orb[2]) / (1 - self.orb[2])) * np.tan(E / 2))
+    def _getspectrum(self):
+        return spec_man.getspectrum if self.spectra_cache is None else self.spectra_cache.getspectrum
 
     def _set_spectra(self):
         print(' fetching spectrum data for {}'.format(repr(self)))
-        self.data = list()
-        self.widedata = list()
-        self.noises = list()
-        self.mjds = list()
+        data = list()
+        widedata = list()
+        noises = list()
+        mjds = list()
+        used = list()
+        getspectrum = self._getspectrum()
+        # a sample of the wide base, to check a spectrum covers it without evaluating it on the full base
+        widecheck = self.widelogbase[np.unique(np.linspace(0, len(self.widelogbase) - 1, 4 * self.edgepoints,
+                                                           dtype=int))]
         for j in range(len(self.spectra)):
             try:
-                fluxhere, noisehere, mjdhere = spec_man.getspectrum(repr(self), self.spectra[j], self.logbase, self.edgepoints)
-                wideflux, _, _ = spec_man.getspectrum(repr(self), self.spectra[j], self.widelogbase, self.edgepoints)
+                fluxhere, noisehere, mjdhere = getspectrum(repr(self), self.spectra[j], self.logbase, self.edgepoints)
+                if self.lazywide:
+                    getspectrum(repr(self), self.spectra[j], widecheck, self.edgepoints)
+                else:
+                    widedata.append(np.asarray(getspectrum(repr(self), self.spectra[j], self.widelogbase,
+                                                           self.edgepoints)[0], dtype=self.dtype))
             except spec_man.SpectrumError:
                 continue
-            self.data.append(fluxhere)
-            self.widedata.append(wideflux)
-            self.noises.append(noisehere)
-            self.mjds.append(mjdhere)
-        self.no_used_spectra = len(self.data)
-        self.widedata = np.array(self.widedata)
-        self.data = np.array(self.data)
-        self.mjds = np.array(self.mjds)
-        self.noises = np.array(self.noises)
-        self.dof = self.no_used_spectra * len(self.logbase)
+            data.append(np.asarray(fluxhere, dtype=self.dtype))
+            noises.append(noisehere)
+            mjds.append(mjdhere)
+            used.append(j)
+        self.no_used_spectra = len(data)
+        self.data = np.array(data, dtype=self.dtype)
+        self._widedata = None if self.lazywide else np.array(widedata, dtype=self.dtype)
+        self.mjds = np.array(mjds)
+        self.noises = np.array(noises)
+        self._used = used
+        self._bins = None
         print(' {} uses {} spectra'.format(repr(self), self.no_used_spectra))
+        if self.bintol is not None and self.no_used_spectra > 1:
+            self._bin_epochs()
+        self.dof = self.no_used_spectra * len(self.logbase)
 
-    def _perturb_spectra(self):
-        newdata = np.copy(self.data)
-        n = newdata.shape[1]
-        m = newdata.shape[0]
-        pert = np.random.default_rng().normal(loc=0, scale=self.noises, size=(n, m))
-        return newdata + pert.T
+    def _set_widedata(self):
+        print(' fetching wide spectrum data for {}'.format(repr(self)))
+        getspectrum = self._getspectrum()
+        widedata = np.empty((len(self._used), len(self.widelogbase)), dtype=self.dtype)
+        for i, j in enumerate(self._used):
+            try:
+                widedata[i] = getspectrum(repr(self), self.spectra[j], self.widelogbase, self.edgepoints)[0]
+            except spec_man.SpectrumError as e:
+                raise ValueError('{} was used for {}, but fails on its wide range: {}'.format(
+                    self.spectra[j], repr(self), e)) from e
+        self._widedata = widedata if self._bins is None else self._coadd(widedata)
+
+    def _max_ks(self):
+        # largest semi-amplitudes the line will be evaluated at
+        if self.k1s is not None and self.k2s is not None:
+            return np.max(np.abs(chisqstore.k_axis(self.k1s))), np.max(np.abs(chisqstore.k_axis(self.k2s)))
+        return abs(self.orb[4]), abs(self.orb[5])
+
+    def _bin_epochs(self):
+        """
+        groups spectra, in order of time, while the predicted rvs of both components at the largest K1 and K2 stay
+        within bintol of those of the first spectrum of the group and they were taken within bingap of it, and
+        replaces every group by its noise weighted average. The time limit keeps spectra a period apart, at about the
+        same rvs, out of one group, as their average time would fall at a different phase
+        """
+        order = np.argsort(self.mjds)
+        times = self.mjds[order]
+        gap = self.orb[0] / 100 if self.bingap is None else self.bingap
+        omega = np.pi / 180 * self.orb[3]
+        theta = kepler.true_anom(kepler.phase(self.mjds[order], self.orb[0], self.orb[1]), self.orb[2])
+        shape = np.cos(theta + omega) + self.orb[2] * np.cos(omega)
+        # the largest rv difference of the two components between spectra is the largest K times the shape difference
+        scale = max(self._max_ks())
+        starts = [0]
+        for j in range(1, len(order)):
+            if scale * abs(shape[j] - shape[starts[-1]]) > self.bintol or times[j] - times[starts[-1]] > gap:
+                starts.append(j)
+        if len(starts) == len(order):
+            print(' {}: no spectra to co-add within {} km/s and {} d'.format(repr(self), self.bintol, gap))
+            return
+        w = 1 / self.noises[order] ** 2
+        wsum = np.add.reduceat(w, starts)
+        self._bins = (order, starts, w, wsum)
+        self.data = self._coadd(self.data)
+        if self._widedata is not None:
+            self._widedata = self._coadd(self._widedata)
+        self.mjds = np.add.reduceat(w * self.mjds[order], starts) / wsum
+        self.noises = 1 / np.sqrt(wsum)
+        print(' {}: co-added {} spectra into {} epochs within {} km/s, expected speed-up {:.1f}x'.format(
+            repr(self), self.no_used_spectra, len(starts), self.bintol, self.no_used_spectra / len(starts)))
+        self.no_used_spectra = len(starts)
+
+    def _coadd(self, spectra):
+        # the noise weighted averages of the groups of _bin_epochs
+        order, starts, w, wsum = self._bins
+        return (np.add.reduceat(w[:, None] * spectra[order], starts) / wsum[:, None]).astype(self.dtype)
+
+    def _perturb_spectra(self, rng=None, out=None):
+        """
+        :param rng: numpy Generator to draw the perturbations from, a fresh one by default
+        :param out: optional array of the shape and type of data the perturbed spectra are drawn into, so the buffer
+        of earlier iterations can be reused
+        :return: the spectra perturbed with their noise
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        if out is None:
+            out = np.empty_like(self.data)
+        rng.standard_normal(out=out, dtype=out.dtype)
+        out *= self.noises[:, None]
+        out += self.data
+        return out
 
     def _perturb_orbit(self):
         if self.orbcovar is None:
             turb = np.random.default_rng().normal(scale=self.orberr)
         else:
             turb = np.random.default_rng().normal(size=(4, 1))
-            c = spalg.cholesky(self.orbcovar, lower=True)
-            turb = np.dot(c, turb).T
+            if self._orbchol is None:
+                self._orbchol = np.linalg.cholesky(self.orbcovar)
+            turb = np.dot(self._orbchol, turb).T
         return self.orb + turb[0]
 
-    def run_gridfd3(self, wd, iteration: int = None):
+    def run_gridfd3(self, wd, iteration: int = None, store=None, buffers=None):
         """
         do the grid minimization.
         1. write infile
         2. write obsfile for fd3
         3. run_fd3 the executable
-        4. save output in speedy npz files for later handling
+        4. save output in speedy npz files, or in the result store, for later handling
+        With engine 'numpy', steps 2 and 3 are replaced by evaluating the grid with the NumPy GridEngine. With a cache,
+        only the grid nodes it does not hold are evaluated.
         :param wd: working directory
         :param iteration: if an MCMC is running, which iteration are we doing
+        :param store: optional ChisqStore of the MCMC run the output is written to
+        :param buffers: optional dict of the perturbed spectra of the previous iteration by line, which are reused
         """
-        if self.data is None or self.widedata is None:
-            self._set_spectra()
+        if self.data is None:
+            with TIMELINE.stage('load spectra', self, iteration):
+                self._set_spectra()
         if self.no_used_spectra < 1:
             print(' {} has no spectral data, skipping'.format(repr(self)))
             return
-        if not iteration:
+        params = self._iteration_orbit(iteration, store)
+        if self.cache is not None and not self.ps:
+            kk1s, kk2s, ddgs, cchisq = self._cached_grid(params, wd, iteration, not iteration)
+        else:
+            data = self._iteration_data(iteration, store, None if buffers is None else buffers.get(repr(self)))
+            if buffers is not None and data is not None:
+                buffers[repr(self)] = data
+            kk1s, kk2s, ddgs, cchisq = self._grid(params, wd, iteration, not iteration, data)
+        with TIMELINE.stage('save output', self, iteration):
+            self._save_gridfd3_output(wd, iteration, store, kk1s, kk2s, ddgs, cchisq)
+
+    def _grid(self, params, wd, iteration=None, verbose=True, data=None):
+        """
+        evaluates the grid with the selected engine
+        :param params: orbit p, t0, e, omega(, Delta gamma)
+        :param wd: working directory
+        :param iteration: if an MCMC is running, which iteration are we doing
+        :param verbose: print the progress
+        :param data: spectra to use instead of those of the line, e.g. perturbed ones
+        :return: k1s, k2s, Delta gammas and chisq of all nodes, in the order gridfd3 prints them
+        """
+        if verbose:
             print(' making in file for {}'.format(repr(self)))
-        self._make_gridfd3_infile(wd)
-        if not iteration:
+        with TIMELINE.stage('write infile', self, iteration):
+            self._make_gridfd3_infile(wd, params)
+        if self.engine == 'numpy':
+            if verbose:
+                print(' running numpy grid engine for {}'.format(repr(self)))
+            with TIMELINE.stage('numpy engine', self, iteration):
+                return self._run_grid_engine(params, data)
+        if verbose:
             print(' making master file for {}'.format(repr(self)))
-        self._make_grid_masterfile(wd)
-        if not iteration:
+        with TIMELINE.stage('write obs', self, iteration):
+            self._make_grid_masterfile(wd, data)
+        if verbose:
             print(' running gridfd3 for {}'.format(repr(self)))
-        self._run_gridfd3(wd)
-        if not iteration:
+        with TIMELINE.stage('run gridfd3', self, iteration):
+            self._run_gridfd3(wd, iteration)
+        if verbose:
             print(' saving output for {}'.format(repr(self)))
-        self._handle_gridfd3_output(wd, iteration)
+        with TIMELINE.stage('parse output', self, iteration):
+            return self._parse_gridfd3_output(wd)
+
+    def _cached_grid(self, params, wd, iteration=None, verbose=True):
+        """
+        serves the grid from the cache, evaluating only the (K1, K2) nodes it misses, in rectangular blocks
+        :param params: orbit p, t0, e, omega(, Delta gamma)
+        :param wd: working directory
+        :param iteration: if an MCMC is running, which iteration are we doing
+        :param verbose: print the progress
+        :return: k1s, k2s, Delta gammas and chisq of all nodes, in the order gridfd3 prints them
+        """
+        key, nodes, cchisq, blocks = self._cache_plan(params, iteration, verbose)
+        for span, block in blocks:
+            self._cache_fill(key, cchisq, span, block._grid(params, wd, iteration, verbose), iteration)
+        # the in file of the full grid, which holds the dof for the analysis
+        self._make_gridfd3_infile(wd, params)
+        return nodes + (cchisq.ravel(),)
+
+    def _cache_plan(self, params, iteration=None, verbose=True):
+        """
+        looks the grid up in the cache, and splits the nodes it misses in rectangular blocks
+        :param params: orbit p, t0, e, omega(, Delta gamma)
+        :param iteration: if an MCMC is running, which iteration are we doing
+        :param verbose: print the progress
+        :return: the cache key, the k1s, k2s and Delta gammas of all nodes, the chisq cube with NaN at the missing
+        nodes, and a list of (rows and columns, line restricted to them) blocks still to be evaluated
+        """
+        k1axis = chisqstore.k_axis(self.k1s)
+        k2axis = chisqstore.k_axis(self.k2s)
+        dgrange = self._dg_range(params)
+        dgaxis = chisqstore.k_axis(dgrange)
+        shape = (len(k1axis), len(k2axis), len(dgaxis))
+        nodes = tuple(np.broadcast_to(axis, shape).ravel() for axis in
+                      (k1axis[:, None, None], k2axis[None, :, None], dgaxis[None, None, :]))
+        with TIMELINE.stage('cache lookup', self, iteration):
+            key = self.cache.key(self, params)
+            cchisq = self.cache.lookup(key, *nodes).reshape(shape)
+        missing = np.any(np.isnan(cchisq), axis=2)
+        if verbose:
+            print(' {} has {} of {} grid nodes cached'.format(repr(self), np.count_nonzero(~missing), missing.size))
+        step1 = float(self.k1s.split()[2])
+        step2 = float(self.k2s.split()[2])
+        blocks = list()
+        for r0, r1, c0, c1 in chisqcache.missing_blocks(missing):
+            # a shallow copy of this line restricted to the block, with half a step of margin against round-off
+            block = copy.copy(self)
+            block.k1s = '{} {} {}'.format(k1axis[r0], k1axis[r1] + step1 / 2, step1)
+            block.k2s = '{} {} {}'.format(k2axis[c0], k2axis[c1] + step2 / 2, step2)
+            block.dgs = dgrange
+            blocks.append(((r0, r1, c0, c1), block))
+        return key, nodes, cchisq, blocks
+
+    def _cache_fill(self, key, cchisq, span, grid, iteration=None):
+        """
+        puts an evaluated block in the chisq cube and in the cache
+        :param key: the cache key
+        :param cchisq: chisq cube of the grid
+        :param span: first row, last row, first column and last column of the block
+        :param grid: k1s, k2s, Delta gammas and chisq of the block
+        :param iteration: if an MCMC is running, which iteration are we doing
+        """
+        r0, r1, c0, c1 = span
+        bk1s, bk2s, bdgs, bchisq = grid
+        cchisq[r0:r1 + 1, c0:c1 + 1] = bchisq.reshape(r1 - r0 + 1, c1 - c0 + 1, cchisq.shape[2])
+        with TIMELINE.stage('cache update', self, iteration):
+            self.cache.update(key, bk1s, bk2s, bdgs, bchisq)
 
     def run_fd3(self, wd):
         """
@@ -156,37 +416,129 @@ class Fd3class:
         4. handle the output to speedy npz files
         :param wd: working directory
         """
-        if self.data is None or self.widedata is None:
-            self._set_spectra()
+        if self.data is None:
+            with TIMELINE.stage('load spectra', self):
+                self._set_spectra()
         if self.no_used_spectra < 1:
             print(' {} has no spectral data, skipping'.format(repr(self)))
             return
         print(' making in file for {}'.format(repr(self)))
-        self._make_fd3_infile(wd)
+        with TIMELINE.stage('write infile', self):
+            self._make_fd3_infile(wd)
         print(' making master file for {}'.format(repr(self)))
-        self._make_fd3_masterfile(wd)
+        with TIMELINE.stage('write obs', self):
+            self._make_fd3_masterfile(wd)
         print(' running fd3 for {}'.format(repr(self)))
-        self._run_fd3(wd)
+        with TIMELINE.stage('run fd3', self):
+            self._run_fd3(wd)
+        with TIMELINE.stage('handle fd3 output', self):
+            self._handle_fd3_output(wd)
+
+    def run_fd3_windowed(self, wd, maxbins=8000, overlap=400, workers=None):
+        """
+        do the minimization of a wide range in overlapping ln(lambda) windows, each disentangled by its own fd3
+        process in parallel. The component spectra of the windows are cross-faded over the central half of their
+        overlaps, and handled as those of a single run. A range of at most maxbins bins is run by a single fd3.
+        :param wd: working directory
+        :param maxbins: maximal number of bins of a window, which bounds the memory of every fd3 process
+        :param overlap: number of bins neighbouring windows share, which should be well above the largest rv shift
+        :param workers: number of simultaneous fd3 processes, the number of cpus by default
+        """
+        if self.data is None:
+            self._set_spectra()
+        if self.no_used_spectra < 1:
+            print(' {} has no spectral data, skipping'.format(repr(self)))
+            return
+        workers = workers or os.cpu_count()
+        step = self.widelogbase[1] - self.widelogbase[0]
+        lo, hi = self.wideloglimits
+        nbins = int((hi - lo) / step)
+        if nbins <= maxbins:
+            self.run_fd3(wd)
+            return
+        # as few windows as maxbins allows, the pool bounds how many run at once
+        nwin = int(np.ceil((nbins - overlap) / (maxbins - overlap)))
+        ov = overlap * step
+        width = (hi - lo - ov) / nwin
+        windows = [self._window(ii, lo + ii * width, lo + (ii + 1) * width + ov) for ii in range(nwin)]
+        print(' running fd3 for {} in {} windows of {} bins'.format(repr(self), nwin, int((width + ov) / step)))
+        with cf.ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda win: win._run_fd3_window(wd), windows))
+        # stitch the model spectra of the windows
+        grid = self.widelogbase[(self.widelogbase >= lo) & (self.widelogbase <= hi)]
+        stitched = np.zeros((4 if self.tl else 3, len(grid)))
+        wsum = np.zeros(len(grid))
+        for ii, win in enumerate(windows):
+            x = np.loadtxt(wd + '/products{}.mod'.format(repr(win))).T
+            w = crossfade_weights(grid, *win.wideloglimits, ov if ii > 0 else 0, ov if ii < nwin - 1 else 0)
+            for k in range(1, len(x)):
+                stitched[k] += w * np.interp(grid, x[0], x[k])
+            wsum += w
+        stitched[0] = grid
+        stitched = stitched[:, wsum > 0]
+        stitched[1:] /= wsum[wsum > 0]
+        np.savetxt(wd + '/products{}.mod'.format(repr(self)), stitched.T, fmt='%15.8E')
         self._handle_fd3_output(wd)
 
-    def _make_gridfd3_infile(self, wd):
+    def _window(self, ii, lo, hi):
+        # a shallow copy of this line restricted to one ln(lambda) window, sharing its spectra
+        win = copy.copy(self)
+        win.name = '{}_w{}'.format(self.name, ii)
+        win.wideloglimits = np.array([lo, hi])
+        pad = self.edgepoints * (self.widelogbase[1] - self.widelogbase[0])
+        inds = (self.widelogbase >= lo - pad) & (self.widelogbase <= hi + pad)
+        win.widelogbase = self.widelogbase[inds]
+        win.widedata = self.widedata[:, inds]
+        return win
+
+    def _run_fd3_window(self, wd):
+        with TIMELINE.stage('write infile', self):
+            self._make_fd3_infile(wd)
+        with TIMELINE.stage('write obs', self):
+            self._make_fd3_masterfile(wd)
+        with TIMELINE.stage('run fd3', self):
+            self._run_fd3(wd)
+
+    def _iteration_data(self, iteration=None, store=None, out=None):
+        # the perturbed spectra of an iteration, drawn reproducibly if the store has a seed, into out if given. None
+        # if not perturbed
+        if not self.ps:
+            return None
+        return self._perturb_spectra(None if store is None else store.rng(iteration, repr(self)), out)
+
+    def _iteration_orbit(self, iteration=None, store=None):
+        if self.po and store is not None and store.orbits is not None:
+            # the pre-drawn realization of this iteration, shared by all lines
+            return store.orbits[iteration - 1]
+        elif self.po:
+            return self._perturb_orbit()
+        return self.orb
+
+    def _make_gridfd3_infile(self, wd, params):
         with open(wd + '/in{}'.format(repr(self)), 'w') as infile:
-            self.__common_infile(wd, infile)
-            if self.po:
-                params = self._perturb_orbit()
-            else:
-                params = self.orb
-            # write the A-B orbital params
-            infile.write(
-                '{} {} {} {} 0 {}\n'.format(params[0], params[1], params[2], params[3], params[4]))  # 0 is the for the precession of the omega
-            # write rv ranges and step size
-            infile.write('{}\n'.format(self.k1s))
-            infile.write('{}\n'.format(self.k2s))
-            infile.write('{}\n'.format(self.dof))
-
-    def __common_infile(self, wd, file):
+            self._write_gridfd3_infile(infile, wd + '/{}'.format(repr(self)), params)
+
+    def _write_gridfd3_infile(self, file, root, params):
+        # root is the master file without .obs, or 'stdin' if the master file is streamed ahead of the rest
+        self.__common_infile(root, file)
+        # write the A-B orbital params
+        file.write(
+            '{} {} {} {} 0\n'.format(params[0], params[1], params[2], params[3]))  # 0 is the for the precession of the omega
+        # write rv ranges and step size
+        file.write('{}\n'.format(self.k1s))
+        file.write('{}\n'.format(self.k2s))
+        file.write('{}\n'.format(self._dg_range(params)))
+        file.write('{}\n'.format(self.dof))
+
+    def _dg_range(self, params):
+        if self.dgs is not None:
+            return self.dgs
+        dg = params[4] if len(params) > 4 else 0
+        return '{} {} 1'.format(dg, dg)
+
+    def __common_infile(self, root, file):
         # write first line
-        file.write(wd + "/{} ".format(repr(self)))
+        file.write(root + " ")
         file.write("{} ".format(self.loglimits[0]))
         file.write("{} ".format(self.loglimits[1]))
         # write the star switches
@@ -206,81 +558,155 @@ class Fd3class:
 
     def _make_fd3_infile(self, wd):
         with open(wd + '/in{}'.format(repr(self)), 'w') as infile:
-            # write first line
-            infile.write(wd + "/{}.obs ".format(repr(self)))
-            infile.write("{} ".format(self.wideloglimits[0]))
-            infile.write("{} ".format(self.wideloglimits[1]))
-            infile.write("{} ".format(wd + '/products{} '.format(repr(self))))
+            self._write_fd3_infile(infile, wd + "/{}.obs".format(repr(self)), wd)
+
+    def _write_fd3_infile(self, file, obsfile, wd):
+        # obsfile is the master file, or 'stdin' if it is streamed ahead of the rest
+        # write first line
+        file.write(obsfile + " ")
+        file.write("{} ".format(self.wideloglimits[0]))
+        file.write("{} ".format(self.wideloglimits[1]))
+        file.write("{} ".format(wd + '/products{} '.format(repr(self))))
+        if self.tl:
+            file.write("1 1 1 \n")
+        else:
+            file.write("1 1 0 \n")
+
+        # write observation data
+        for j in range(self.no_used_spectra):
             if self.tl:
-                infile.write("1 1 1 \n")
+                file.write(str(self.mjds[j]) + ' 0 {} {} {} {}\n'.format(self.noises[j], self.lfs[0], self.lfs[1],
+                                                                        self.lfs[2]))  # correction, noise, lfA, lfB, lfC
             else:
-                infile.write("1 1 0 \n")
-
-            # write observation data
-            for j in range(self.no_used_spectra):
-                if self.tl:
-                    infile.write(str(self.mjds[j]) + ' 0 {} {} {} {}\n'.format(self.noises[j], self.lfs[0], self.lfs[1],
-                                                                               self.lfs[2]))  # correction, noise, lfA, lfB, lfC
-                else:
-                    infile.write(str(self.mjds[j]) + ' 0 {} {} {} \n'.format(self.noises[j], self.lfs[0], self.lfs[1]))
-            # write the AB-C orbital params
-            infile.write('1 0   1 0   0 0   0 0   0 0   0 0\n\n')
-            # write the A-B orbital params
-            infile.write(
-                '{} 0 {} 0 {} 0 {} 0 {} 0 {} 0 0 0 \n\n'.format(self.orb[0], self.orb[1], self.orb[2], self.orb[3], self.orb[4], self.orb[5]))
-
-    def _make_grid_masterfile(self, wd):
+                file.write(str(self.mjds[j]) + ' 0 {} {} {} \n'.format(self.noises[j], self.lfs[0], self.lfs[1]))
+        # write the AB-C orbital params
+        file.write('1 0   1 0   0 0   0 0   0 0   0 0\n\n')
+        # write the A-B orbital params
+        file.write(
+            '{} 0 {} 0 {} 0 {} 0 {} 0 {} 0 0 0 \n\n'.format(self.orb[0], self.orb[1], self.orb[2], self.orb[3], self.orb[4], self.orb[5]))
+
+    def _make_grid_masterfile(self, wd, data=None):
         with open(wd + '/{}.obs'.format(repr(self)), 'w') as obsfile:
-            obsfile.write('# {} X {} \n'.format(self.no_used_spectra + 1, len(self.logbase)))
-            master = [self.logbase]
-            if self.ps:
-                data = self._perturb_spectra()
-            else:
-                data = self.data
-            for ii in range(len(data)):
-                master.append(data[ii])
-            towrite = np.array(master).T
-            for ii in range(len(towrite)):
-                obsfile.write(" ".join([str(num) for num in towrite[ii]]))
-                obsfile.write('\n')
+            for chunk in self._grid_master_chunks(data):
+                obsfile.write(chunk)
+
+    def _grid_master_chunks(self, data=None, rows=1000):
+        if data is None:
+            data = self._perturb_spectra() if self.ps else self.data
+        return self._master_chunks(self.logbase, data, rows)
 
     def _make_fd3_masterfile(self, wd):
         with open(wd + '/{}.obs'.format(repr(self)), 'w') as obsfile:
-            obsfile.write('# {} X {} \n'.format(self.no_used_spectra + 1, len(self.widelogbase)))
-            master = [self.widelogbase]
-            for ii in range(len(self.widedata)):
-                master.append(self.widedata[ii])
-            towrite = np.array(master).T
-            for ii in range(len(towrite)):
-                obsfile.write(" ".join([str(num) for num in towrite[ii]]))
-                obsfile.write('\n')
-
-    def _run_gridfd3(self, wd):
-        with open(wd + '/in{}'.format(repr(self))) as inpipe, open(wd + '/out{}'.format(repr(self)), 'w') as outpipe:
-            sp.run(['./bin/gridfd3'], stdin=inpipe, stdout=outpipe)
+            for chunk in self._fd3_master_chunks():
+                obsfile.write(chunk)
+
+    def _fd3_master_chunks(self, rows=1000):
+        return self._master_chunks(self.widelogbase, self.widedata, rows)
+
+    @staticmethod
+    def _master_chunks(base, data, rows=1000):
+        """
+        the master file of the engines, the ln(lambda) base and the spectra as columns, as text in blocks of rows
+        :param base: ln(lambda) base
+        :param data: spectra on base
+        :param rows: number of rows per block
+        :return: generator of text blocks
+        """
+        yield '# {} X {} \n'.format(len(data) + 1, len(base))
+        # transposed block by block, so no float64 copy of all spectra is made
+        for start in range(0, len(base), rows):
+            block = np.column_stack((base[start:start + rows], np.transpose(data[:, start:start + rows])))
+            yield ''.join(" ".join([str(num) for num in row]) + '\n' for row in block)
+
+    def _run_gridfd3(self, wd, iteration=None):
+        self._run_engine('./bin/gridfd3', wd, iteration)
 
     def _run_fd3(self, wd):
+        self._run_engine('./bin/fd3', wd)
+
+    def _engine_env(self):
+        # the environment of the compiled engines, None to inherit that of this process
+        env = dict()
+        if TIMELINE.engine_counters:
+            env['FD3_PERF'] = '1'
+        if self.smoothfft:
+            env['FD3_FFT_TAPER'] = str(self.edgepoints)
+        return dict(os.environ, **env) if env else None
+
+    def _run_engine(self, executable, wd, iteration=None):
         with open(wd + '/in{}'.format(repr(self))) as inpipe, open(wd + '/out{}'.format(repr(self)), 'w') as outpipe:
-            sp.run(['./bin/fd3'], stdin=inpipe, stdout=outpipe)
-
-    def _handle_gridfd3_output(self, wd, iteration):
+            if not TIMELINE.engine_counters:
+                sp.run([executable], stdin=inpipe, stdout=outpipe, env=self._engine_env())
+                return
+            done = sp.run([executable], stdin=inpipe, stdout=outpipe, stderr=sp.PIPE, text=True,
+                          env=self._engine_env())
+        counters = timing.parse_perf_block(done.stderr)
+        if counters is not None:
+            TIMELINE.record_counters(counters, self, iteration)
+
+    def _run_grid_engine(self, params, data=None):
+        if data is None and self.ps:
+            data = self._perturb_spectra()
+        engine = gridengine.GridEngine.from_fd3class(self, data)
+        k1axis = chisqstore.k_axis(self.k1s)
+        k2axis = chisqstore.k_axis(self.k2s)
+        dgaxis = chisqstore.k_axis(self._dg_range(params))
+        cchisq = engine.cube(k1axis, k2axis, dgaxis, params)
+        # flatten in the order gridfd3 prints its grid
+        return (np.repeat(k1axis, len(k2axis) * len(dgaxis)), np.tile(np.repeat(k2axis, len(dgaxis)), len(k1axis)),
+                np.tile(dgaxis, len(k1axis) * len(k2axis)), cchisq.ravel())
+
+    def chisq_grid(self, params, wd, perturb=False):
+        """
+        evaluates the chisq grid of this line for one orbit with the selected engine, without saving it
+        :param params: orbit p, t0, e, omega(, Delta gamma)
+        :param wd: working directory for the files of the compiled engine
+        :param perturb: evaluate freshly perturbed spectra if the line perturbs its spectra, instead of the observed
+        spectra. Off by default, so repeated evaluations at the same orbit agree
+        :return: chisq grid of shape (K1s, K2s), or (K1s, K2s, Delta gammas) if a Delta gamma range is set
+        """
+        if self.data is None:
+            self._set_spectra()
+        data = self._perturb_spectra() if perturb and self.ps else self.data
+        if self.cache is not None and not self.ps:
+            _, _, _, cchisq = self._cached_grid(params, wd, verbose=False)
+        elif self.engine == 'numpy':
+            _, _, _, cchisq = self._run_grid_engine(params, data)
+        else:
+            self._make_gridfd3_infile(wd, params)
+            self._make_grid_masterfile(wd, data)
+            self._run_gridfd3(wd)
+            _, _, _, cchisq = self._parse_gridfd3_output(wd)
+        cchisq = cchisq.reshape(len(chisqstore.k_axis(self.k1s)), len(chisqstore.k_axis(self.k2s)), -1)
+        return cchisq if self.dgs is not None else cchisq[:, :, 0]
+
+    def _parse_gridfd3_output(self, wd):
         with open(wd + '/out{}'.format(repr(self))) as f:
             llines = f.readlines()
             llines.pop(0)
             kk1s = np.zeros(len(llines))
             kk2s = np.zeros(len(llines))
+            ddgs = np.zeros(len(llines))
             cchisq = np.zeros(len(llines))
             for j in range(len(llines)):
-                lline = re.split('[ ]|(?![\d.])', llines[j])
+                lline = llines[j].split()
                 kk1s[j] = np.float64(lline[0])
                 kk2s[j] = np.float64(lline[1])
-                cchisq[j] = np.float64(lline[2])
+                ddgs[j] = np.float64(lline[2])
+                cchisq[j] = np.float64(lline[3])
+        return kk1s, kk2s, ddgs, cchisq
+
+    def _save_gridfd3_output(self, wd, iteration, store, kk1s, kk2s, ddgs, cchisq):
+        if store is not None:
+            store.write(iteration, repr(self), cchisq)
+            return
         chisqdir = wd + '/chisqs'
         if not os.path.isdir(chisqdir):
             os.mkdir(chisqdir)
-        np.savez(chisqdir + '/chisq{}{}'.format(repr(self), iteration if iteration is not None else ''), k1s=kk1s, k2s=kk2s, chisq=cchisq)
+        np.savez(chisqdir + '/chisq{}{}'.format(repr(self), iteration if iteration is not None else ''), k1s=kk1s, k2s=kk2s, dgs=ddgs, chisq=cchisq)
 
     def _handle_fd3_output(self, wd):
+        import scipy.interpolate as spint
         x = np.loadtxt(wd + '/products{}.mod'.format(repr(self))).T
         x[0] = np.exp(x[0])
         x[1] *= self.lfs[0]
@@ -309,60 +735,67 @@ class Fd3class:
         np.savetxt(wd + '/{}primary_norm.txt'.format(repr(self)), np.array([x[0], x1 / self.lfs[0] + 1, errorp * np.ones(len(x[1]))]).T)
         np.savetxt(wd + '/{}secondary_norm.txt'.format(repr(self)), np.array([x[0], x2 / self.lfs[1] + 1, errors * np.ones(len(x[2]))]).T)
 
-    def recombine_and_renorm(self):
-        avres = np.zeros(self.no_used_spectra)
-        for i in range(self.no_used_spectra):
-            res = self._get_residual_and_norm(i)
-            avres[i] = np.average(res)
+    def recombine_and_renorm(self, plot=False):
+        """
+        reconstructs every observed spectrum from the separated components, and removes a linear trend in the residual
+        from the observed spectra. All epochs are done at once on the log wavelength grid.
+        :param plot: plot the reconstruction of the middle spectrum
+        """
+        with TIMELINE.stage('renormalize', self):
+            res = self._get_residuals_and_norm(plot)
+        avres = np.average(res, axis=1)
         print('the std of the average residuals of all {} spectra is {}'.format(self.no_used_spectra, np.std(avres)))
 
-    def _get_residual_and_norm(self, i):
-        phase = np.remainder((self.mjds[i] - self.orb[1]) / self.orb[0], 1)
-        t = self.true_anom(phase)
-        rvk1 = - self.orb[4] * (np.cos(t + np.pi / 180 * self.orb[3]) + self.orb[2] * np.cos(np.pi / 180 * self.orb[3]))
-        rvk2 = self.orb[5] * (np.cos(t + np.pi / 180 * self.orb[3]) + self.orb[2] * np.cos(np.pi / 180 * self.orb[3]))
-        shifted_primary_spline = spint.splrep(doppler_shift(self.prim[:, 0], rvk1), self.prim[:, 1])
-        shifted_secondary_spline = spint.splrep(doppler_shift(self.sec[:, 0], rvk2), self.sec[:, 1])
-        resamp_shifted_primary = spint.splev(self.linbase, shifted_primary_spline)
-        resamp_shifted_secondary = spint.splev(self.linbase, shifted_secondary_spline)
-        resamp_composite = spint.splev(self.linbase, spint.splrep(np.exp(self.logbase), self.data[i, :]))
-        reconstructees = self.lfs[0] * resamp_shifted_primary + self.lfs[1] * resamp_shifted_secondary
-        residual = resamp_composite - reconstructees
-        ll = len(residual)
-        if i == np.int(self.no_used_spectra / 2):
-            print(i)
+    def _get_residuals_and_norm(self, plot=False):
+        import scipy.interpolate as spint
+        c = 299792.458
+        t = self.true_anom(kepler.phase(self.mjds, self.orb[0], self.orb[1]))
+        rv = np.cos(t + np.pi / 180 * self.orb[3]) + self.orb[2] * np.cos(np.pi / 180 * self.orb[3])
+        rvk1 = - self.orb[4] * rv
+        rvk2 = self.orb[5] * rv
+        # a doppler shift is a constant offset in ln(lambda), so both components are interpolated by one spline each,
+        # evaluated at the shifted log grid of all epochs in a single call
+        shift1 = - np.log(1 - rvk1 / c)
+        shift2 = - np.log(1 - rvk2 / c)
+        primary_spline = spint.splrep(np.log(self.prim[:, 0]), self.prim[:, 1])
+        secondary_spline = spint.splrep(np.log(self.sec[:, 0]), self.sec[:, 1])
+        shifted_primary = spint.splev((self.logbase[None, :] - shift1[:, None]).ravel(), primary_spline)
+        shifted_primary = shifted_primary.reshape(self.data.shape)
+        shifted_secondary = spint.splev((self.logbase[None, :] - shift2[:, None]).ravel(), secondary_spline)
+        shifted_secondary = shifted_secondary.reshape(self.data.shape)
+        reconstructees = self.lfs[0] * shifted_primary + self.lfs[1] * shifted_secondary
+        residual = self.data - reconstructees
+        ll = residual.shape[1]
+        if plot:
+            import matplotlib.pyplot as plt
+            i = self.no_used_spectra // 2
+            linbase = np.exp(self.logbase)
             plt.title('k2 = {}'.format(self.orb[5]))
-            plt.plot(self.linbase, reconstructees, label='reconstruction')
-            plt.plot(self.linbase, resamp_shifted_primary, label='primary')
-            plt.plot(self.linbase, resamp_shifted_secondary, label='secondary')
-            plt.plot(self.linbase, resamp_composite, label='composite')
+            plt.plot(linbase, reconstructees[i], label='reconstruction')
+            plt.plot(linbase, shifted_primary[i], label='primary')
+            plt.plot(linbase, shifted_secondary[i], label='secondary')
+            plt.plot(linbase, self.data[i], label='composite')
             plt.legend()
             plt.show()
 
-        def corr(x):
-            yleft = np.average(residual[:int(np.floor(0.1 * ll))])
-            yright = np.average(residual[int(np.ceil(0.9 * ll)):])
-            xleft = self.linbase[int(np.floor(0.05 * ll))]
-            xright = self.linbase[int(np.ceil(0.95 * ll))]
-            return yleft + (yright - yleft) / (xright - xleft) * (x - xleft)
-
-        self.data[i, :] -= corr(np.exp(self.logbase))
-        self.widedata[i, :] -= corr(np.exp(self.widelogbase))
-        # print('spectrum at index', i, 'has an average residual of', np.average(residual))
-        # if i == 50:
-        #     plt.plot(self.linbase, residual + 1, 'b')
-        #     plt.plot(self.linbase, resamp_composite, 'orange')
-        #     plt.plot(self.linbase, resamp_shifted_primary, 'r--')
-        #     plt.plot(self.linbase, resamp_shifted_secondary, 'r.-')
-        #     plt.plot(self.linbase, reconstructees, 'k')
-        #     plt.plot(self.linbase, corr(self.linbase) + 1, 'yellow')
-        #     plt.plot(np.exp(self.logbase), self.data[i, :], 'g--')
-        # # plt.plot(np.exp(self.widelogbase), self.widedata[i, :], 'g.-')
-        # # plt.plot(self.prim[:, 0], self.prim[:, 1])
-        # # plt.plot(self.linbase, residual)
+        # linear correction through the average residuals at both edges, for all spectra at once
+        yleft = np.average(residual[:, :int(np.floor(0.1 * ll))], axis=1)
+        yright = np.average(residual[:, int(np.ceil(0.9 * ll)):], axis=1)
+        xleft = np.exp(self.logbase[int(np.floor(0.05 * ll))])
+        xright = np.exp(self.logbase[int(np.ceil(0.95 * ll))])
+        slope = (yright - yleft) / (xright - xleft)
+        self.data -= yleft[:, None] + slope[:, None] * (np.exp(self.logbase)[None, :] - xleft)
+        self.widedata -= yleft[:, None] + slope[:, None] * (np.exp(self.widelogbase)[None, :] - xleft)
         return residual
 
-    def plot_fd3_results(self, ax=plt.gca(), offset=0):
+    def plot_fd3_results(self, ax=None, offset=0):
+        """
+        :param ax: axis to plot on, the current axis by default
+        :param offset: offset of the primary
+        """
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
         ax.plot(self.sec[:, 0], self.sec[:, 1], 'r', label='secondary')
         ax.plot(self.prim[:, 0], self.prim[:, 1] + offset, 'b', label='primary + {}'.format(offset))
         ax.grid()
@@ -372,12 +805,20 @@ class Fd3class:
 class GridFd3MCThread(threading.Thread):
     """
     defines an MCMC thread that runs its containing fd3gridlines for some specified number of iterations.
+    If a ChisqStore is given, the thread writes iterations first + 1 up to first + iterations of it.
+    If a stop event is given, the thread quits early once it is set.
     """
 
-    def __init__(self, fd3folder, threadno, iterations, fd3gridlines: typing.List[Fd3class]):
-        super().__init__()
+    def __init__(self, fd3folder, threadno, iterations, fd3gridlines: typing.List[Fd3class], store=None, first=0,
+                 stop: threading.Event = None):
+        super().__init__(name='gridfd3 MC thread {}'.format(threadno))
         self.threadno = threadno
+        self.store = store
+        self.first = first
+        self.stop = stop
         self.wd = fd3folder + "/thread" + str(threadno)
+        # the perturbed spectra of every line, reused from iteration to iteration
+        self.buffers = dict()
         self.fd3gridlines = fd3gridlines
         self.iterations = iterations
         self.threadtime = 0
@@ -405,11 +846,14 @@ class GridFd3MCThread(threading.Thread):
         Run this thread for its specified number of iterations.
         """
         for ii in range(self.iterations):
+            if self.stop is not None and self.stop.is_set():
+                print('Thread {} stopping after {} iterations.'.format(self.threadno, ii))
+                break
             self.threadtime = time.time()
             # execute fd3gridline runs
             print('Thread {} running gridfd3 iteration {}...'.format(self.threadno, ii + 1))
             for ffd3line in self.fd3gridlines:
-                ffd3line.run_gridfd3(self.wd, ii + 1)
+                ffd3line.run_gridfd3(self.wd, self.first + ii + 1, self.store, self.buffers)
             print('estimated time to completion of thread {}: {}h'.format(self.threadno,
                                                                           (time.time() - self.threadtime) * (self.iterations - ii - 1) / 3600))
 
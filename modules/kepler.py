@@ -0,0 +1,101 @@
+"""
+Vectorized solution of Kepler's equation, the Python counterpart of src/kepler.c.
+All functions broadcast over their arguments, so arrays of epochs can be combined with arrays of orbit realizations,
+e.g. phases of shape (M,) with eccentricities of shape (R, 1) give anomalies of shape (R, M).
+"""
+import numpy as np
+
+
+def ecc_anom(mean_anom, e, tol=1e-12, max_iter=20):
+    """
+    solves Kepler's equation E - e sin(E) = mean_anom with Danby's fourth order iteration, which reuses one sin and
+    one cos per step, starting from Danby's guess E0 = mu + 0.85 e sign(sin(mu)) that converges for all 0 <= e < 1
+    :param mean_anom: mean anomaly (rad)
+    :param e: eccentricity
+    :param tol: absolute tolerance on E (rad). Every anomaly is iterated until its correction is below sqrt(tol), after
+    which the fourth order convergence leaves an error well below tol
+    :param max_iter: maximal number of iterations
+    :return: eccentric anomaly (rad), in [0, 2pi)
+    """
+    # reduce to [-pi, pi), where the starting guess is valid and sin(mu) has the sign of mu. Through floor, which is
+    # much faster than np.remainder
+    red = np.asarray(mean_anom, dtype=np.float64)
+    red = red - 2 * np.pi * np.floor((red + np.pi) / (2 * np.pi))
+    red, e = np.broadcast_arrays(red, np.asarray(e, dtype=np.float64))
+    shape = red.shape
+    red, e = red.ravel(), e.ravel()
+    big = red + 0.85 * e * np.sign(red)
+    # only the anomalies that have not converged yet are iterated. Hardly any converge in the first step, most in the
+    # second and the rest in one or two more
+    todo = None
+    for it in range(max_iter):
+        sub = big if todo is None else big[todo]
+        esinb = np.sin(sub)
+        esinb *= e
+        ecosb = np.cos(sub)
+        ecosb *= e
+        f = sub - esinb
+        f -= red
+        df = 1 - ecosb
+        step = f / df
+        step *= esinb
+        step *= -0.5
+        step += df
+        np.divide(f, step, out=step)
+        corr = step * step
+        corr *= ecosb / 6
+        corr += df
+        step *= esinb
+        step *= 0.5
+        np.subtract(corr, step, out=step)
+        np.divide(f, step, out=step)
+        if todo is None:
+            big -= step
+        else:
+            big[todo] = sub - step
+        if it == 0:
+            continue
+        going = np.abs(step) >= np.sqrt(tol)
+        if not going.any():
+            break
+        todo = np.flatnonzero(going) if todo is None else todo[going]
+        red, e = red[going], e[going]
+    # the solutions lie in [-pi, pi]
+    return np.where(big < 0, big + 2 * np.pi, big).reshape(shape)
+
+
+def true_anom_of_ecc(big, e):
+    """
+    :param big: eccentric anomaly (rad)
+    :param e: eccentricity
+    :return: true anomaly (rad), in (-pi, pi]
+    """
+    return 2 * np.arctan(np.sqrt((1 + e) / (1 - e)) * np.tan(big / 2))
+
+
+def ecc_anom_of_phase(ph, e):
+    """
+    :param ph: orbital phase(s), counted from periastron
+    :param e: eccentricity
+    :return: eccentric anomaly (rad), in [0, 2pi)
+    """
+    return ecc_anom(2 * np.pi * np.remainder(ph, 1), e)
+
+
+def true_anom(ph, e):
+    """
+    :param ph: orbital phase(s), counted from periastron
+    :param e: eccentricity
+    :return: true anomaly (rad), in (-pi, pi]
+    """
+    return true_anom_of_ecc(ecc_anom_of_phase(ph, e), e)
+
+
+def phase(t, p, t0):
+    """
+    :param t: time(s) (MJD)
+    :param p: period (d)
+    :param t0: time of periastron passage (MJD)
+    :return: orbital phase(s) in [0, 1)
+    """
+    return np.remainder((np.asarray(t) - t0) / p, 1)
@@ -0,0 +1,97 @@
+"""
+Multi-start Nelder-Mead optimization of the tight orbit (p, t0, e, omega, K1, K2) on the fd3sep merit function of one
+or more lines, with the starts spread over a Latin hypercube around the initial orbit and run in parallel threads
+"""
+import concurrent.futures as cf
+import os
+
+import numpy as np
+import scipy.optimize as spopt
+
+import modules.gridengine as gridengine
+
+
+def latin_hypercube(n, dim, rng):
+    """
+    :param n: number of points
+    :param dim: number of dimensions
+    :param rng: numpy random generator
+    :return: points in [-1, 1]^dim, shape (n, dim), with exactly one point in each of the n slices of every dimension
+    """
+    u = (np.argsort(rng.random((dim, n)), axis=1).T + rng.random((n, dim))) / n
+    return 2 * u - 1
+
+
+class OrbitMerit:
+    """
+    chisq of an orbit (p, t0, e, omega, K1, K2) summed over lines, for the free parameters only. The Fourier transformed
+    observations of every line are computed once and shared by all threads.
+    """
+
+    def __init__(self, fd3lines, orbit, steps):
+        """
+        :param fd3lines: Fd3class objects of the lines, with their spectra loaded
+        :param orbit: initial orbit p, t0, e, omega, K1, K2
+        :param steps: step sizes of the parameters, 0 for fixed ones
+        """
+        self.engines = [gridengine.GridEngine.from_fd3class(fd3line) for fd3line in fd3lines
+                        if fd3line.no_used_spectra > 0]
+        self.orbit = np.array(orbit[:6], dtype=np.float64)
+        self.steps = np.array(steps[:6], dtype=np.float64)
+        self.free = np.flatnonzero(self.steps)
+
+    def __repr__(self):
+        return 'OrbitMerit over {} lines, free parameters {}'.format(len(self.engines), list(self.free))
+
+    def full(self, x):
+        """
+        :param x: values of the free parameters
+        :return: the full orbit
+        """
+        orbit = np.copy(self.orbit)
+        orbit[self.free] = x
+        return orbit
+
+    def __call__(self, x):
+        orbit = self.full(x)
+        if not 0 <= orbit[2] < 1 or orbit[0] <= 0:
+            return np.inf
+        return sum(engine.merit_orbits(orbit[4:5], orbit[5:6], orbit[None, :4])[0] for engine in self.engines)
+
+
+def multistart_simplex(fd3lines, orbit, steps, starts=8, workers=None, seed=None, xatol=1e-4, fatol=1e-6,
+                       maxiter=2000):
+    """
+    :param fd3lines: Fd3class objects of the lines, with their spectra loaded
+    :param orbit: initial orbit p, t0, e, omega, K1, K2
+    :param steps: step sizes of the parameters, 0 for fixed ones. The starts are spread over orbit +- steps, and every
+    simplex starts with these step sizes
+    :param starts: number of starts
+    :param workers: number of threads, the number of cpus by default
+    :param seed: seed of the Latin hypercube
+    :param xatol: absolute tolerance on the free parameters for convergence
+    :param fatol: absolute tolerance on the chisq for convergence
+    :param maxiter: maximal number of iterations of every simplex
+    :return: best orbit, its chisq, the spread (std) of the converged orbits, and all (orbit, chisq, converged) results
+    """
+    merit = OrbitMerit(fd3lines, orbit, steps)
+    x0s = merit.orbit[merit.free] + latin_hypercube(starts, len(merit.free), np.random.default_rng(seed)) * \
+        merit.steps[merit.free]
+    x0s[0] = merit.orbit[merit.free]
+
+    def run(x0):
+        simplex = np.vstack((x0, x0 + np.diag(merit.steps[merit.free])))
+        return spopt.minimize(merit, x0, method='Nelder-Mead', options=dict(
+            initial_simplex=simplex, xatol=xatol, fatol=fatol, maxiter=maxiter))
+
+    with cf.ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        results = list(pool.map(run, x0s))
+    orbits = np.array([merit.full(res.x) for res in results])
+    chisqs = np.array([res.fun for res in results])
+    converged = np.array([res.success for res in results])
+    best = np.argmin(chisqs)
+    spread = np.std(orbits[converged], axis=0) if np.any(converged) else np.full(len(merit.orbit), np.nan)
+    print('{} of {} simplex starts converged, best chisq {}'.format(np.count_nonzero(converged), starts, chisqs[best]))
+    print('best orbit: {}'.format(orbits[best]))
+    print('spread of the converged orbits: {}'.format(spread))
+    return orbits[best], chisqs[best], spread, list(zip(orbits, chisqs, converged))
@@ -0,0 +1,91 @@
+"""
+Linear propagation of the orbit uncertainties into K1 and K2 (delta method), as a cheap alternative to a full
+orbit-perturbation Monte Carlo
+"""
+import numpy as np
+
+import modules.chisqstore as chisqstore
+import modules.gridfd3classes as fd3classes
+
+
+def refine_minimum(kk1s, kk2s, cchisq):
+    """
+    finds the minimum of a chisq grid between the grid nodes, from a quadratic fitted to the 3x3 nodes around the
+    grid minimum. Falls back to the grid minimum at the edge of the grid or if the quadratic has no minimum.
+    :param kk1s: k1 axis
+    :param kk2s: k2 axis
+    :param cchisq: chisq grid
+    :return: k1, k2 of the minimum
+    """
+    i, j = np.unravel_index(np.argmin(cchisq), cchisq.shape)
+    if i in (0, len(kk1s) - 1) or j in (0, len(kk2s) - 1):
+        return kk1s[i], kk2s[j]
+    x, y = np.meshgrid(kk1s[i - 1:i + 2] - kk1s[i], kk2s[j - 1:j + 2] - kk2s[j], indexing='ij')
+    x, y, z = x.ravel(), y.ravel(), cchisq[i - 1:i + 2, j - 1:j + 2].ravel()
+    (_, b1, b2, c11, c12, c22), _, _, _ = np.linalg.lstsq(np.array([np.ones(9), x, y, x * x, x * y, y * y]).T, z,
+                                                           rcond=None)
+    hess = np.array([[2 * c11, c12], [c12, 2 * c22]])
+    if np.any(np.linalg.eigvalsh(hess) <= 0):
+        return kk1s[i], kk2s[j]
+    dk1, dk2 = np.linalg.solve(hess, [-b1, -b2])
+    # a minimum outside the neighbourhood means the quadratic is not trustworthy
+    if abs(dk1) > abs(kk1s[i + 1] - kk1s[i]) or abs(dk2) > abs(kk2s[j + 1] - kk2s[j]):
+        return kk1s[i], kk2s[j]
+    return kk1s[i] + dk1, kk2s[j] + dk2
+
+
+def best_fit(fd3lines, params, wd):
+    """
+    :param fd3lines: Fd3class objects of the lines
+    :param params: orbit
+    :param wd: working directory for the engine runs
+    :return: refined k1, k2 of the minimum of the chisq summed over all lines, on the observed spectra even if the
+    lines perturb them, so the finite differences are not drowned in spectral noise. Lines with a Delta gamma range are
+    minimized over Delta gamma first
+    """
+    lines = [fd3line for fd3line in fd3lines if fd3line.no_used_spectra > 0]
+    total = np.sum([fd3line.chisq_grid(params, wd) for fd3line in lines], axis=0)
+    if total.ndim == 3:
+        total = np.min(total, axis=2)
+    return np.array(refine_minimum(chisqstore.k_axis(lines[0].k1s), chisqstore.k_axis(lines[0].k2s), total))
+
+
+def delta_method(fd3lines, orbit, wd, orbcovar=None, orberr=None, step=0.5, mc=20, seed=None):
+    """
+    propagates the covariance of (p, t0, e, omega) into (K1, K2) through central finite differences of the best fit,
+    which takes 9 grid runs, and compares the result to a small orbit-perturbation Monte Carlo
+    :param fd3lines: Fd3class objects of the lines, with their spectra loaded
+    :param orbit: nominal orbit
+    :param wd: working directory for the engine runs
+    :param orbcovar: covariance matrix of p, t0, e, omega
+    :param orberr: errors of p, t0, e, omega, used if no covariance matrix is given
+    :param step: finite difference step in units of the error of every element
+    :param mc: number of Monte Carlo draws to compare with, 0 to skip
+    :param seed: seed of the Monte Carlo draws
+    :return: best fit (K1, K2), the 2x4 jacobian, the propagated covariance of (K1, K2), and the Monte Carlo
+    covariance (or None)
+    """
+    if orbcovar is None:
+        orbcovar = np.diag(np.ravel(orberr) ** 2)
+    orbit = np.array(orbit, dtype=np.float64)
+    best = best_fit(fd3lines, orbit, wd)
+    jac = np.zeros((2, 4))
+    for i in range(4):
+        h = step * np.sqrt(orbcovar[i, i])
+        plus, minus = np.copy(orbit), np.copy(orbit)
+        plus[i] += h
+        minus[i] -= h
+        jac[:, i] = (best_fit(fd3lines, plus, wd) - best_fit(fd3lines, minus, wd)) / (2 * h)
+    kcovar = jac @ orbcovar @ jac.T
+    print('best fit K1, K2: {}, {}'.format(*best))
+    print('propagated errors K1, K2: {}, {} (correlation {})'.format(
+        np.sqrt(kcovar[0, 0]), np.sqrt(kcovar[1, 1]), kcovar[0, 1] / np.sqrt(kcovar[0, 0] * kcovar[1, 1])))
+    mccovar = None
+    if mc:
+        orbits, _ = fd3classes.perturbed_orbits(orbit, mc, orbcovar=orbcovar, seed=seed)
+        ks = np.array([best_fit(fd3lines, params, wd) for params in orbits])
+        mccovar = np.cov(ks.T)
+        print('Monte Carlo errors K1, K2 from {} draws: {}, {} (propagated/Monte Carlo: {}, {})'.format(
+            mc, np.sqrt(mccovar[0, 0]), np.sqrt(mccovar[1, 1]), np.sqrt(kcovar[0, 0] / mccovar[0, 0]),
+            np.sqrt(kcovar[1, 1] / mccovar[1, 1])))
+    return best, jac, kcovar, mccovar
@@ -0,0 +1,203 @@
+"""
+Affine invariant ensemble MCMC sampling of the posterior of K1, K2 and the orbit, with the gridfd3 merit function of
+all lines as the likelihood. An alternative to the grid-plus-Monte-Carlo approach, which spends most of its
+evaluations far from the minimum.
+"""
+import concurrent.futures as cf
+
+import numpy as np
+import scipy.linalg as spalg
+
+import modules.chisqstore as chisqstore
+import modules.gridengine as gridengine
+import modules.propagation as propagation
+
+
+class EnsembleSampler:
+    """
+    Goodman & Weare (2010) stretch move sampler. The walkers are split in two halves that are updated in turn, so
+    the log probability of a whole half is requested in one call and can be evaluated in parallel.
+    """
+
+    def __init__(self, lnprob, nwalkers, ndim, a=2., seed=None):
+        """
+        :param lnprob: function taking positions of shape (W, ndim) and returning their log probabilities, shape (W,)
+        :param nwalkers: number of walkers, even and at least 2 ndim
+        :param ndim: number of parameters
+        :param a: scale of the stretch move
+        :param seed: seed of the random generator
+        """
+        if nwalkers % 2 or nwalkers < 2 * ndim:
+            raise ValueError('need an even number of at least {} walkers'.format(2 * ndim))
+        self.lnprob = lnprob
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.a = a
+        self.rng = np.random.default_rng(seed)
+        self.chain = None
+        self.lnprobs = None
+        self.accepted = 0
+        self.evaluations = 0
+
+    def __repr__(self):
+        return 'EnsembleSampler ({} walkers, {} parameters)'.format(self.nwalkers, self.ndim)
+
+    def run(self, p0, nsteps, report=100):
+        """
+        :param p0: initial positions of the walkers, shape (nwalkers, ndim)
+        :param nsteps: number of steps
+        :param report: number of steps between progress messages, None for none
+        :return: chain of shape (nsteps, nwalkers, ndim)
+        """
+        pos = np.array(p0, dtype=np.float64)
+        lnp = self._evaluate(pos)
+        self.chain = np.empty((nsteps, self.nwalkers, self.ndim))
+        self.lnprobs = np.empty((nsteps, self.nwalkers))
+        half = self.nwalkers // 2
+        for step in range(nsteps):
+            for s, c in ((slice(None, half), slice(half, None)), (slice(half, None), slice(None, half))):
+                z = ((self.a - 1) * self.rng.random(half) + 1) ** 2 / self.a
+                partners = pos[c][self.rng.integers(half, size=half)]
+                proposal = partners + z[:, None] * (pos[s] - partners)
+                lnpnew = self._evaluate(proposal)
+                accept = np.log(self.rng.random(half)) < (self.ndim - 1) * np.log(z) + lnpnew - lnp[s]
+                pos[s][accept] = proposal[accept]
+                lnp[s][accept] = lnpnew[accept]
+                self.accepted += np.count_nonzero(accept)
+            self.chain[step] = pos
+            self.lnprobs[step] = lnp
+            if report and (step + 1) % report == 0:
+                print('step {} of {}, acceptance fraction {:.2f}'.format(step + 1, nsteps, self.acceptance(step + 1)))
+        return self.chain
+
+    def acceptance(self, steps=None):
+        """
+        :param steps: number of steps taken, all of the chain by default
+        :return: fraction of accepted proposals
+        """
+        steps = len(self.chain) if steps is None else steps
+        return self.accepted / (steps * self.nwalkers)
+
+    def samples(self, burn=0):
+        """
+        :param burn: number of initial steps to discard
+        :return: flattened chain after burn in, shape ((nsteps - burn) * nwalkers, ndim)
+        """
+        return self.chain[burn:].reshape(-1, self.ndim)
+
+    def _evaluate(self, pos):
+        self.evaluations += len(pos)
+        return self.lnprob(pos)
+
+
+class Posterior:
+    """
+    log posterior of (K1, K2, p, t0, e, omega): -chisq / 2 summed over all lines, a Gaussian prior on the orbit and
+    a flat prior on K1 and K2 within their grid ranges. Positions are evaluated as batches, split over the lines and
+    over chunks of walkers in a thread pool.
+    """
+
+    def __init__(self, fd3lines, orbit, orbcovar=None, orberr=None, threads=4):
+        """
+        :param fd3lines: Fd3class objects of the lines, with their spectra loaded
+        :param orbit: nominal orbit, the centre of the prior
+        :param orbcovar: covariance matrix of p, t0, e, omega
+        :param orberr: errors of p, t0, e, omega, used if no covariance matrix is given
+        :param threads: number of threads evaluating the merit function
+        """
+        if orbcovar is None:
+            orbcovar = np.diag(np.ravel(orberr) ** 2)
+        lines = [fd3line for fd3line in fd3lines if fd3line.no_used_spectra > 0]
+        self.engines = [gridengine.GridEngine.from_fd3class(fd3line) for fd3line in lines]
+        self.k1s = chisqstore.k_axis(lines[0].k1s)
+        self.k2s = chisqstore.k_axis(lines[0].k2s)
+        self.orbit = np.array(orbit[:4], dtype=np.float64)
+        self.chol = spalg.cholesky(orbcovar, lower=True)
+        self.threads = threads
+
+    def __repr__(self):
+        return 'Posterior over {} lines'.format(len(self.engines))
+
+    def __call__(self, pos):
+        """
+        :param pos: positions (K1, K2, p, t0, e, omega), shape (W, 6)
+        :return: log posterior, shape (W,)
+        """
+        lnp = self.lnprior(pos)
+        ok = np.isfinite(lnp)
+        if np.any(ok):
+            lnp[ok] -= 0.5 * self.chisq(pos[ok])
+        return lnp
+
+    def lnprior(self, pos):
+        u = spalg.solve_triangular(self.chol, (pos[:, 2:] - self.orbit).T, lower=True)
+        lnp = -0.5 * np.sum(u ** 2, axis=0)
+        inside = ((pos[:, 0] >= self.k1s[0]) & (pos[:, 0] <= self.k1s[-1]) & (pos[:, 1] >= self.k2s[0])
+                  & (pos[:, 1] <= self.k2s[-1]) & (pos[:, 4] >= 0) & (pos[:, 4] < 1))
+        return np.where(inside, lnp, -np.inf)
+
+    def chisq(self, pos):
+        """
+        :param pos: positions (K1, K2, p, t0, e, omega), shape (W, 6)
+        :return: chisq summed over the lines, shape (W,)
+        """
+        chunks = np.array_split(np.arange(len(pos)), min(self.threads, len(pos)))
+        with cf.ThreadPoolExecutor(self.threads) as pool:
+            futures = [(chunk, pool.submit(engine.merit_orbits, pos[chunk, 0], pos[chunk, 1], pos[chunk, 2:]))
+                       for engine in self.engines for chunk in chunks]
+        total = np.zeros(len(pos))
+        for chunk, future in futures:
+            total[chunk] += future.result()
+        return total
+
+    def start(self, nwalkers, seed=None):
+        """
+        starting positions around the best fit at the nominal orbit: K1 and K2 within one grid step of it, and the
+        orbit drawn from its prior
+        :param nwalkers: number of walkers
+        :param seed: seed of the random generator
+        :return: positions, shape (nwalkers, 6)
+        """
+        rng = np.random.default_rng(seed)
+        total = np.sum([engine.grid(self.k1s, self.k2s, self.orbit) for engine in self.engines], axis=0)
+        best = propagation.refine_minimum(self.k1s, self.k2s, total)
+        steps = (self.k1s[1] - self.k1s[0], self.k2s[1] - self.k2s[0])
+        pos = np.empty((nwalkers, 6))
+        pos[:, :2] = best + rng.normal(size=(nwalkers, 2)) * steps
+        pos[:, 2:] = self.orbit + rng.normal(size=(nwalkers, 4)) @ self.chol.T
+        pos[:, 4] = np.clip(pos[:, 4], 0, 0.999)
+        return pos
+
+
+def sample_posterior(fd3lines, orbit, orbcovar=None, orberr=None, nwalkers=32, nsteps=1000, threads=4, seed=None):
+    """
+    :param fd3lines: Fd3class objects of the lines, with their spectra loaded
+    :param orbit: nominal orbit, the centre of the prior
+    :param orbcovar: covariance matrix of p, t0, e, omega
+    :param orberr: errors of p, t0, e, omega, used if no covariance matrix is given
+    :param nwalkers: number of walkers
+    :param nsteps: number of steps of every walker
+    :param threads: number of threads evaluating the merit function
+    :param seed: seed of the starting positions and the sampler
+    :return: the sampler after its run
+    """
+    posterior = Posterior(fd3lines, orbit, orbcovar, orberr, threads)
+    ss = np.random.SeedSequence(seed)
+    startseed, runseed = ss.spawn(2)
+    sampler = EnsembleSampler(posterior, nwalkers, 6, seed=runseed)
+    sampler.run(posterior.start(nwalkers, startseed), nsteps)
+    print('{} merit evaluations per line, acceptance fraction {:.2f}'.format(sampler.evaluations, sampler.acceptance()))
+    return sampler
+
+
+def save_samples(folder, samples):
+    """
+    saves posterior samples as the mink1s, mink2s and combs files monte_carlo_analyser writes and MC_combiner reads,
+    and the full samples as posterior.npy
+    :param folder: output folder
+    :param samples: samples (K1, K2, p, t0, e, omega), shape (S, 6)
+    """
+    np.save(folder + '/mink1s', np.sort(samples[:, 0]))
+    np.save(folder + '/mink2s', np.sort(samples[:, 1]))
+    np.save(folder + '/combs', samples[:, :2])
+    np.save(folder + '/posterior', samples)
@@ -0,0 +1,266 @@
+"""
+Sharded Monte Carlo runs over several worker processes, possibly on several nodes that share a filesystem. A coordinator
+plans the run in a shard folder: the layout of its ChisqStore, the orbit of every iteration, the seed of the spectrum
+perturbations and a queue with one entry per shard of consecutive iterations. Workers claim shards by renaming their
+entry, which is atomic on a shared filesystem, and run them into a ChisqStore of their own. The merge puts the
+finished shards together into the ChisqStore a single node run of the same plan writes.
+"""
+import json
+import os
+import shutil
+import socket
+import time
+
+import numpy as np
+
+import modules.asyncrunner as asyncrunner
+import modules.chisqstore as chisqstore
+
+
+def worker_name():
+    """
+    :return: name of this process, unique over the nodes sharing the shard folder
+    """
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def plan(folder, iterations, lines, k1s, k2s, orbits=None, seed=None, shardsize=50, dgs=None):
+    """
+    plans a sharded Monte Carlo run, replacing any earlier plan in folder
+    :param folder: shard folder, on a filesystem all workers share
+    :param iterations: number of Monte Carlo iterations
+    :param lines: names of the lines
+    :param k1s: K1 range string 'left right step'
+    :param k2s: K2 range string 'left right step'
+    :param orbits: optional array with the orbit of every iteration
+    :param seed: seed of the spectrum perturbations, see ChisqStore.rng
+    :param shardsize: number of iterations per shard
+    :param dgs: optional Delta gamma range string 'left right step'
+    :return: the ShardQueue of the run
+    """
+    for sub in ('queue', 'shards'):
+        shutil.rmtree(os.path.join(folder, sub), ignore_errors=True)
+    os.makedirs(folder, exist_ok=True)
+    arrays = dict(iterations=iterations, lines=np.array(lines, dtype=str), k1s=k1s, k2s=k2s,
+                  dgs='' if dgs is None else dgs, seed='' if seed is None else str(seed))
+    if orbits is not None:
+        arrays['orbits'] = orbits
+    # written under a temporary name, so workers never read a partial plan
+    np.savez(os.path.join(folder, 'plan.tmp.npz'), **arrays)
+    os.replace(os.path.join(folder, 'plan.tmp.npz'), os.path.join(folder, 'plan.npz'))
+    queue = ShardQueue(folder)
+    for first in range(0, iterations, shardsize):
+        queue.put(first, min(shardsize, iterations - first))
+    return queue
+
+
+def load_plan(folder):
+    """
+    :param folder: shard folder
+    :return: dict of the plan: iterations, lines, k1s, k2s, dgs (None without a Delta gamma range), orbits (None if not
+    perturbed) and seed (None if unseeded)
+    """
+    with np.load(os.path.join(folder, 'plan.npz')) as npz:
+        return dict(iterations=int(npz['iterations']), lines=[str(line) for line in npz['lines']],
+                    k1s=str(npz['k1s']), k2s=str(npz['k2s']),
+                    dgs=str(npz['dgs']) if 'dgs' in npz and str(npz['dgs']) else None,
+                    orbits=npz['orbits'] if 'orbits' in npz else None,
+                    seed=int(npz['seed']) if str(npz['seed']) else None)
+
+
+class ShardQueue:
+    """
+    The queue of a shard folder. An entry named after the first iteration and size of its shard is free in queue/todo,
+    claimed in queue/claimed with the name of its worker appended, and finished in queue/done, where it holds the name
+    of the worker whose ChisqStore has the results. Workers renew their claims as they go, and claims that are not
+    renewed within a timeout can be put back in todo.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: shard folder
+        """
+        self.folder = folder
+        for state in ('todo', 'claimed', 'done'):
+            os.makedirs(self._path(state), exist_ok=True)
+
+    def __repr__(self):
+        return 'ShardQueue at {} ({} todo, {} claimed, {} done)'.format(self.folder, *self.status())
+
+    def _path(self, state, name=''):
+        return os.path.join(self.folder, 'queue', state, name)
+
+    @staticmethod
+    def _name(first, count):
+        return '{:08d}-{:08d}'.format(first, count)
+
+    @staticmethod
+    def _shard(name):
+        first, count = name.split('.', 1)[0].split('-')
+        return int(first), int(count)
+
+    def put(self, first, count):
+        """
+        adds a free shard
+        :param first: number of iterations before the first one of the shard
+        :param count: number of iterations of the shard
+        """
+        open(self._path('todo', self._name(first, count)), 'w').close()
+
+    def claim(self, worker):
+        """
+        claims the first free shard
+        :param worker: name of the claiming worker
+        :return: (first, count) of the shard, None if no shard is free
+        """
+        done = set(os.listdir(self._path('done')))
+        for name in sorted(os.listdir(self._path('todo'))):
+            if name in done:
+                # finished by a worker whose claim had timed out
+                self._remove(self._path('todo', name))
+                continue
+            try:
+                os.rename(self._path('todo', name), self._path('claimed', name + '.' + worker))
+            except FileNotFoundError:
+                # another worker was first
+                continue
+            return self._shard(name)
+        return None
+
+    def renew(self, first, count, worker):
+        """
+        renews a claim, so it does not time out
+        """
+        try:
+            os.utime(self._path('claimed', self._name(first, count) + '.' + worker))
+        except FileNotFoundError:
+            pass
+
+    def finish(self, first, count, worker):
+        """
+        marks a claimed shard as finished with the results of worker
+        """
+        name = self._name(first, count)
+        with open(self._path('done', name + '.tmp'), 'w') as f:
+            json.dump(dict(worker=worker, time=time.time()), f)
+        os.replace(self._path('done', name + '.tmp'), self._path('done', name))
+        self._remove(self._path('claimed', name + '.' + worker))
+
+    def release(self, first, count, worker):
+        """
+        puts a claimed shard back in the queue, e.g. after it failed
+        """
+        try:
+            os.rename(self._path('claimed', self._name(first, count) + '.' + worker),
+                      self._path('todo', self._name(first, count)))
+        except FileNotFoundError:
+            pass
+
+    def requeue(self, timeout):
+        """
+        puts the claims that were not renewed within timeout back in the queue, as their worker is considered dead
+        :param timeout: seconds
+        :return: number of shards put back
+        """
+        requeued = 0
+        for name in os.listdir(self._path('claimed')):
+            try:
+                if time.time() - os.path.getmtime(self._path('claimed', name)) > timeout:
+                    os.rename(self._path('claimed', name), self._path('todo', name.split('.', 1)[0]))
+                    requeued += 1
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def finished(self):
+        """
+        :return: list of (first, count, worker) of the finished shards
+        """
+        shards = list()
+        for name in sorted(os.listdir(self._path('done'))):
+            if name.endswith('.tmp'):
+                continue
+            with open(self._path('done', name)) as f:
+                shards.append(self._shard(name) + (json.load(f)['worker'],))
+        return shards
+
+    def status(self):
+        """
+        :return: number of free, claimed and finished shards
+        """
+        return tuple(len([name for name in os.listdir(self._path(state)) if not name.endswith('.tmp')])
+                     for state in ('todo', 'claimed', 'done'))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def shard_folder(folder, first, count, worker):
+    """
+    :return: folder of the ChisqStore of a shard run by worker
+    """
+    return os.path.join(folder, 'shards', '{}.{}'.format(ShardQueue._name(first, count), worker))
+
+
+def work(folder, fd3lines, worker=None, concurrency=None, stop=None):
+    """
+    runs shards of a planned run until none are free
+    :param folder: shard folder
+    :param fd3lines: list of Fd3class, with the lines of the plan among them
+    :param worker: name of this worker, worker_name() by default
+    :param concurrency: maximal number of engines running at once, the number of cpus by default
+    :param stop: optional threading.Event, no new shards are claimed once it is set
+    :return: number of shards run
+    """
+    worker = worker or worker_name()
+    shardplan = load_plan(folder)
+    runner = asyncrunner.AsyncRunner(concurrency)
+    bynames = {repr(fd3line): fd3line for fd3line in runner.load(fd3lines)}
+    missing = [line for line in shardplan['lines'] if line not in bynames]
+    if missing:
+        raise ValueError('worker {} has no spectra for the lines {} of the plan'.format(worker, ', '.join(missing)))
+    queue = ShardQueue(folder)
+    shards = 0
+    while stop is None or not stop.is_set():
+        shard = queue.claim(worker)
+        if shard is None:
+            break
+        first, count = shard
+        print('worker {} running iterations {} to {}'.format(worker, first + 1, first + count))
+        orbits = shardplan['orbits']
+        store = chisqstore.ChisqStore.create(shard_folder(folder, first, count, worker), count, shardplan['lines'],
+                                             shardplan['k1s'], shardplan['k2s'],
+                                             None if orbits is None else orbits[first:first + count],
+                                             shardplan['seed'], first, shardplan['dgs'])
+        tasks = [(bynames[line], None, ii, store) for ii in range(1, count + 1) for line in shardplan['lines']]
+        results = runner.run_tasks(tasks, done=lambda task: queue.renew(first, count, worker))
+        if any(isinstance(result, BaseException) for result in results) or len(store.completed()) < count:
+            print('worker {} failed iterations {} to {}, releasing them and stopping'.format(worker, first + 1,
+                                                                                           first + count))
+            queue.release(first, count, worker)
+            break
+        queue.finish(first, count, worker)
+        shards += 1
+    print('worker {} ran {} shards'.format(worker, shards))
+    return shards
+
+
+def merge(folder, storefolder):
+    """
+    combines the finished shards into one ChisqStore, identical to the store of a single node run of the plan
+    :param folder: shard folder
+    :param storefolder: folder of the merged store
+    :return: the merged ChisqStore
+    """
+    shardplan = load_plan(folder)
+    store = chisqstore.ChisqStore.create(storefolder, shardplan['iterations'], shardplan['lines'], shardplan['k1s'],
+                                         shardplan['k2s'], shardplan['orbits'], shardplan['seed'], dgs=shardplan['dgs'])
+    for first, count, worker in ShardQueue(folder).finished():
+        shard = chisqstore.ChisqStore(shard_folder(folder, first, count, worker))
+        store.write_block(first + 1, np.asarray(shard.chisq))
+    print('merged {} of {} iterations into {}'.format(len(store.completed()), len(store), storefolder))
+    return store
@@ -1,6 +1,11 @@
-import astropy.io.fits as fits
+"""
+Reads spectra from FITS files. astropy and scipy are imported when a file is read, so the compute modules can be
+imported without the FITS stack.
+"""
+import collections
+import threading
+
 import numpy as np
-import scipy.interpolate as spint
 
 
 class SpectrumError(Exception):
@@ -24,34 +29,99 @@ def getspectrum(line, file, lambdabase, edgepoints=20):
     :param edgepoints: number of points before the line that are used to estimate the noise
     :return: flux, noise, mjd as stated in the description of this function or None
     """
+    return _evaluate(line, file, _read(line, file), lambdabase, edgepoints)
+
+
+def _read(line, file):
+    """
+    :return: the ln(lambda) limits, the spline in ln(lambda) and the mjd of the spectrum in file
+    """
+    import astropy.io.fits as fits
     with fits.open(file) as hdul:
         try:
             spec_hdu = hdul['NORM_SPECTRUM']
         except KeyError:
             raise SpectrumError(file, line, 'has no normalized spectrum, skipping')
         loglamb = spec_hdu.data['log_wave']
-        # check whether base is completely covered
-        if loglamb[0] > lambdabase[0] or loglamb[-1] < lambdabase[-1]:
-            raise SpectrumError(file, line, 'does not cover line')
         try:
             logspline = hdul['LOG_NORM_SPLINE']
         except KeyError:
             raise SpectrumError(file, line, 'has no spline')
-        # append in base evaluated flux values
-        flux = spint.splev(lambdabase, logspline.data[0])
-        if np.average(flux) < 0.1:
-            raise SpectrumError(file, line, 'average flux is low here, might be a gap in the spectrum, skipping')
-        # determine noise near this line
-        noise = np.std(flux[:edgepoints - 1])
-        if np.isnan(noise):
-            print(file, line)
-            print(flux[:edgepoints - 1])
+        t, c, k = logspline.data[0]
         # get mjd
         mjd = hdul[0].header['MJD-obs']
-        return flux, noise, mjd
+        return (loglamb[0], loglamb[-1]), (np.array(t), np.array(c), int(k)), mjd
+
+
+def _evaluate(line, file, spectrum, lambdabase, edgepoints=20):
+    import scipy.interpolate as spint
+    limits, logspline, mjd = spectrum
+    # check whether base is completely covered
+    if limits[0] > lambdabase[0] or limits[1] < lambdabase[-1]:
+        raise SpectrumError(file, line, 'does not cover line')
+    # append in base evaluated flux values
+    flux = spint.splev(lambdabase, logspline)
+    if np.average(flux) < 0.1:
+        raise SpectrumError(file, line, 'average flux is low here, might be a gap in the spectrum, skipping')
+    # determine noise near this line
+    noise = np.std(flux[:edgepoints - 1])
+    if np.isnan(noise):
+        print(file, line)
+        print(flux[:edgepoints - 1])
+    return flux, noise, mjd
+
+
+class SpectrumCache:
+    """
+    Keeps the spline and mjd of every FITS file read through it, so the lines of one or many targets that share
+    spectra open every file only once. Drop-in for getspectrum, and safe to use from several threads.
+    """
+
+    def __init__(self, maxfiles=None):
+        """
+        :param maxfiles: maximal number of files kept, the least recently used are dropped beyond it. None to keep all
+        """
+        self.maxfiles = maxfiles
+        self.spectra = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._filelocks = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'SpectrumCache of {} files ({} hits, {} misses)'.format(len(self.spectra), self.hits, self.misses)
+
+    def getspectrum(self, line, file, lambdabase, edgepoints=20):
+        """
+        getspectrum, reading file only the first time it is asked for
+        """
+        with self.lock:
+            filelock = self._filelocks.setdefault(file, threading.Lock())
+        # lines asking for the same file wait for the one reading it, others read in parallel
+        with filelock:
+            with self.lock:
+                spectrum = self.spectra.get(file)
+                if spectrum is not None:
+                    self.spectra.move_to_end(file)
+                    self.hits += 1
+            if spectrum is None:
+                try:
+                    spectrum = _read(line, file)
+                except SpectrumError as e:
+                    # a file without a spectrum stays without one
+                    spectrum = e
+                with self.lock:
+                    self.misses += 1
+                    self.spectra[file] = spectrum
+                    if self.maxfiles is not None and len(self.spectra) > self.maxfiles:
+                        self.spectra.popitem(last=False)
+        if isinstance(spectrum, SpectrumError):
+            raise spectrum
+        return _evaluate(line, file, spectrum, lambdabase, edgepoints)
 
 
 def getspectrumspline(line, file):
+    import astropy.io.fits as fits
     with fits.open(file) as hdul:
         try:
             spl = hdul['NORM_SPLINE']
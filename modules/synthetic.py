@@ -0,0 +1,204 @@
+"""
+Synthetic double and triple lined spectra for benchmarks and regression checks: component spectra of Gaussian
+absorption lines, Doppler shifted along a Keplerian orbit, mixed with light factors and given white noise. The lines
+are built directly as Fd3class objects with their spectra set, so no FITS files are needed, or written as FITS files in
+the format spectra_manager.getspectrum reads, for end-to-end runs of the pipeline.
+"""
+import os
+
+import numpy as np
+
+import modules.gridfd3classes as fd3classes
+import modules.kepler as kepler
+
+SPEEDOFLIGHT = 299792.458  # km/s
+
+
+def k_range(k, n, step):
+    """
+    :param k: central semi-amplitude (km/s)
+    :param n: number of grid points
+    :param step: step size (km/s)
+    :return: K range in string form 'left right step' that gridfd3 samples in exactly n points
+    """
+    low = k - (n - 1) / 2 * step
+    # half a step of margin, so the truncation in gridfd3 cannot lose the last point to round-off
+    return '{} {} {}'.format(low, low + (n - 0.5) * step, step)
+
+
+def orbit_rvs(mjds, orbit, tl=False):
+    """
+    :param mjds: times of the observations
+    :param orbit: p, t0, e, omega (deg), K1, K2(, Delta gamma)
+    :param tl: whether there is a static third component
+    :return: radial velocities of the components (km/s), shape (2, M) or (3, M)
+    """
+    p, t0, e, omega, k1, k2 = orbit[:6]
+    dg = orbit[6] if len(orbit) > 6 else 0.
+    omega = np.pi / 180 * omega
+    shape = np.cos(kepler.true_anom(kepler.phase(mjds, p, t0), e) + omega) + e * np.cos(omega)
+    rvs = [k1 * shape, - k2 * shape + dg]
+    if tl:
+        rvs.append(np.zeros(len(mjds)))
+    return np.array(rvs)
+
+
+class SyntheticComponents:
+    """
+    Continuum normalized component spectra with Gaussian absorption lines at random positions, evaluated analytically
+    on any ln(lambda) base and at any radial velocity
+    """
+
+    def __init__(self, k, loglimits, density=0.002, depths=(0.05, 0.4), widths=(15., 60.), seed=None):
+        """
+        :param k: number of components
+        :param loglimits: ln(lambda) range the lines are spread over
+        :param density: number of lines per km/s of the range, per component
+        :param depths: range of the line depths
+        :param widths: range of the gaussian widths (km/s)
+        :param seed: seed of the line positions, depths and widths
+        """
+        rng = np.random.default_rng(seed)
+        nlines = max(1, int(density * SPEEDOFLIGHT * (loglimits[1] - loglimits[0])))
+        self.centres = rng.uniform(*loglimits, (k, nlines))
+        self.depths = rng.uniform(*depths, (k, nlines))
+        self.widths = rng.uniform(*widths, (k, nlines)) / SPEEDOFLIGHT
+
+    @classmethod
+    def from_lines(cls, wavelengths, depths, widths):
+        """
+        :param wavelengths: central wavelengths (angstrom) of the lines of every component, shape (K, lines)
+        :param depths: depths of the lines, shape (K, lines)
+        :param widths: gaussian widths of the lines (km/s), shape (K, lines)
+        :return: components with exactly these lines
+        """
+        comps = cls.__new__(cls)
+        comps.centres = np.log(np.asarray(wavelengths, dtype=np.float64))
+        comps.depths = np.asarray(depths, dtype=np.float64)
+        comps.widths = np.asarray(widths, dtype=np.float64) / SPEEDOFLIGHT
+        return comps
+
+    def __repr__(self):
+        return 'SyntheticComponents ({} components of {} lines)'.format(*self.centres.shape)
+
+    def __call__(self, logbase, rvs):
+        """
+        :param logbase: ln(lambda) base
+        :param rvs: radial velocity of every component (km/s), shape (K,), or (K, M) for M epochs
+        :return: component fluxes, shape (K, len(logbase)) or (K, M, len(logbase))
+        """
+        rvs = np.asarray(rvs, dtype=np.float64)
+        flux = np.ones(rvs.shape + (len(logbase),))
+        for k in range(len(self.centres)):
+            # the rest frame ln(lambda) of the observed bins
+            rest = logbase + np.log(1 - rvs[k, ..., None] / SPEEDOFLIGHT)
+            for c, d, w in zip(self.centres[k], self.depths[k], self.widths[k]):
+                near = np.abs(logbase - c) < 6 * w + np.max(np.abs(rvs[k])) / SPEEDOFLIGHT
+                flux[k][..., near] -= d * np.exp(-0.5 * ((rest[..., near] - c) / w) ** 2)
+        return flux
+
+
+def synthetic_line(name='synthetic', bins=2000, spectra=20, tl=False, orbit=(1000., 100., 0.5, 40., 30., 50.),
+                   lfs=None, snr=300., seed=0, engine='numpy', k1s=None, k2s=None, start=4500., sampling=0.05,
+                   dtype=np.float64, wide=True):
+    """
+    :param name: name of the line
+    :param bins: number of ln(lambda) bins gridfd3 disentangles
+    :param spectra: number of spectra
+    :param tl: whether there is a static third component
+    :param orbit: p, t0, e, omega (deg), K1, K2 of the synthetic binary
+    :param lfs: light factors of the components, (0.6, 0.4) or (0.5, 0.3, 0.2) by default
+    :param snr: signal to noise ratio of the spectra
+    :param seed: seed of the epochs, the component spectra and the noise
+    :param engine: engine of the line, 'numpy' or 'gridfd3'
+    :param k1s: K1 range in string form, 21 points of 1 km/s around K1 by default
+    :param k2s: K2 range in string form, 21 points of 1 km/s around K2 by default
+    :param start: lower wavelength limit (angstrom)
+    :param sampling: sampling in angstrom, as in the driver scripts
+    :param dtype: storage type of the fluxes of the line
+    :param wide: whether to set the spectra on the wide base of fd3 too, which grid runs do not use
+    :return: Fd3class with its spectra set, and the SyntheticComponents it was made of
+    """
+    if lfs is None:
+        lfs = (0.5, 0.3, 0.2) if tl else (0.6, 0.4)
+    rng = np.random.default_rng(seed)
+    logsamp = sampling / 4500
+    linlimits = (start, start * np.exp(bins * logsamp))
+    fd3line = fd3classes.Fd3class(name, linlimits, sampling, [], tl, orbit, lfs=lfs,
+                                  k1s=k1s or k_range(orbit[4], 21, 1.), k2s=k2s or k_range(orbit[5], 21, 1.),
+                                  engine=engine, dtype=dtype)
+    comps = SyntheticComponents(3 if tl else 2, fd3line.wideloglimits, seed=rng.integers(2 ** 31))
+    mjds = np.sort(rng.uniform(orbit[1], orbit[1] + 3 * orbit[0], spectra))
+    rvs = orbit_rvs(mjds, orbit, tl)
+    lfs = np.asarray(lfs)[:, None, None]
+    fd3line.data = np.sum(lfs * comps(fd3line.logbase, rvs), axis=0)
+    fd3line.data += rng.normal(0, 1 / snr, fd3line.data.shape)
+    fd3line.data = fd3line.data.astype(dtype, copy=False)
+    if wide:
+        fd3line.widedata = np.sum(lfs * comps(fd3line.widelogbase, rvs), axis=0)
+        fd3line.widedata += rng.normal(0, 1 / snr, fd3line.widedata.shape)
+        fd3line.widedata = fd3line.widedata.astype(dtype, copy=False)
+    fd3line.mjds = mjds
+    fd3line.noises = np.full(spectra, 1 / snr)
+    fd3line.no_used_spectra = spectra
+    fd3line.dof = spectra * len(fd3line.logbase)
+    return fd3line, comps
+
+
+def write_fits(file, logwave, flux, mjd):
+    """
+    writes a spectrum as spectra_manager.getspectrum reads it: the flux on its ln(lambda) grid in NORM_SPECTRUM, its
+    interpolating spline in ln(lambda) in LOG_NORM_SPLINE and in lambda in NORM_SPLINE, and the MJD-obs header
+    :param file: FITS file to write
+    :param logwave: ln(lambda) grid
+    :param flux: normalized flux on logwave
+    :param mjd: time of the observation
+    """
+    # imported here, so the in-memory lines do not need the FITS stack
+    import astropy.io.fits as fits
+    import scipy.interpolate as spint
+
+    def spline_hdu(x, name):
+        t, c, k = spint.splrep(x, flux, s=0)
+        return fits.BinTableHDU.from_columns([fits.Column('t', '{}D'.format(len(t)), array=t[None]),
+                                              fits.Column('c', '{}D'.format(len(c)), array=c[None]),
+                                              fits.Column('k', 'J', array=[k])], name=name)
+
+    primary = fits.PrimaryHDU()
+    primary.header['MJD-obs'] = mjd
+    spectrum = fits.BinTableHDU.from_columns([fits.Column('log_wave', 'D', array=logwave),
+                                              fits.Column('norm_flux', 'D', array=flux)], name='NORM_SPECTRUM')
+    fits.HDUList([primary, spectrum, spline_hdu(logwave, 'LOG_NORM_SPLINE'),
+                  spline_hdu(np.exp(logwave), 'NORM_SPLINE')]).writeto(file, overwrite=True)
+
+
+def synthetic_dataset(folder, comps, coverage, epochs=30, tl=False, orbit=(1000., 100., 0.5, 40., 30., 50.), lfs=None,
+                      snr=300., seed=0, sampling=0.03):
+    """
+    writes the spectra of a synthetic binary as FITS files, one per epoch
+    :param folder: folder to write the files to, created if needed
+    :param comps: SyntheticComponents of the binary
+    :param coverage: wavelength range (angstrom) of the spectra
+    :param epochs: number of spectra
+    :param tl: whether there is a static third component
+    :param orbit: p, t0, e, omega (deg), K1, K2 of the synthetic binary
+    :param lfs: light factors of the components, (0.6, 0.4) or (0.5, 0.3, 0.2) by default
+    :param snr: signal to noise ratio of the spectra
+    :param seed: seed of the epochs and the noise
+    :param sampling: sampling of the spectra in angstrom at 4500 angstrom, constant in ln(lambda)
+    :return: the files written, and the times of the observations
+    """
+    if lfs is None:
+        lfs = (0.5, 0.3, 0.2) if tl else (0.6, 0.4)
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    logwave = np.arange(np.log(coverage[0]), np.log(coverage[1]), sampling / 4500)
+    mjds = np.sort(rng.uniform(orbit[1], orbit[1] + 3 * orbit[0], epochs))
+    rvs = orbit_rvs(mjds, orbit, tl)
+    files = list()
+    for j in range(epochs):
+        flux = np.sum(np.asarray(lfs)[:, None] * comps(logwave, rvs[:, j]), axis=0)
+        flux += rng.normal(0, 1 / snr, len(flux))
+        files.append(os.path.join(folder, 'synthetic{:04d}.fits'.format(j)))
+        write_fits(files[-1], logwave, flux, mjds[j])
+    return files, mjds
@@ -0,0 +1,155 @@
+"""
+Defines the Timeline, a low overhead recorder of the durations of the stages of a run per line, iteration and thread,
+with export to the Chrome trace event format (chrome://tracing, ui.perfetto.dev) and a summary table
+"""
+import json
+import os
+import threading
+import time
+
+
+def parse_perf_block(text):
+    """
+    parses the performance counter block the engines write to stderr when FD3_PERF is set
+    :param text: stderr of an engine run
+    :return: dict of the counters and timings, None if there is no block
+    """
+    if '# BEGIN PERF' not in text:
+        return None
+    block = text.split('# BEGIN PERF', 1)[1].split('# END PERF', 1)[0]
+    counters = dict()
+    for row in block.strip().splitlines():
+        key, value = row.split(maxsplit=1)
+        try:
+            counters[key] = int(value)
+        except ValueError:
+            try:
+                counters[key] = float(value)
+            except ValueError:
+                counters[key] = value
+    return counters
+
+
+class Stage:
+    """
+    context manager timing one stage; records nothing if its timeline is disabled
+    """
+    __slots__ = ('timeline', 'name', 'line', 'iteration', 'start')
+
+    def __init__(self, timeline, name, line, iteration):
+        self.timeline = timeline
+        self.name = name
+        self.line = line
+        self.iteration = iteration
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timeline.enabled:
+            # list.append is atomic, so threads can record without a lock
+            self.timeline.events.append((self.name, self.line, self.iteration, threading.current_thread().name,
+                                         self.start, time.perf_counter() - self.start))
+        return False
+
+
+class Timeline:
+    """
+    Collects (stage, line, iteration, thread, start, duration) events. Recording a stage costs two clock reads and
+    a list append, so it can stay enabled in production runs.
+    """
+
+    def __init__(self, enabled=True, engine_counters=False):
+        """
+        :param enabled: record stage durations
+        :param engine_counters: run the compiled engines with their performance counters on, and collect them
+        """
+        self.enabled = enabled
+        self.engine_counters = engine_counters
+        self.events = list()
+        self.counters = list()
+        self.origin = time.perf_counter()
+
+    def __repr__(self):
+        return 'Timeline with {} events'.format(len(self.events))
+
+    def __len__(self):
+        return len(self.events)
+
+    def stage(self, name, line=None, iteration=None):
+        """
+        :param name: name of the stage
+        :param line: line the stage works on, anything with a repr
+        :param iteration: Monte Carlo iteration, if any
+        :return: context manager timing the stage
+        """
+        return Stage(self, name, None if line is None else repr(line), iteration)
+
+    def record_counters(self, counters, line=None, iteration=None):
+        """
+        :param counters: parsed performance counter block of one engine run
+        :param line: line the engine ran on
+        :param iteration: Monte Carlo iteration, if any
+        """
+        self.counters.append((time.perf_counter(), None if line is None else repr(line), iteration, counters))
+
+    def reset(self):
+        self.events = list()
+        self.counters = list()
+        self.origin = time.perf_counter()
+
+    def export_chrome(self, file):
+        """
+        writes the events as complete ('X') events of the Chrome trace event format, one track per thread
+        :param file: output json file
+        """
+        pid = os.getpid()
+        tids = dict()
+        trace = list()
+        for name, line, iteration, thread, start, duration in list(self.events):
+            tid = tids.setdefault(thread, len(tids) + 1)
+            trace.append(dict(name=name, cat='gridfd3', ph='X', pid=pid, tid=tid, ts=(start - self.origin) * 1e6,
+                              dur=duration * 1e6, args=dict(line=line, iteration=iteration)))
+        for stamp, line, iteration, counters in list(self.counters):
+            trace.append(dict(name=counters.get('engine', 'engine'), cat='counters', ph='C', pid=pid,
+                              ts=(stamp - self.origin) * 1e6,
+                              args={key: value for key, value in counters.items() if key != 'engine'}))
+        for thread, tid in tids.items():
+            trace.append(dict(name='thread_name', ph='M', pid=pid, tid=tid, args=dict(name=thread)))
+        with open(file, 'w') as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), f)
+
+    def summary(self):
+        """
+        :return: table of the count, total, mean and maximal duration of every stage, and its share of the total time
+        spent in all stages, sorted by total time
+        """
+        stats = dict()
+        for name, _, _, _, _, duration in list(self.events):
+            count, total, maxd = stats.get(name, (0, 0., 0.))
+            stats[name] = (count + 1, total + duration, max(maxd, duration))
+        alltotal = sum(total for _, total, _ in stats.values()) or 1
+        rows = ['{:<24}{:>10}{:>14}{:>12}{:>12}{:>8}'.format('stage', 'count', 'total (s)', 'mean (s)', 'max (s)', '%')]
+        for name, (count, total, maxd) in sorted(stats.items(), key=lambda item: -item[1][1]):
+            rows.append('{:<24}{:>10}{:>14.3f}{:>12.4f}{:>12.4f}{:>8.1f}'.format(
+                name, count, total, total / count, maxd, 100 * total / alltotal))
+        return '\n'.join(rows) + self.counter_summary()
+
+    def counter_summary(self):
+        """
+        :return: table of the engine counters summed over all runs of every engine, empty if none were collected
+        """
+        sums = dict()
+        for _, _, _, counters in list(self.counters):
+            engine = sums.setdefault(counters.get('engine', 'engine'), dict(runs=0))
+            engine['runs'] += 1
+            for key, value in counters.items():
+                if key != 'engine':
+                    engine[key] = engine.get(key, 0) + value
+        rows = list()
+        for engine, totals in sums.items():
+            rows.append('\n{} engine counters'.format(engine))
+            rows.extend('{:<24}{:>16}'.format(key, round(value, 6)) for key, value in totals.items())
+        return '\n'.join(rows)
@@ -6,6 +6,7 @@ import sys
 import os
 import numpy as np
 import outfile_analyser as oa
+import modules.chisqstore as chisqstore
 # noinspection PyUnresolvedReferences
 import plotsetup
 
@@ -55,7 +56,16 @@ k1s, k2s = None, None
 lines = sorted(lines)
 iterations = 0
 c = 0
-while True:
+legacy = not chisqstore.ChisqStore.exists(folder + '/chisqstore')
+if not legacy:
+    # runs with a result store hold all iterations in one memory-mapped array, which is combined in batched chunks.
+    # Only completed iterations are read, so this can run while the Monte Carlo is still going.
+    store = chisqstore.ChisqStore(folder + '/chisqstore')
+    k1s, k2s = store.k1s, store.k2s
+    _, mink1s, mink2s = chisqstore.combine_minima(store)
+    combs = list(zip(mink1s, mink2s))
+    iterations = len(mink1s)
+while legacy:
     c += 1
     if not os.path.isdir(folder+'/thread{}'.format(c)):
         break
@@ -4,6 +4,8 @@ import numpy as np
 import scipy.optimize as spopt
 import scipy.special as sps
 
+from modules.chisqstore import ChisqStore
+
 
 def file_parser(ffile):
     """
@@ -17,10 +19,77 @@ def file_parser(ffile):
     kk2s = ffile['k2s']
     kk2s = np.unique(kk2s)
     cchisqhere = ffile['chisq']
-    cchisqhere = cchisqhere.reshape((len(kk1s), len(kk2s)))
+    cchisqhere = cchisqhere.reshape((len(kk1s), len(kk2s), -1))
+    if cchisqhere.shape[2] == 1:
+        cchisqhere = cchisqhere[:, :, 0]
     return kk1s, kk2s, cchisqhere
 
 
+def cube_parser(ffile):
+    """
+    parses a gridfd3 output file of a K1 x K2 x Delta gamma grid
+    :param ffile: file to parse
+    :return: the unique k1s, k2s, Delta gammas and a chisq cube corresponding to those. Files of runs without a Delta
+    gamma axis give a cube with a single Delta gamma
+    """
+    kk1s, kk2s, cchisqhere = file_parser(ffile)
+    ffile = np.load(ffile)
+    ddgs = np.unique(ffile['dgs']) if 'dgs' in ffile.files else np.zeros(1)
+    return kk1s, kk2s, ddgs, cchisqhere.reshape((len(kk1s), len(kk2s), len(ddgs)))
+
+
+def marginalize_cube(cchisq, ddof, axis=2):
+    """
+    marginalizes a chisq cube over one axis, integrating the likelihood exp(-chisq / 2) with chisq rescaled to a
+    minimal reduced chisq of 1, as for the error contours
+    :param cchisq: chisq cube
+    :param ddof: degrees of freedom
+    :param axis: axis to eliminate, 2 for Delta gamma
+    :return: chisq grid of the two remaining axes, in the units of cchisq and equal to its minimum at the best point
+    """
+    minn = np.min(cchisq)
+    factor = minn / ddof
+    marg = -2 * sps.logsumexp(-(cchisq - minn) / factor / 2, axis=axis)
+    return minn + factor * (marg - np.min(marg))
+
+
+def slice_cube(ddgs, cchisq, dg=None):
+    """
+    takes the K1 x K2 chisq grid at one Delta gamma
+    :param ddgs: Delta gamma axis
+    :param cchisq: chisq cube
+    :param dg: Delta gamma to slice at (the nearest one in the grid is taken), None for the best one
+    :return: the Delta gamma of the slice and its chisq grid
+    """
+    if dg is None:
+        idx = get_min_idx(cchisq)[2]
+    else:
+        idx = np.argmin(np.abs(ddgs - dg))
+    return ddgs[idx], cchisq[:, :, idx]
+
+
+def store_parser(folder, line=None):
+    """
+    reads the chisq grids of a Monte Carlo run from its result store without copying them into memory
+    :param folder: folder of the run, containing the chisqstore directory
+    :param line: name of a line, or None for all lines
+    :return: the k1s, k2s and a read-only chisq array of shape (iterations, lines, k1s, k2s), or (iterations, k1s, k2s)
+    if a line was given, holding only the completed iterations. Runs over a Delta gamma range have a last Delta gamma
+    axis, see store.dgs
+    """
+    store = ChisqStore(folder + '/chisqstore')
+    cchisq = store.chisq
+    completed = store.completed()
+    if np.array_equal(completed, np.arange(len(completed))):
+        # the completed iterations are a prefix of the store, so a slice keeps this a view
+        cchisq = cchisq[:len(completed)]
+    else:
+        cchisq = cchisq[completed]
+    if line is not None:
+        cchisq = cchisq[:, store.lines.index(line)]
+    return store.k1s, store.k2s, cchisq
+
+
 def plot_contours(ffig, kk1s, kk2s, cchisq, ddof, error=False):
     """
     plots the reduced chisq contours on a figure
@@ -233,6 +302,26 @@ def get_min_and_plot(kk1s, kk2s, cchisq, ddof, name):
         plt.close(fig)
 
 
+def get_min_and_plot_cube(kk1s, kk2s, ddgs, cchisq, ddof, name):
+    """
+    get_min_and_plot for a K1 x K2 x Delta gamma cube: plots the K1, K2 grid marginalized over Delta gamma and the
+    slice at the best Delta gamma. A cube with a single Delta gamma is plotted as a normal grid.
+    :param kk1s: k1 axis
+    :param kk2s: k2 axis
+    :param ddgs: Delta gamma axis
+    :param cchisq: chisq cube
+    :param ddof: degrees of freedom
+    :param name: name of the savefile
+    """
+    if len(ddgs) == 1:
+        get_min_and_plot(kk1s, kk2s, cchisq[:, :, 0], ddof, name)
+        return
+    bestdg, sslice = slice_cube(ddgs, cchisq)
+    print(name, 'best Delta gamma', bestdg)
+    get_min_and_plot(kk1s, kk2s, marginalize_cube(cchisq, ddof), ddof, name + 'margdg')
+    get_min_and_plot(kk1s, kk2s, sslice, ddof, name + 'dg{}'.format(bestdg))
+
+
 def get_min_of_run(wd):
     files = glob.glob(wd + '/chisqs/*')
     # parse first file
@@ -277,13 +366,13 @@ if __name__ == "__main__":
                 dof += dofhere
                 totdof += dofhere
         # parse first file
-        k1s, k2s, chisq = file_parser(chisqfiles[0])
+        k1s, k2s, dgs, chisq = cube_parser(chisqfiles[0])
         totchisq += chisq
         # add up chisq
         for i in range(1, len(chisqfiles)):
-            _, _, chisqhere = file_parser(chisqfiles[i])
+            _, _, _, chisqhere = cube_parser(chisqfiles[i])
             chisq += chisqhere
         # print its minimum
-        get_min_and_plot(k1s, k2s, chisq, dof, line)
+        get_min_and_plot_cube(k1s, k2s, dgs, chisq, dof, line)
     # get the aggregate chisq plot
-    get_min_and_plot(k1s, k2s, totchisq, totdof, 'all')
+    get_min_and_plot_cube(k1s, k2s, dgs, totchisq, totdof, 'all')
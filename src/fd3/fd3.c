@@ -15,6 +15,7 @@
 #include "../mxfuns.h"
 #include "fd3sep.h"
 #include "../triorb.h"
+#include "../perf.h"
 
 /*****************************************************************************/
 
@@ -58,8 +59,8 @@ static char *triorb_pformat (long j) { return triorb_strings[3*j+2]; }
 
 /*****************************************************************************/
 
-static long   K, M, N, Ndft, ksw[3], nfp, opsw[TRIORB_NP];
-static double **dftobs, **dftmod, **dftres;
+static long   K, M, N, Nfft, Ndft, ksw[3], nfp, opsw[TRIORB_NP];
+static double **dftobs, **dftmod, **dftres, **res;
 static double rvstep, *otimes, *rvcorr, *sig, **lfm, **rvm;
 static double op0[TRIORB_NP], dop0[TRIORB_NP];
 static double meritfngsl ( const gsl_vector *v, void *params );
@@ -72,14 +73,15 @@ static char *mxfd3fmts=MX_FDBINARY_FORMAT;
 
 int main ( void ) {
 
-    long i, i0, i1, j, k, vc, vlen, nruns, niter, rootfnlen;
-    double **masterobs, **mod, **res, **obs, z0, z1, stoprat;
+    long i, i0, i1, j, k, vc, vlen, nruns, niter, rootfnlen, taper;
+    double **masterobs, **mod, **obs, z0, z1, stoprat, tp = 0;
     char rootfn[1024], obsfn[1024], resfn[1024];
     char modfn[1024], rvsfn[1024], logfn[1024];
     char *starcode[] = {"A","B","C"};
     FILE *logfp;
 
     setbuf ( stdout, NULL );
+    perf_init ();
     MxError( FDBErrorString, stdout, fdbfailure );
     MxFormat( mxfd3fmts );
 
@@ -143,14 +145,22 @@ int main ( void ) {
     }
     printf ( "\n  number of components to be resolved is %ld\n", K );
 
+    /* the transform length, a smooth one the window is extended to if FD3_FFT_TAPER is set */
+    taper = dft_taper ();
+    Nfft = dft_length ( N, taper );
+    if ( Nfft > N )
+        printf ( "\n  transform length %ld, extended with a taper of %ld bins\n", Nfft, taper );
+
     /* allocating memory */
-    Ndft = 2*(N/2 + 1);
-    dftobs = MxAlloc ( M, Ndft ); dft_fwd ( M, N, obs+1, dftobs );
+    Ndft = 2*(Nfft/2 + 1);
+    dftobs = MxAlloc ( M, Ndft );
+    PERF_START(tp); dft_fwd_ext ( M, N, Nfft, taper, obs+1, dftobs ); PERF_STOP(PERF_DFT,tp);
     otimes = *MxAlloc ( 1, M );
     rvcorr = *MxAlloc ( 1, M );
     sig = *MxAlloc ( 1, M );
-    res = MxAlloc ( M+1, N ); dftres = MxAlloc ( M, Ndft );
-    mod = MxAlloc ( K+1, N ); dftmod = MxAlloc ( K, Ndft );
+    /* the extra bins of the transform are dropped from the model spectra and residuals when they are written */
+    res = MxAlloc ( M+1, Nfft ); dftres = MxAlloc ( M, Ndft );
+    mod = MxAlloc ( K+1, Nfft ); dftmod = MxAlloc ( K, Ndft );
     rvm = MxAlloc ( K, M );
     lfm = MxAlloc ( K, M );
     for ( i = 0 ; i < N ; i++ ) { *(*res+i) = *(*obs+i); *(*mod+i) = *(*obs+i); }
@@ -197,11 +207,13 @@ int main ( void ) {
     chi2 = meritfn ( op0 );
     printf ( "  separation at the starting point:  chi2=%lg  gof=%.2lf\n",
              chi2, gsl_sf_gamma_inc_Q ( N*(M-K)/2.0, chi2/2.0 ) );
-    dft_bck ( K, N, dftmod, mod+1 ); MxWrite ( mod, K+1, N, modfn );
-    dft_bck ( M, N, dftres, res+1 ); MxWrite ( res, M+1, N, resfn );
+    dft_bck ( K, Nfft, dftmod, mod+1 ); MxWrite ( mod, K+1, N, modfn );
+    dft_bck ( M, Nfft, dftres, res+1 ); MxWrite ( res, M+1, N, resfn );
     MxWrite( rvm, K, M, rvsfn );
 
     printf ( "  EXITING REGULARLY\n\n" );
+    perf_report ( stderr, "fd3" );
+    dft_free ();
 
     return EXIT_SUCCESS;
 
@@ -213,8 +225,9 @@ double meritfn ( double *opin )
 {
 
     long j, k;
-    double op[TRIORB_NP], rv[3];
+    double op[TRIORB_NP], rv[3], chi2, tp = 0;
 
+    PERF_COUNT(perf_merit_evals,1);
     op[ 0] = opin[ 0];
     op[ 1] = opin[ 1];
     op[ 2] = opin[ 2];
@@ -229,13 +242,19 @@ double meritfn ( double *opin )
     op[11] = opin[11] / rvstep;
     op[12] = opin[12] * (M_PI/180);
 
+    PERF_START(tp);
     for ( j = 0 ; j < M ; j++ ) {
         triorb_rv ( op, otimes[j], rv );
         for ( k = 0 ; k < K ; k++ )
             *(*(rvm+k)+j) = rv[ksw[k]] + *(rvcorr+j) / rvstep;
     }
+    PERF_STOP(PERF_ORBIT,tp);
 
-    return fd3sep ( K, M, N, dftobs, sig, rvm, lfm, dftmod, dftres );
+    chi2 = fd3sep ( K, M, Nfft, dftobs, sig, rvm, lfm, dftmod, dftres );
+    /* with an extended transform, count the residuals on the N bins of the window only, as gof does */
+    if ( Nfft > N )
+        chi2 = dft_chi2 ( M, N, Nfft, dftres, sig, res+1 );
+    return chi2;
 }
 
 /*****************************************************************************/
@@ -2,6 +2,7 @@
 #include <stdlib.h>
 
 #include "fd3sep.h"
+#include "../perf.h"
 
 #include <gsl/gsl_linalg.h>
 #include <gsl/gsl_matrix.h>
@@ -16,7 +17,7 @@ double fd3sep ( long K, long M, long N, double **dftobs, double *sig,
    double **rvm, double **lfm, double **dftmod, double **dftres ) {
 
    long i, j, k, n;
-   double s2;
+   double s2, tp = 0;
    gsl_matrix *A, *U, *X, *V;
    gsl_vector *S, *w, *b, *x;
 
@@ -37,6 +38,8 @@ double fd3sep ( long K, long M, long N, double **dftobs, double *sig,
 
       /* assemble data vector and model matrix */
 
+      PERF_START(tp);
+
       for ( j = 0 ; j < M ; j++ ) {
          double s = *(sig+j);
          gsl_vector_set ( b, 2*j,   *(*(dftobs+j)+2*n)  /s );
@@ -58,17 +61,25 @@ double fd3sep ( long K, long M, long N, double **dftobs, double *sig,
          gsl_matrix_memcpy ( U, A );
       }
 
+      PERF_STOP(PERF_ASSEMBLE,tp);
+
       /* solve for model parameters */
 
+      PERF_START(tp);
+
       /* gsl_linalg_SV_decomp ( U, V, S, w ); */
       /* gsl_linalg_SV_decomp_mod ( U, X, V, S, w ); */
       /* gsl_linalg_SV_decomp_jacobi ( U, V, S ); */
 
       gsl_linalg_SV_decomp_mod ( U, X, V, S, w );
       for ( k = 0 ; k < 2*K-1 ; k++ )
-         if ( gsl_vector_get(S,2*K-1-k)/gsl_vector_get(S,0) < SVCUT )
+         if ( gsl_vector_get(S,2*K-1-k)/gsl_vector_get(S,0) < SVCUT ) {
             gsl_vector_set ( S, 2*K-1-k, 0 );
+            PERF_COUNT(perf_svd_truncations,1);
+         }
       gsl_linalg_SV_solve ( U, V, S, b, x );
+      PERF_STOP(PERF_SVD,tp);
+      PERF_COUNT(perf_svd_solves,1);
 
       /* copy to output */
 
@@ -79,6 +90,8 @@ double fd3sep ( long K, long M, long N, double **dftobs, double *sig,
 
       /* compute s2 */
 
+      PERF_START(tp);
+
       for ( j = 0 ; j < M ; j++ ) for ( i = 0 ; i < 2 ; i++ ) {
 
         double bc, db, s = *(sig+j);
@@ -93,6 +106,8 @@ double fd3sep ( long K, long M, long N, double **dftobs, double *sig,
 
       }
 
+      PERF_STOP(PERF_CHI2,tp);
+
    }
 
    /* close */
@@ -112,27 +127,99 @@ double fd3sep ( long K, long M, long N, double **dftobs, double *sig,
 
 /*************************************************************************/
 
-void dft_fwd ( long m, long n, double **mxin, double **mxout ) {
+/* the wavetables and workspace of the last transform length, reused by all transforms of that length */
+static long dft_n = 0;
+static gsl_fft_real_wavetable * dft_rewt = NULL;
+static gsl_fft_halfcomplex_wavetable * dft_hcwt = NULL;
+static gsl_fft_real_workspace * dft_rews = NULL;
 
-   long i, j;
-   double a = 1.0 / sqrt(n);
-   gsl_fft_real_wavetable * dft_rewt;
-   gsl_fft_real_workspace * dft_rews;
+static void dft_plan ( long n ) {
 
-   dft_rewt = gsl_fft_real_wavetable_alloc (n);
+   if ( n == dft_n ) return;
+   dft_free ();
    dft_rews = gsl_fft_real_workspace_alloc (n);
+   dft_n = n;
+
+}
+
+void dft_free ( void ) {
+
+   if ( dft_rewt ) gsl_fft_real_wavetable_free ( dft_rewt );
+   if ( dft_hcwt ) gsl_fft_halfcomplex_wavetable_free ( dft_hcwt );
+   if ( dft_rews ) gsl_fft_real_workspace_free ( dft_rews );
+   dft_rewt = NULL;
+   dft_hcwt = NULL;
+   dft_rews = NULL;
+   dft_n = 0;
+
+}
+
+/*************************************************************************/
+
+long dft_taper ( void ) {
+
+   /* FD3_FFT_TAPER bins: extend the windows to a smooth transform length, tapered over that many bins at both
+      edges. Unset or 0: transform the windows as they are */
+   const char *s = getenv ( "FD3_FFT_TAPER" );
+
+   return s ? atol ( s ) : 0;
+
+}
+
+long dft_length ( long n, long taper ) {
+
+   /* the transform length of a window of n bins: n without a taper, else the smallest length >= n with only the
+      factors 2, 3 and 5, which GSL transforms with its fast radices instead of its slow generic one */
+   long l, r;
+
+   if ( taper <= 0 ) return n;
+   for ( l = n ; ; l++ ) {
+      for ( r = l ; r % 2 == 0 ; r /= 2 ) ;
+      for ( ; r % 3 == 0 ; r /= 3 ) ;
+      for ( ; r % 5 == 0 ; r /= 5 ) ;
+      if ( r == 1 ) return l;
+   }
+
+}
+
+/*************************************************************************/
+
+void dft_fwd ( long m, long n, double **mxin, double **mxout ) {
+
+   dft_fwd_ext ( m, n, n, 0, mxin, mxout );
+
+}
+
+void dft_fwd_ext ( long m, long n, long nfft, long taper, double **mxin, double **mxout ) {
+
+   /* transforms windows of n bins extended to nfft bins. The extra bins bridge the average of the last taper bins
+      to that of the first taper bins with a raised cosine, so the periodic spectrum has no jump at the edges */
+   long i, j, t = taper < 1 ? 1 : ( taper < n ? taper : n );
+   double a = 1.0 / sqrt(nfft), left, right, w;
+
+   dft_plan ( nfft );
+   if ( dft_rewt == NULL ) dft_rewt = gsl_fft_real_wavetable_alloc (nfft);
 
    for ( j = 0 ; j < m ; j++ ) {
       for ( i = 0; i < n; i++ ) *(*(mxout+j)+i+1) = a * *(*(mxin+j)+i);
-      gsl_fft_real_transform ( *(mxout+j)+1, 1, n, dft_rewt, dft_rews );
+      if ( nfft > n ) {
+         for ( left = right = i = 0 ; i < t ; i++ ) {
+            left += *(*(mxin+j)+i);
+            right += *(*(mxin+j)+n-1-i);
+         }
+         left *= a / t;
+         right *= a / t;
+         for ( i = n ; i < nfft ; i++ ) {
+            w = 0.5 * ( 1 + cos ( M_PI * ( i - n + 1 ) / ( nfft - n + 1 ) ) );
+            *(*(mxout+j)+i+1) = w * right + ( 1 - w ) * left;
+         }
+      }
+      gsl_fft_real_transform ( *(mxout+j)+1, 1, nfft, dft_rewt, dft_rews );
       *(*(mxout+j)+0) = *(*(mxout+j)+1);
       *(*(mxout+j)+1) = 0;
-      if ( ! n % 2 ) *(*(mxout+j)+n+1) = 0; /* if n even */
+      if ( ! (nfft % 2) ) *(*(mxout+j)+nfft+1) = 0; /* if n even */
    }
 
-   gsl_fft_real_wavetable_free ( dft_rewt );
-   gsl_fft_real_workspace_free ( dft_rews );
-
 }
 
 /*************************************************************************/
@@ -141,11 +228,9 @@ void dft_bck ( long m, long n, double **mxin, double **mxout ) {
 
    long i, j;
    double a = 1.0 / sqrt(n);
-   gsl_fft_halfcomplex_wavetable * dft_hcwt;
-   gsl_fft_real_workspace * dft_rews;
 
-   dft_hcwt = gsl_fft_halfcomplex_wavetable_alloc (n);
-   dft_rews = gsl_fft_real_workspace_alloc (n);
+   dft_plan ( n );
+   if ( dft_hcwt == NULL ) dft_hcwt = gsl_fft_halfcomplex_wavetable_alloc (n);
 
    for ( j = 0 ; j < m ; j++ ) {
       *(*(mxout+j)+0) = *(*(mxin+j)+0) / a;
@@ -153,8 +238,27 @@ void dft_bck ( long m, long n, double **mxin, double **mxout ) {
       gsl_fft_halfcomplex_inverse ( *(mxout+j), 1, n, dft_hcwt, dft_rews );
    }
 
-   gsl_fft_halfcomplex_wavetable_free ( dft_hcwt );
-   gsl_fft_real_workspace_free ( dft_rews );
+}
+
+/*************************************************************************/
+
+double dft_chi2 ( long m, long n, long nfft, double **dftres, double *sig, double **work ) {
+
+   /* the chi2 of the residuals on the n bins of the windows only, for transforms extended to nfft bins, whose
+      spectral sum also counts the residuals on the extra bins. work holds m rows of nfft bins */
+   long i, j;
+   double s2 = 0, r, tp = 0;
+
+   PERF_START(tp);
+   dft_bck ( m, nfft, dftres, work );
+   for ( j = 0 ; j < m ; j++ )
+      for ( i = 0 ; i < n ; i++ ) {
+         r = *(*(work+j)+i) / *(sig+j);
+         s2 += r * r;
+      }
+   PERF_STOP(PERF_CHI2,tp);
+
+   return s2;
 
 }
 
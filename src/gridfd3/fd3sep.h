@@ -1,7 +1,19 @@
 
-double fd3sep ( long K, long M, long N, double **dftobs, double **rvm, double *sig, double **lfm );
+double fd3sep ( long K, long M, long N, double **dftobs, double **rvm, double *sig, double **lfm, double **dftres );
 
 void dft_fwd ( long m, long n, double **mxin, double **mxout ) ;
 
+void dft_fwd_ext ( long m, long n, long nfft, long taper, double **mxin, double **mxout ) ;
+
+long dft_taper ( void ) ;
+
+long dft_length ( long n, long taper ) ;
+
+void dft_free ( void ) ;
+
+void dft_bck ( long m, long n, double **mxin, double **mxout ) ;
+
+double dft_chi2 ( long m, long n, long nfft, double **dftres, double *sig, double **work ) ;
+
 
 
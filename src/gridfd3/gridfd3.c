@@ -15,6 +15,7 @@
 #include "../mxfuns.h"
 #include "fd3sep.h"
 #include "../triorb.h"
+#include "../perf.h"
 
 /*****************************************************************************/
 
@@ -38,11 +39,12 @@ void fdbfailure(void) { exit ( EXIT_FAILURE ); }
 
 /*****************************************************************************/
 
-static long   K, M, N, Ndft, nfp;
-static double **dftobs, **dftmod;
-static double rvstep, *otimes, *rvcorr, *sig, **lfm, **rvm;
+static long   K, M, N, Nfft, Ndft, nfp;
+static double **dftobs, **dftmod, **dftres = NULL, **res;
+static double rvstep, *otimes, *rvcorr, *sig, **lfm, **rvm, **rvbase, *rvorb;
 static double op0[TRIORB_NP];
-static double meritfn ( double *op, double rvA, double rvB);
+static void orbitfn ( double *op );
+static double meritfn ( double rvA, double rvB, double dg );
 
 #define MX_FDBINARY_FORMAT "%15.8E   "
 static char *mxfd3fmts=MX_FDBINARY_FORMAT;
@@ -52,18 +54,26 @@ static char *mxfd3fmts=MX_FDBINARY_FORMAT;
 int main ( int argc, char *argv[] ) {
 
     long i, i0, i1, j, k, vc, vlen, rootfnlen;
-    double **masterobs, **obs, z0, z1, *rvAs, *rvBs, **chi2, lowA, highA, lowB, highB, stepA, stepB;
+    long l, taper;
+    double **masterobs, **obs, z0, z1, *rvAs, *rvBs, *dgs, chi2, lowA, highA, lowB, highB, stepA, stepB;
+    double lowG, highG, stepG, tp = 0;
     char rootfn[1024], obsfn[1024];
-    int sampA, sampB;
+    int sampA, sampB, sampG;
 
     setbuf ( stdout, NULL );
+    perf_init ();
     MxError( FDBErrorString, stdout, fdbfailure );
     MxFormat( mxfd3fmts );
     GETSTR ( rootfn );
     rootfnlen = strlen ( rootfn );
     vc=0;
     vlen=0;
-    sprintf ( obsfn, "%s", rootfn ); sprintf ( obsfn+rootfnlen, "%s", ".obs" );
+    /* root name "stdin": the master file follows on stdin, ahead of the rest of the input */
+    if ( strcmp ( "stdin", rootfn ) ) {
+        sprintf ( obsfn, "%s", rootfn ); sprintf ( obsfn+rootfnlen, "%s", ".obs" );
+    } else {
+        sprintf ( obsfn, "%s", rootfn );
+    }
     masterobs = MxLoad ( obsfn, &vc, &vlen );
     M = vc - 1;
     z0 = **masterobs;
@@ -91,16 +101,28 @@ int main ( int argc, char *argv[] ) {
             K++;
     }
 
-    Ndft = 2*(N/2 + 1);
+    /* the transform length, a smooth one the window is extended to if FD3_FFT_TAPER is set */
+    taper = dft_taper ();
+    Nfft = dft_length ( N, taper );
+    Ndft = 2*(Nfft/2 + 1);
     /* allocating memory */
     dftobs = MxAlloc ( M, Ndft );
+    /* an extended transform needs the residuals in the window to leave the extra bins out of chi2, see meritfn */
+    if ( Nfft > N ) {
+        dftres = MxAlloc ( M, Ndft );
+        res = MxAlloc ( M, Nfft );
+    }
     otimes = *MxAlloc ( 1, M );
     rvcorr = *MxAlloc ( 1, M );
     sig = *MxAlloc ( 1, M );
     rvm = MxAlloc ( K, M );
+    rvbase = MxAlloc ( K, M );
+    rvorb = *MxAlloc ( 1, M );
     lfm = MxAlloc ( K, M );
     /* transform to fourier space */
-    dft_fwd ( M, N, obs+1, dftobs );
+    PERF_START(tp);
+    dft_fwd_ext ( M, N, Nfft, taper, obs+1, dftobs );
+    PERF_STOP(PERF_DFT,tp);
     for ( j = 0 ; j < M ; j++ ) {
         GETDBL(otimes+j);
         GETDBL(rvcorr+j);
@@ -118,9 +140,14 @@ int main ( int argc, char *argv[] ) {
     GETDBL(&lowB);
     GETDBL(&highB);
     GETDBL(&stepB);
+    /* Delta gamma, the systemic velocity of B relative to A */
+    GETDBL(&lowG);
+    GETDBL(&highG);
+    GETDBL(&stepG);
 
     sampA = (highA - lowA) / stepA + 1;
     sampB = (highB - lowB) / stepB + 1;
+    sampG = (highG - lowG) / stepG + 1;
 
     rvAs = *MxAlloc(1, sampA);
     for (i=0; i<sampA; i++){
@@ -130,22 +157,34 @@ int main ( int argc, char *argv[] ) {
     for (i=0;i<sampB; i++){
         *(rvBs+i) = lowB + i*stepB;
     }
-    chi2 = MxAlloc(sampA, sampB);
+    dgs = *MxAlloc(1, sampG);
+    for (i=0;i<sampG; i++){
+        *(dgs+i) = lowG + i*stepG;
+    }
+
+    /* the orbit is the same for every grid point, so it is solved only once */
+    PERF_START(tp);
+    orbitfn ( op0 );
+    PERF_STOP(PERF_ORBIT,tp);
 
     // here is where the heavy lifting occurs
-    printf ( "k1 k2 chisq \n" );
+    printf ( "k1 k2 dgamma chisq \n" );
     for (i=0; i<sampA; i++){
         for (j=0; j<sampB; j++){
-            *(*(chi2+i)+j) = meritfn ( op0 , *(rvAs+i), *(rvBs+j));
-            printf ( "%.5f %.5f %.5f\n", *(rvAs+i), *(rvBs+j), *(*(chi2+i)+j));
+            for (l=0; l<sampG; l++){
+                chi2 = meritfn ( *(rvAs+i), *(rvBs+j), *(dgs+l));
+                printf ( "%.5f %.5f %.5f %.5f\n", *(rvAs+i), *(rvBs+j), *(dgs+l), chi2);
+            }
         }
     }
+    perf_report ( stderr, "gridfd3" );
+    dft_free ();
     return EXIT_SUCCESS;
 }
 
 /*****************************************************************************/
 
-double meritfn ( double *opin, double rvA, double rvB) {
+void orbitfn ( double *opin ) {
 
     long j, k;
     double op[TRIORB_NP+2], rv[3];
@@ -160,17 +199,41 @@ double meritfn ( double *opin, double rvA, double rvB) {
     op[ 7] = opin[ 7];
     op[ 8] = opin[ 8];
     op[ 9] = opin[ 9] * (M_PI/180);
-    op[10] = rvA / rvstep;
-    op[11] = rvB / rvstep;
+    /* unit semi-amplitudes: the rvs are linear in them, rv_A = rv_AB + K_A rv_orb and rv_B = rv_AB - K_B rv_orb */
+    op[10] = 1;
+    op[11] = 1;
     op[12] = opin[10] * (M_PI/180);
 
     for ( j = 0 ; j < M ; j++ ) {
         triorb_rv ( op, otimes[j], rv );
+        *(rvorb+j) = ( rv[0] - rv[1] ) / 2;
+        rv[0] = rv[1] = ( rv[0] + rv[1] ) / 2;
         for ( k = 0 ; k < K ; k++ )
-            *(*(rvm+k)+j) = rv[k] + *(rvcorr+j) / rvstep;
+            *(*(rvbase+k)+j) = rv[k] + *(rvcorr+j) / rvstep;
     }
+}
 
-    return fd3sep ( K, M, N, dftobs, rvm, sig, lfm);
+/*****************************************************************************/
+
+double meritfn ( double rvA, double rvB, double dg ) {
+
+    long j;
+    double chi2;
+
+    PERF_COUNT(perf_merit_evals,1);
+    for ( j = 0 ; j < M ; j++ ) {
+        *(*(rvm+0)+j) = *(*(rvbase+0)+j) + rvA / rvstep * *(rvorb+j);
+        *(*(rvm+1)+j) = *(*(rvbase+1)+j) - rvB / rvstep * *(rvorb+j) + dg / rvstep;
+    }
+    if ( K > 2 )
+        for ( j = 0 ; j < M ; j++ )
+            *(*(rvm+2)+j) = *(*(rvbase+2)+j);
+
+    chi2 = fd3sep ( K, M, Nfft, dftobs, rvm, sig, lfm, dftres );
+    /* with an extended transform, count the residuals on the N bins of the window only, as the dof does */
+    if ( Nfft > N )
+        chi2 = dft_chi2 ( M, N, Nfft, dftres, sig, res );
+    return chi2;
 }
 
 /*****************************************************************************/
@@ -64,7 +64,8 @@ double **MxLoad( const char *filename, long *vc, long *vlen ) {
         fp = stdin;
     }
 
-    if( 2 != fscanf( fp, "# %ld X %ld", vc, vlen ) ) {
+    /* the leading space skips the whitespace after a preceding token on stdin */
+    if( 2 != fscanf( fp, " # %ld X %ld", vc, vlen ) ) {
         sprintf( mxerr2, "failed parsing header of \"%s\"", filename);
         PrintError; TreatError;
     }
@@ -112,7 +113,9 @@ double **MxLoad( const char *filename, long *vc, long *vlen ) {
         }
     }
 
-    fclose(fp);
+    /* stdin stays open, the rest of the input may follow the matrix */
+    if ( stdin != fp )
+        fclose(fp);
 
     mxerr1 = mxerr0;
 
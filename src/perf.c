@@ -0,0 +1,59 @@
+#define _POSIX_C_SOURCE 199309L
+
+#include <stdlib.h>
+#include <time.h>
+
+#include "perf.h"
+
+int perf_on = 0;
+long perf_merit_evals = 0, perf_svd_solves = 0, perf_svd_truncations = 0;
+
+static double perf_time[PERF_NPHASES], perf_t0;
+static const char *perf_names[PERF_NPHASES] = {"dft_fwd", "triorb_rv", "assemble", "svd", "chi2"};
+
+/*****************************************************************************/
+
+void perf_init ( void ) {
+
+    const char *env = getenv ( "FD3_PERF" );
+
+    perf_on = env != NULL && atoi ( env ) != 0;
+    perf_t0 = perf_now ();
+}
+
+/*****************************************************************************/
+
+/* seconds on the monotonic clock */
+double perf_now ( void ) {
+
+    struct timespec ts;
+
+    clock_gettime ( CLOCK_MONOTONIC, &ts );
+    return ts.tv_sec + 1e-9 * ts.tv_nsec;
+}
+
+/*****************************************************************************/
+
+void perf_add ( int phase, double t0 ) {
+
+    perf_time[phase] += perf_now () - t0;
+}
+
+/*****************************************************************************/
+
+void perf_report ( FILE *fp, const char *engine ) {
+
+    int i;
+
+    if ( ! perf_on )
+        return;
+    fprintf ( fp, "# BEGIN PERF\n" );
+    fprintf ( fp, "engine %s\n", engine );
+    fprintf ( fp, "merit_evals %ld\n", perf_merit_evals );
+    fprintf ( fp, "svd_solves %ld\n", perf_svd_solves );
+    fprintf ( fp, "svd_truncations %ld\n", perf_svd_truncations );
+    for ( i = 0 ; i < PERF_NPHASES ; i++ )
+        fprintf ( fp, "time_%s %.9f\n", perf_names[i], perf_time[i] );
+    fprintf ( fp, "time_total %.9f\n", perf_now () - perf_t0 );
+    fprintf ( fp, "# END PERF\n" );
+}
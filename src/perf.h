@@ -0,0 +1,21 @@
+/*
+ *  Opt-in performance counters of the engines. Set the environment variable FD3_PERF to a nonzero value to enable
+ *  them; the summary is written to stderr as a block of "key value" lines between "# BEGIN PERF" and "# END PERF".
+ *  Disabled, every probe costs a single branch.
+ */
+
+#include <stdio.h>
+
+enum { PERF_DFT, PERF_ORBIT, PERF_ASSEMBLE, PERF_SVD, PERF_CHI2, PERF_NPHASES };
+
+extern int perf_on;
+extern long perf_merit_evals, perf_svd_solves, perf_svd_truncations;
+
+void perf_init ( void ) ;
+double perf_now ( void ) ;
+void perf_add ( int phase, double t0 ) ;
+void perf_report ( FILE *fp, const char *engine ) ;
+
+#define PERF_START(t) { if ( perf_on ) t = perf_now(); }
+#define PERF_STOP(phase,t) { if ( perf_on ) perf_add ( phase, t ); }
+#define PERF_COUNT(c,n) { if ( perf_on ) c += n; }
@@ -0,0 +1,170 @@
+"""
+End-to-end throughput benchmark of the gridfd3 pipeline on a synthetic binary with known K1 and K2.
+The spectra are written as FITS files in the format spectra_manager.getspectrum reads, so the run goes through the
+same loading, grid and Monte Carlo steps as gridfd3.py and gridfd3_renorm_MC.py. It reports the time of every step
+and checks that the known K1 and K2 are recovered.
+"""
+
+import glob
+import os
+import pathlib
+import shutil
+import time
+
+import numpy as np
+
+import modules.chisqstore as chisqstore
+import modules.convergence as convergence
+import modules.gridfd3classes as fd3classes
+import modules.synthetic as synthetic
+import outfile_analyser as oa
+
+# input
+# folders of the synthetic spectra and of the runs
+obj = 'synthetic'
+spectra_folder = obj + '/spectra'
+gridfd3folder = obj + '/gridfd3'
+
+# write the spectra anew, even if the folder already has them
+regenerate = False
+
+# the synthetic binary: p, t0, e, omega(A), and the semi-amplitudes to recover
+orbit = (1000., 100., 0.5, 40.)
+k1, k2 = 30., 50.
+epochs = 30
+snr = 300.
+seed = 0
+
+# do you want a (static) third component?
+thirdlight = False
+
+# light factors of your components (if thirdlight, give three)
+lfs = [0.6, 0.4]
+
+# every component gets one gaussian absorption line at the centre of every line window, with these depths and widths
+# (km/s) per component
+depths = [0.3, 0.2, 0.1]
+widths = [90., 70., 120.]
+
+# sampling of your spectra in angstrom
+sampling = 0.03
+
+# wavelength range(s) in angstrom and name of the line. The spectra cover all of them with margin
+lines = dict()
+lines['line4100'] = (4086., 4114.)
+lines['line4340'] = (4326., 4354.)
+lines['line4541'] = (4527., 4555.)
+lines['line4861'] = (4845., 4877.)
+
+# K1 and K2 ranges to be explored, in string form: 'left right step', all in km/s
+k1str = '20 40 1'
+k2str = '40 60 1'
+
+# engine evaluating the grid: 'gridfd3' for the compiled executable, 'numpy' for the pure NumPy engine
+engine = 'numpy'
+
+# Monte Carlo of N iterations with perturbed spectra, 0 to only time the single grid run
+N = 28
+cpus = os.cpu_count()
+
+# the recovered K1 and K2 must lie within this of the true values (km/s)
+ktol = 1.
+
+############################################################
+# Here we start our actual runs
+
+
+def run_join_threads(threads):
+    """
+    runs and joins the threads passed in the list 'threads'. Also catches any exceptions thrown in the threads
+    :param threads: list of threads to be run and joined
+    """
+    for thread in threads:
+        try:
+            thread.start()
+        except Exception as e:
+            print(repr(thread), e)
+    for thread in threads:
+        thread.join()
+
+
+starttime = time.time()
+failures = list()
+report = list()
+
+# write the synthetic spectra
+allfiles = sorted(glob.glob(spectra_folder + '/*.fits'))
+if regenerate or len(allfiles) != epochs:
+    print('writing {} synthetic spectra to {}'.format(epochs, spectra_folder))
+    shutil.rmtree(spectra_folder, ignore_errors=True)
+    ncomp = 3 if thirdlight else 2
+    centres = [(lo + hi) / 2 for lo, hi in lines.values()]
+    comps = synthetic.SyntheticComponents.from_lines([centres] * ncomp, [[d] * len(centres) for d in depths[:ncomp]],
+                                                     [[w] * len(centres) for w in widths[:ncomp]])
+    margin = 300 * sampling
+    coverage = (min(lo for lo, _ in lines.values()) - margin, max(hi for _, hi in lines.values()) + margin)
+    now = time.time()
+    allfiles, _ = synthetic.synthetic_dataset(spectra_folder, comps, coverage, epochs, thirdlight, orbit + (k1, k2),
+                                              lfs, snr, seed, sampling)
+    report.append('writing {} spectra took {:.3g}s'.format(epochs, time.time() - now))
+
+pathlib.Path(gridfd3folder).mkdir(parents=True, exist_ok=True)
+shutil.rmtree(gridfd3folder + '/chisqs', ignore_errors=True)
+fd3lineobjects = list()
+for line in lines.keys():
+    fd3lineobjects.append(
+        fd3classes.Fd3class(line, lines[line], sampling, allfiles, thirdlight, orbit, lfs=lfs, k1s=k1str, k2s=k2str,
+                            engine=engine))
+points = len(chisqstore.k_axis(k1str)) * len(chisqstore.k_axis(k2str))
+
+# the gridfd3.py pipeline: one grid per line, in parallel threads
+print('running the grid of {} lines'.format(len(lines)))
+now = time.time()
+run_join_threads([fd3classes.GridFd3Thread(gridfd3folder, fd3line) for fd3line in fd3lineobjects])
+elapsed = time.time() - now
+report.append('grid run of {} lines x {} points took {:.3g}s, {:.3g} points/s (including loading {} spectra per line)'
+              .format(len(lines), points, elapsed, len(lines) * points / elapsed, epochs))
+mink1, mink2 = oa.get_min_of_run(gridfd3folder)
+report.append('grid minimum K1 = {}, K2 = {} (true {}, {})'.format(mink1, mink2, k1, k2))
+if abs(mink1 - k1) > ktol or abs(mink2 - k2) > ktol:
+    failures.append('grid minimum')
+
+# the gridfd3_renorm_MC.py pipeline: Monte Carlo over perturbed spectra, every thread writing to one store
+if N > 0:
+    print('running a Monte Carlo of {} iterations in {} threads'.format(N, cpus))
+    # the grid run used the unperturbed spectra, only the Monte Carlo perturbs them, drawn from the seed so that the
+    # benchmark is reproducible
+    for fd3line in fd3lineobjects:
+        fd3line.ps = True
+    storelines = [repr(fd3line) for fd3line in fd3lineobjects if fd3line.no_used_spectra > 0]
+    store = chisqstore.ChisqStore.create(gridfd3folder + '/chisqstore', N, storelines, k1str, k2str, seed=seed)
+    gridthreads = list()
+    first = 0
+    for i in range(cpus):
+        iterations = N // cpus + (1 if i < N % cpus else 0)
+        if iterations:
+            gridthreads.append(fd3classes.GridFd3MCThread(gridfd3folder, i + 1, iterations, fd3lineobjects, store,
+                                                          first))
+        first += iterations
+    now = time.time()
+    run_join_threads(gridthreads)
+    elapsed = time.time() - now
+    report.append('Monte Carlo of {} iterations took {:.3g}s, {:.3g} iterations/s, {:.3g} points/s'.format(
+        N, elapsed, N / elapsed, N * len(storelines) * points / elapsed))
+    _, mink1s, mink2s = chisqstore.combine_minima(store)
+    for name, true, mins in (('K1', k1, mink1s), ('K2', k2, mink2s)):
+        low, high = convergence.quantiles(mins)
+        report.append('Monte Carlo {} = {:.2f} +- {:.2f}, 15.8% - 84.2% quantiles {} - {} (true {})'.format(
+            name, np.mean(mins), np.std(mins), low, high, true))
+        if not low - ktol <= true <= high + ktol:
+            failures.append('Monte Carlo ' + name)
+
+print(fd3classes.TIMELINE.summary())
+fd3classes.TIMELINE.export_chrome(gridfd3folder + '/trace.json')
+print('\n'.join(report))
+with open(gridfd3folder + '/benchmark.txt', 'w') as f:
+    f.write('\n'.join(report) + '\n')
+print('benchmark took {}s'.format(time.time() - starttime))
+if failures:
+    print('K1 and K2 not recovered by: {}'.format(', '.join(failures)))
+    exit(1)